@@ -10,8 +10,14 @@
 ##
 __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
+import functools
+from collections import Counter
+
 import file_utils as fu
 import utils as u
+import db_pool as dbp
+import ref_backend as rb
+import transcript_models as tm
 
 indicesKnownGenes = [12, 1, 3]  # 12 for gene
 
@@ -147,101 +153,386 @@ def getComplementary(nuc):
         return compNuc
 
 
+"""Header tests used by the per-file stages
+   isCommentLine: any line starting with '#'
+   isHeaderLine: '##' meta lines and the CHROM column header
+"""
+
+
+def isCommentLine(line):
+    return line.startswith("#")
+
+
+def isHeaderLine(line):
+    return (
+        line.startswith("##") or line.startswith("CHROM") or line.startswith("#CHROM")
+    )
+
+
+"""Appends an annotation to the INFO field, adding the ';' separator
+   only when the field does not already end with one
+"""
+
+
+def appendInfo(fields, annotation):
+    if annotation is None:
+        return fields
+
+    if str(fields[7]).endswith(";"):
+        fields[7] = fields[7] + annotation
+    else:
+        fields[7] = fields[7] + ";" + annotation
+    return fields
+
+
+"""Runs one annotation stage over a whole file
+
+   Every stage is split into a lookup, which queries the reference
+   database for a single variant and returns its annotation (or None),
+   and an apply, which writes that annotation into the VCF fields.
+   Counters are kept in a Counter and written to the count log by 'log'.
+   The fused pipeline in pipeline.py calls the same lookup/apply functions
+   without the intermediate files.
+
+   lookupBlock, when given, replaces lookup: it takes a list of split
+   records and returns one annotation per record, so a stage can batch
+   its queries. Records are handed to it blockSize at a time.
+
+   Most lookups also take 'index', used in place of the per-variant
+   query: a ref_index.IntervalIndex for the small tables, or a
+   merge_join.SortedExtract when the input is coordinate-sorted.
+   Both return the matching rows for (chrom, pos).
+"""
+
+
+def runStage(
+    vcf,
+    lookup,
+    apply=appendInfo,
+    log=None,
+    label="",
+    logmode="a",
+    isHeader=isHeaderLine,
+    format="vcf",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    lookupBlock=None,
+    blockSize=1000,
+    **options,
+):
+
+    fh = open(vcf + tmpextin)
+    fh_out = open(vcf + tmpextout, "w")
+
+    counts = Counter()
+    inds = getFormatSpecificIndices(format=format)
+    with dbp.connection() as conn:
+        annotateBlock = functools.partial(
+            writeBlock,
+            fh_out,
+            apply=apply,
+            lookup=lookup,
+            lookupBlock=lookupBlock,
+            cursor=conn.cursor(),
+            counts=counts,
+            inds=inds,
+            options=options,
+        )
+
+        block = []
+        for line in fh:
+            line = line.strip()
+            if isHeader(line):
+                annotateBlock(block)
+                block = []
+                fh_out.write(line + "\n")
+            else:
+                block.append(line.split(sep))
+                if len(block) >= blockSize:
+                    annotateBlock(block)
+                    block = []
+
+        annotateBlock(block)
+
+    if log is not None:
+        fh_log = open(vcf + ".count.log", logmode)
+        log(fh_log, counts, label)
+        fh_log.close()
+
+    fh.close()
+    fh_out.close()
+
+    return counts
+
+
+def writeBlock(
+    fh_out, block, apply, lookup, lookupBlock, cursor, counts, inds, options
+):
+    if lookupBlock is None:
+        annotations = [
+            lookup(fields, cursor, counts, inds, **options) for fields in block
+        ]
+    else:
+        annotations = lookupBlock(block, cursor, counts, inds, **options)
+
+    for fields, annotation in zip(block, annotations):
+        fields = apply(fields, annotation)
+        fh_out.write("\t".join([str(x) for x in fields]) + "\n")
+
+
+"""Writes the standard per-table line to the count log
+"""
+
+
+def logOverlap(fh_log, counts, label):
+    fh_log.write(
+        f"In {str(label)}: {str(counts['var_count'])} in "
+        + f"{str(counts['line_count'])} variants\n"
+    )
+
+
 """"Format must be pileup or vcf
     Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
 """
 
 
 def getSnpsFromDbSnp(
-    vcf, format="vcf", tmpextin="", tmpextout=".1", varclass="SNV", sep="\t"
+    vcf,
+    format="vcf",
+    tmpextin="",
+    tmpextout=".1",
+    varclass="SNV",
+    sep="\t",
+    window=0,
+    index=None,
 ):
 
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + ".count.log"
-    fh_log = open(logcountfile, "w")
-    var_count = 0
+    options = {}
+    if window > 0:
+        options = {
+            "lookupBlock": lookupDbSnpBlock,
+            "blockSize": window,
+            "window": window,
+        }
+
+    runStage(
+        vcf,
+        lookupDbSnp,
+        apply=applyDbSnp,
+        log=logDbSnp,
+        label="dbSNP",
+        logmode="w",
+        isHeader=isCommentLine,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+        varclass=varclass,
+        index=index,
+        **options,
+    )
 
-    inds = getFormatSpecificIndices(format=format)
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+"""Returns the dbSNP hits for a variant as (rsids, mafs, varclass),
+   or None when the variant is not in dbSNP
+"""
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace("chr", "")
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
+def lookupDbSnp(
+    fields, cursor, counts, inds, varclass="SNV", index=None, snapshot=None
+):
+    if snapshot is not None:
+        return lookupDbSnpBlock(
+            [fields], cursor, counts, inds, varclass=varclass, snapshot=snapshot
+        )[0]
+
+    chr = fields[inds[0]].strip()
+    if chr.startswith("chr"):
+        chr = chr.replace("chr", "")
+
+    pos = fields[inds[1]].strip()
+    ref = clean_mysql_chars(fields[inds[2]]).strip()
+    compRef = getComplementary(ref)
+
+    if index is not None:
+        rows = [
+            r[1:] for r in index.overlapping(chr, pos) if matchesRef(r[0], ref, compRef)
+        ]
+    else:
+        rows = rb.for_table("dbSNP", cursor).exact(
+            "dbSNP",
+            [
+                ("CHR", chr),
+                ("POS", int(pos)),
+                ("REF", [ref, compRef]),
+                ("INFO", varclass),
+            ],
+        )
+
+    counts["linenum"] += 1
+    return dbSnpHits(rows, counts, varclass)
+
+
+"""Batched dbSNP lookup for a block of records
+
+   Variants are grouped by chromosome and resolved with one
+   POS IN (...) query per 'window' of distinct positions; rows are then
+   joined back to each record in input order. REF is matched case-insensitively,
+   as MySQL does for the per-variant query, so the hits (and their order)
+   are the same as calling lookupDbSnp on every record.
+
+   With a 'snapshot' (dbsnp_snapshot.DbSnpSnapshot) the positions of each
+   chromosome are resolved against the memory-mapped POS array instead.
+"""
 
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
 
-            sql = (
-                'select * from dbSNP where CHR="'
-                + str(chr)
-                + '" AND POS='
-                + str(pos)
-                + ' AND ( REF="'
-                + str(ref)
-                + '" OR REF ="'
-                + str(compRef)
-                + '" )  AND INFO = "'
-                + varclass
-                + '" ;'
+def lookupDbSnpBlock(
+    block,
+    cursor,
+    counts,
+    inds,
+    varclass="SNV",
+    window=1000,
+    index=None,
+    snapshot=None,
+):
+    if index is not None and snapshot is None:
+        return [
+            lookupDbSnp(fields, cursor, counts, inds, varclass=varclass, index=index)
+            for fields in block
+        ]
+
+    variants = []
+    byChrom = {}
+    for fields in block:
+        chr = fields[inds[0]].strip()
+        if chr.startswith("chr"):
+            chr = chr.replace("chr", "")
+
+        pos = int(fields[inds[1]].strip())
+        ref = clean_mysql_chars(fields[inds[2]]).strip()
+        compRef = getComplementary(ref)
+
+        variants.append((chr, pos, ref, compRef))
+        byChrom.setdefault(chr, []).append((pos, ref, compRef))
+
+    if snapshot is not None:
+        spans = {}
+        for chr, keys in byChrom.items():
+            positions = sorted(set([k[0] for k in keys]))
+            spans[chr] = snapshot.find(chr, positions)
+
+        hits = []
+        for chr, pos, ref, compRef in variants:
+            span = spans[chr].get(pos)
+            ids = [] if span is None else snapshot.matches(chr, span, ref, compRef)
+            counts["linenum"] += 1
+            hits.append(dbSnpIdHits(ids, counts, varclass))
+        return hits
+
+    rowsByPos = {}
+    for chr, keys in byChrom.items():
+        # Window over distinct positions, so rows at a position repeated
+        # in the block are fetched (and joined back) only once
+        refsByPos = {}
+        for pos, ref, compRef in keys:
+            refsByPos.setdefault(pos, set()).update([ref, compRef])
+        distinct = sorted(refsByPos)
+        for i in range(0, len(distinct), window):
+            positions = distinct[i : i + window]
+            refs = sorted(set().union(*[refsByPos[pos] for pos in positions]))
+
+            rows = rb.for_table("dbSNP", cursor).exact(
+                "dbSNP",
+                [("CHR", chr), ("POS", positions), ("REF", refs), ("INFO", varclass)],
+                columns=["POS", "REF", "dbSNP.*"],
             )
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+            for row in rows:
+                rowsByPos.setdefault((chr, int(row[0])), []).append(row)
 
-            fields[2] = "."
-            rsids = []
-            mafs = []
-            if len(rows) > 0:
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if str(row[7]) != ".":
-                        mafs.append("GMAF=" + str(row[7]))
+    hits = []
+    for chr, pos, ref, compRef in variants:
+        rows = [
+            row[2:]
+            for row in rowsByPos.get((chr, pos), [])
+            if matchesRef(row[1], ref, compRef)
+        ]
+        counts["linenum"] += 1
+        hits.append(dbSnpHits(rows, counts, varclass))
 
-                maf_str = ""
-                if len(mafs) > 0:
-                    maf_str = ";" + ";".join([str(x) for x in mafs])
+    return hits
 
-                var_count = var_count + 1
-                if str(fields[7]) == ".":
-                    fields[7] = "DB" + maf_str
-                else:
-                    fields[7] = fields[7] + ";DB;VC=" + varclass + maf_str
 
-                fields[2] = str(";".join(rsids))
-                l = "\t".join([str(x) for x in fields])
-                fh_out.write(l + "\n")
+"""REF test of the dbSNP query, case-insensitive like MySQL's
+"""
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write("\t".join([str(x) for x in fields]) + "\n")
 
-            linenum = linenum + 1
+def matchesRef(value, ref, compRef):
+    return str(value).upper() in [ref.upper(), compRef.upper()]
 
-        else:
-            fh_out.write(line + "\n")
 
+"""Collapses dbSNP rows, or their (rsid, GMAF) pairs, into
+(rsids, mafs, varclass)
+"""
+
+
+def dbSnpHits(rows, counts, varclass="SNV"):
+    return dbSnpIdHits([(row[3], row[7]) for row in rows], counts, varclass)
+
+
+def dbSnpIdHits(ids, counts, varclass="SNV"):
+    if len(ids) == 0:
+        return None
+
+    rsids = []
+    mafs = []
+    for rsid, gmaf in ids:
+        rsids.append(str(rsid))
+        if str(gmaf) != ".":
+            mafs.append("GMAF=" + str(gmaf))
+
+    counts["var_count"] += 1
+    return (rsids, mafs, varclass)
+
+
+"""Counters lookupDbSnp bumps for a record, given what it returned
+"""
+
+
+def countDbSnp(hits):
+    return Counter(linenum=1, var_count=0 if hits is None else 1)
+
+
+def applyDbSnp(fields, hits):
+    ## reset rsid to "." - in case there was annotation from old release of dbSNP
+    fields[2] = "."
+    if hits is None:
+        return fields
+
+    rsids, mafs, varclass = hits
+    maf_str = ""
+    if len(mafs) > 0:
+        maf_str = ";" + ";".join([str(x) for x in mafs])
+
+    if str(fields[7]) == ".":
+        fields[7] = "DB" + maf_str
+    else:
+        fields[7] = fields[7] + ";DB;VC=" + varclass + maf_str
+
+    fields[2] = str(";".join(rsids))
+    return fields
+
+
+def logDbSnp(fh_log, counts, label="dbSNP"):
+    # linenum starts at 1, as it always has
+    linenum = counts["linenum"] + 1
+    var_count = counts["var_count"]
     ratioInDbSnp = (var_count / float(linenum)) * 100
     fh_log.write("## Please notice that all Isoforms were counted\n")
     fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
     fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    fh_log.write(f"In {label}: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
 
 
 """NOTE: all isoforms are collapsed in one record
@@ -251,139 +542,235 @@ def getSnpsFromDbSnp(
 """
 
 
-def getBigRefGene(vcf, format="vcf", tmpextin=".1", tmpextout=".2", sep="\t"):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
+def getBigRefGene(vcf, format="vcf", tmpextin=".1", tmpextout=".2", sep="\t", window=0):
+
+    options = {}
+    if window > 0:
+        options = {
+            "lookupBlock": lookupBigRefGeneBlock,
+            "blockSize": window,
+            "window": window,
+        }
+
+    runStage(
+        vcf,
+        lookupBigRefGene,
+        apply=applyBigRefGene,
+        isHeader=isCommentLine,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+        **options,
+    )
 
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace("chr", "")
+def lookupBigRefGene(fields, cursor, counts, inds):
+    chr = fields[inds[0]].strip()
+    if chr.startswith("chr"):
+        chr = chr.replace("chr", "")
+
+    pos = fields[inds[1]].strip()
+    ref = clean_mysql_chars(fields[inds[2]]).strip()
+    alt = clean_mysql_chars(fields[inds[3]]).strip()
+
+    compRef = getComplementary(ref)
+    compAlt = getComplementary(alt)
+
+    # Tables are tried in order; the first one with any rows wins
+    table = "chrom_pos_equal_base"
+    wanted = [(ref.upper(), alt.upper()), (compRef.upper(), compAlt.upper())]
+    rows = [
+        row[2:]
+        for row in rb.for_table(table, cursor).exact(
+            table,
+            [
+                ("CHR", chr),
+                ("start", int(pos)),
+                ("haplotypeReference", [ref, compRef]),
+                ("haplotypeAlternate", [alt, compAlt]),
+            ],
+            columns=["haplotypeReference", "haplotypeAlternate", table + ".*"],
+        )
+        if (str(row[0]).upper(), str(row[1]).upper()) in wanted
+    ]
+    if len(rows) == 0:
+        table = "chrom_pos_equal_nobase"
+        rows = rb.for_table(table, cursor).point(table, "CHR", chr, "start", int(pos))
+    if len(rows) == 0:
+        table = "chrom_pos_unequal"
+        rows = rb.for_table(table, cursor).overlap(
+            table, "CHR", chr, "start", "end", int(pos)
+        )
+    if len(rows) > 0:
+        return collapseRefSeqRows(rows)
+
+    return None
+
+
+"""Batched, tiered BigRefGene lookup for a block of records
+
+   Variants are grouped by chromosome and, per 'window' of variants,
+   each tier is fetched with one query for all the variants still
+   unresolved: chrom_pos_equal_base and chrom_pos_equal_nobase by
+   start IN (...), chrom_pos_unequal by one OR of the covering ranges.
+   The precedence rules of lookupBigRefGene (first tier with any rows
+   wins; base matches compare REF/ALT case-insensitively, as MySQL does)
+   are then applied in memory, so a window costs at most three queries.
+"""
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
 
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
+def lookupBigRefGeneBlock(block, cursor, counts, inds, window=1000):
+    variants = []
+    byChrom = {}
+    for fields in block:
+        chr = fields[inds[0]].strip()
+        if chr.startswith("chr"):
+            chr = chr.replace("chr", "")
 
-            sql1 = (
-                'select * from chrom_pos_equal_base where CHR="'
-                + str(chr)
-                + '" AND start = '
-                + str(pos)
-                + ' AND ((haplotypeReference="'
-                + str(ref)
-                + '" AND haplotypeAlternate ="'
-                + str(alt)
-                + '") OR (haplotypeReference="'
-                + str(compRef)
-                + '" AND haplotypeAlternate ="'
-                + str(compAlt)
-                + '"));'
-            )
+        pos = int(fields[inds[1]].strip())
+        ref = clean_mysql_chars(fields[inds[2]]).strip()
+        alt = clean_mysql_chars(fields[inds[3]]).strip()
+        key = (pos, ref, alt, getComplementary(ref), getComplementary(alt))
 
-            sql2 = (
-                'select * from chrom_pos_equal_nobase where CHR="'
-                + str(chr)
-                + '" AND start = '
-                + str(pos)
-                + ";"
-            )
+        variants.append((chr, key))
+        byChrom.setdefault(chr, []).append(key)
 
-            sql3 = (
-                'select * from chrom_pos_unequal where CHR="'
-                + str(chr)
-                + '" AND start <= '
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= end ;"
+    resolved = {}
+    for chr, keys in byChrom.items():
+        for i in range(0, len(keys), window):
+            resolveBigRefGeneTiers(cursor, chr, keys[i : i + window], resolved)
+
+    return [resolved.get((chr, key)) for chr, key in variants]
+
+
+def resolveBigRefGeneTiers(cursor, chr, keys, resolved):
+    pending = sorted(set(keys))
+
+    # 1. chrom_pos_equal_base: same start and REF/ALT (or complement)
+    positions = sorted(set([k[0] for k in pending]))
+    table = "chrom_pos_equal_base"
+    rows = rb.for_table(table, cursor).point(
+        table,
+        "CHR",
+        chr,
+        "start",
+        positions,
+        columns=["start", "haplotypeReference", "haplotypeAlternate", table + ".*"],
+    )
+    byStart = {}
+    for row in rows:
+        byStart.setdefault(int(row[0]), []).append(row)
+    unresolved = []
+    for pos, ref, alt, compRef, compAlt in pending:
+        wanted = [(ref.upper(), alt.upper()), (compRef.upper(), compAlt.upper())]
+        hits = [
+            row[3:]
+            for row in byStart.get(pos, [])
+            if (str(row[1]).upper(), str(row[2]).upper()) in wanted
+        ]
+        if len(hits) > 0:
+            resolved[(chr, (pos, ref, alt, compRef, compAlt))] = collapseRefSeqRows(
+                hits
             )
+        else:
+            unresolved.append((pos, ref, alt, compRef, compAlt))
+    pending = unresolved
+    if len(pending) == 0:
+        return
+
+    # 2. chrom_pos_equal_nobase: same start
+    positions = sorted(set([k[0] for k in pending]))
+    table = "chrom_pos_equal_nobase"
+    rows = rb.for_table(table, cursor).point(
+        table, "CHR", chr, "start", positions, columns=["start", table + ".*"]
+    )
+    byStart = {}
+    for row in rows:
+        byStart.setdefault(int(row[0]), []).append(row[1:])
+    unresolved = []
+    for key in pending:
+        if key[0] in byStart:
+            resolved[(chr, key)] = collapseRefSeqRows(byStart[key[0]])
+        else:
+            unresolved.append(key)
+    pending = unresolved
+    if len(pending) == 0:
+        return
+
+    # 3. chrom_pos_unequal: start <= pos <= end
+    positions = sorted(set([k[0] for k in pending]))
+    table = "chrom_pos_unequal"
+    rows = rb.for_table(table, cursor).overlap(
+        table,
+        "CHR",
+        chr,
+        "start",
+        "end",
+        positions,
+        columns=["start", "end", table + ".*"],
+    )
+    for key in pending:
+        hits = [row[2:] for row in rows if int(row[0]) <= key[0] <= int(row[1])]
+        if len(hits) > 0:
+            resolved[(chr, key)] = collapseRefSeqRows(hits)
 
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
 
-            if len(rows) > 0:
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(
-                        collapseRefSeq("\t".join([str(x) for x in row[1 : len(row)]]))
-                    )
+def collapseRefSeqRows(rows):
+    m = set([])
+    for row in rows:
+        m.add(collapseRefSeq("\t".join([str(x) for x in row[1 : len(row)]])))
+    return ";".join(m)
 
-                fields[7] = fields[7] + ";" + ";".join(m)
-                if str(fields[7]).startswith(".;"):
-                    fields[7] = str(fields[7]).replace(".;", "", 1)
 
-                l = "\t".join([str(x) for x in fields])
-                fh_out.write(l + "\n")
+"""lookupBigRefGene keeps no counters
+"""
 
-            if keep_going:
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
 
-                if len(rows) > 0:
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(
-                            collapseRefSeq(
-                                "\t".join([str(x) for x in row[1 : len(row)]])
-                            )
-                        )
+def countBigRefGene(refseq):
+    return Counter()
 
-                    fields[7] = fields[7] + ";" + ";".join(m)
-                    if str(fields[7]).startswith(".;"):
-                        fields[7] = str(fields[7]).replace(".;", "", 1)
 
-                    l = "\t".join([str(x) for x in fields])
-                    fh_out.write(l + "\n")
+def applyBigRefGene(fields, refseq):
+    if refseq is None:
+        return fields
 
-            if keep_going:
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
+    fields[7] = fields[7] + ";" + refseq
+    if str(fields[7]).startswith(".;"):
+        fields[7] = str(fields[7]).replace(".;", "", 1)
+    return fields
 
-                if len(rows) > 0:
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(
-                            collapseRefSeq(
-                                "\t".join([str(x) for x in row[1 : len(row)]])
-                            )
-                        )
 
-                    fields[7] = fields[7] + ";" + ";".join(m)
-                    if str(fields[7]).startswith(".;"):
-                        fields[7] = str(fields[7]).replace(".;", "", 1)
+"""CpG island (chrom, chromStart, chromEnd, name) holding a position,
+or None; read from 'cpgIndex' (ref_backend.get_memo_index over
+cpgIslandExt, CPG_ISLAND_COLUMNS) when given
+"""
+CPG_ISLAND_COLUMNS = ["chrom", "chromStart", "chromEnd", "name"]
 
-                    l = "\t".join([str(x) for x in fields])
-                    fh_out.write(l + "\n")
 
-            if keep_going:
-                fh_out.write(line + "\n")
+def getCpgIsland(cursor, chr, pos, cpgIndex=None):
+    if cpgIndex is not None:
+        return cpgIndex.first(chr, pos)
+
+    rows = rb.for_table("cpgIslandExt", cursor).overlap(
+        "cpgIslandExt",
+        "chrom",
+        chr,
+        "chromStart",
+        "chromEnd",
+        int(pos),
+        columns=CPG_ISLAND_COLUMNS,
+    )
+    return rows[0] if len(rows) > 0 else None
 
-            vcf_linenum = vcf_linenum + 1
 
-        else:
-            fh_out.write(line + "\n")
+"""The positionType in INFO that lookupGenes counts by
+"""
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+
+def positionTypeOf(fields):
+    info_field = clean_mysql_chars(fields[7]).strip()
+    return str(u.parse_field(info_field, "positionType", ";", "="))
 
 
 """Get information about location in gene structures
@@ -398,6 +785,156 @@ def getGenes(
     tmpextin=".2",
     tmpextout=".3",
     sep="\t",
+    index=None,
+    cpgIndex=None,
+):
+
+    runStage(
+        vcf,
+        lookupGenes,
+        apply=applyGenes,
+        log=logGenes,
+        label=table,
+        isHeader=isCommentLine,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+        table=table,
+        promoter_offset=promoter_offset,
+        index=index,
+        cpgIndex=cpgIndex,
+    )
+
+
+"""Returns the gene structure annotations for a variant joined with ';',
+   or None when the variant is interGenic
+"""
+
+
+def lookupGenes(
+    fields,
+    cursor,
+    counts,
+    inds,
+    table="refGene",
+    promoter_offset=500,
+    index=None,
+    cpgIndex=None,
+):
+    chr = fields[inds[0]].strip()
+
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
+
+    pos = fields[inds[1]].strip()
+    info_field = clean_mysql_chars(fields[7]).strip()
+
+    if index is not None:
+        rows = index.overlapping(chr, pos)
+    else:
+        rows = rb.for_table(table, cursor).overlap(
+            table, "chrom", chr, "txStart", "txEnd", int(pos), pad=promoter_offset
+        )
+
+    if len(rows) == 0:
+        counts["interGenic_count"] += 1
+        return None
+
+    info = []
+    cnt = 1
+    for row in rows:
+        # count location
+        positionType = str(u.parse_field(info_field, "positionType", ";", "="))
+
+        if positionType == "intron":
+            counts["intronic_count"] += 1
+        elif positionType == "non_coding_intron":
+            counts["non_coding_intronic_count"] += 1
+        elif positionType == "CDS":
+            counts["cds_count"] += 1
+        elif positionType == "non_coding_exon":
+            counts["non_coding_exonic_count"] += 1
+        elif positionType == "utr5":
+            counts["utr5_count"] += 1
+        elif positionType == "utr3":
+            counts["utr3_count"] += 1
+
+        model = tm.get_model(row, promoter_offset)
+        region = ""
+        pos = int(pos)
+
+        if model.nonCoding:
+            exons = ["non_coding_exon=" + model.exonLabel(e) for e in model.exons(pos)]
+            if len(exons) > 0:
+                region = ";".join(exons)
+        elif model.inCds(pos):
+            exons = ["exon=" + model.exonLabel(e) for e in model.exons(pos)]
+            counts["exonic_count"] += len(exons)
+            if len(exons) > 0:
+                region = ";".join(exons)
+
+        elif model.inPromoter(pos):
+            cpg = getCpgIsland(cursor, chr, pos, cpgIndex)
+
+            if cpg is not None:
+                region = "putativePromoterRegion=" + "".join(str(cpg[3]).split())
+                counts["promoter_count"] += 1
+
+        if region != "":
+            info.append(
+                collapseGeneNames(
+                    row=row,
+                    indices=indicesKnownGenes,
+                    region=region,
+                    cnt=cnt,
+                )
+            )
+
+        cnt = cnt + 1
+
+    return ";".join(info)
+
+
+def applyGenes(fields, genes):
+    if genes is None:
+        fields[7] = fields[7] + ";positionType=interGenic"
+    else:
+        fields[7] = fields[7] + ";" + genes
+    return fields
+
+
+def logGenes(fh_log, counts, label="refGene"):
+    lines = [
+        "Variants located:",
+        f"In interGenic {str(counts['interGenic_count'])}",
+        f"In CDS {str(counts['cds_count'])}",
+        f"In '3 UTR {str(counts['utr3_count'])}",
+        f"In '5 UTR {str(counts['utr5_count'])}",
+        f"In Intronic {str(counts['intronic_count'])}",
+        f"In Non_coding_intronic {str(counts['non_coding_intronic_count'])}",
+        f"In Exonic {str(counts['exonic_count'])}",
+        f"In Non_coding_exonic {str(counts['non_coding_exonic_count'])}",
+        f"In Putative Promoter Region {str(counts['promoter_count'])}",
+    ]
+    for line in lines:
+        print(line)
+        fh_log.write(line + "\n")
+
+
+"""Method used in INDELS, where bigRefGeneTable is not applicable
+"""
+
+
+def getExonsEtAl(
+    vcf,
+    format="vcf",
+    table="refGene",
+    promoter_offset=500,
+    tmpextin=".2",
+    tmpextout=".3",
+    sep="\t",
+    cpgIndex=None,
 ):
 
     basefile = vcf
@@ -420,7 +957,8 @@ def getGenes(
 
     inds = getFormatSpecificIndices(format=format)
     fh = open(vcf)
-    conn = u.db_connect()
+    pool = dbp.get_pool()
+    conn = pool.acquire()
     cursor = conn.cursor()
     linenum = 1
 
@@ -444,7 +982,7 @@ def getGenes(
                 + table
                 + ' where chrom="'
                 + str(chr)
-                + '" AND (txStart - '
+                + '"   AND (txStart - '
                 + str(promoter_offset)
                 + ") <= "
                 + str(pos)
@@ -454,32 +992,12 @@ def getGenes(
                 + str(promoter_offset)
                 + ");"
             )
-
             cursor.execute(sql)
             rows = cursor.fetchall()
             info = []
-
             if len(rows) > 0:
                 cnt = 1
                 for row in rows:
-                    # count location
-                    positionType = str(
-                        u.parse_field(info_field, "positionType", ";", "=")
-                    )
-
-                    if positionType == "intron":
-                        intronic_count = intronic_count + 1
-                    elif positionType == "non_coding_intron":
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif positionType == "CDS":
-                        cds_count = cds_count + 1
-                    elif positionType == "non_coding_exon":
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif positionType == "utr5":
-                        utr5_count = utr5_count + 1
-                    elif positionType == "utr3":
-                        utr3_count = utr3_count + 1
-
                     txtStart = int(row[4])
                     txtEnd = int(row[5])
                     cdsStart = int(row[6])
@@ -511,9 +1029,15 @@ def getGenes(
                                     + "/"
                                     + str(exonCount)
                                 )
+                                non_coding_exonic_count = non_coding_exonic_count + 1
                         if len(exons) > 0:
-                            region = ";".join(exons)
-                    elif u.isBetween(pos, cdsStart, cdsEnd):
+                            region = "positionType=non_coding_exon;" + ";".join(exons)
+                        else:
+                            non_coding_intronic_count = non_coding_intronic_count + 1
+                            region = "positionType=non_coding_intron"
+
+                    elif u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd):
+                        cds_count = cds_count + 1
                         for e in range(0, exonCount):
                             if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
                                 exnum = e + 1
@@ -524,255 +1048,24 @@ def getGenes(
                                 )
                                 exonic_count = exonic_count + 1
                         if len(exons) > 0:
-                            region = ";".join(exons)
-
-                    elif u.isBetween(pos, promoter_plus, txtStart) and (strand == "+"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name from "
-                            + 'cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+                            region = "positionType=CDS;" + ";".join(exons)
+                        else:
+                            intronic_count = intronic_count + 1
+                            region = "positionType=CDS;" + "intron"
 
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
+                    elif (
+                        u.isBetween(pos, txtStart, cdsStart)
+                        and (cdsStart < cdsEnd)
+                        and (strand == "+")
+                    ):
+                        utr5_count = utr5_count + 1
+                        region = "positionType=utr5"
 
-                    elif u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name from "
-                            + 'cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ""
-
-                    if region != "":
-                        info.append(
-                            collapseGeneNames(
-                                row=row,
-                                indices=indicesKnownGenes,
-                                region=region,
-                                cnt=cnt,
-                            )
-                        )
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ";" + str_info
-                fh_out.write("\t".join(fields) + "\n")
-
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write("\t".join(fields) + "\n")
-                interGenic_count = interGenic_count + 1
-
-            linenum = linenum + 1
-
-        else:
-            fh_out.write(line + "\n")
-
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
-
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
-
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
-
-    print(f"In '3 UTR {str(utr3_count)}")
-    fh_log.write(f"In '3 UTR {str(utr3_count)}\n")
-
-    print(f"In '5 UTR {str(utr5_count)}")
-    fh_log.write(f"In '5 UTR {str(utr5_count)}\n")
-
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
-
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
-
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
-
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
-
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
-
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
-
-
-"""Method used in INDELS, where bigRefGeneTable is not applicable
-"""
-
-
-def getExonsEtAl(
-    vcf,
-    format="vcf",
-    table="refGene",
-    promoter_offset=500,
-    tmpextin=".2",
-    tmpextout=".3",
-    sep="\t",
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, "name", ";", "="))
-
-            sql = (
-                "select * from "
-                + table
-                + ' where chrom="'
-                + str(chr)
-                + '"   AND (txStart - '
-                + str(promoter_offset)
-                + ") <= "
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= (txEnd + "
-                + str(promoter_offset)
-                + ");"
-            )
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if len(rows) > 0:
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts = str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(",")
-                    exonsEn = exonEnds.split(",")
-
-                    if cdsStart == cdsEnd:
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "non_coding_exon="
-                                    + "ex"
-                                    + str(exnum)
-                                    + "/"
-                                    + str(exonCount)
-                                )
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if len(exons) > 0:
-                            region = "positionType=non_coding_exon;" + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = "positionType=non_coding_intron"
-
-                    elif u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "exon=" + "ex" + str(exnum) + "/" + str(exonCount)
-                                )
-                                exonic_count = exonic_count + 1
-                        if len(exons) > 0:
-                            region = "positionType=CDS;" + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = "positionType=CDS;" + "intron"
-
-                    elif (
-                        u.isBetween(pos, txtStart, cdsStart)
-                        and (cdsStart < cdsEnd)
-                        and (strand == "+")
-                    ):
-                        utr5_count = utr5_count + 1
-                        region = "positionType=utr5"
-
-                    elif u.isBetween(pos, cdsEnd, txtEnd) and (cdsStart < cdsEnd)(
-                        strand == "+"
-                    ):
-                        utr3_count = utr3_count + 1
-                        region = "positionType=utr3"
+                    elif u.isBetween(pos, cdsEnd, txtEnd) and (cdsStart < cdsEnd)(
+                        strand == "+"
+                    ):
+                        utr3_count = utr3_count + 1
+                        region = "positionType=utr3"
 
                     elif u.isBetween(pos, cdsEnd, txtEnd) and (cdsStart < cdsEnd)(
                         strand == "-"
@@ -789,18 +1082,7 @@ def getExonsEtAl(
                         region = "positionType=utr3"
 
                     elif u.isBetween(pos, promoter_plus, txtStart) and (strand == "+"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name "
-                            + 'from cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+                        rows = getCpgIsland(cursor, chr, pos, cpgIndex)
 
                         if rows is not None:
                             region = "putativePromoterRegion=" + "".join(
@@ -809,18 +1091,7 @@ def getExonsEtAl(
                             promoter_count = promoter_count + 1
 
                     elif u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name "
-                            + 'from cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+                        rows = getCpgIsland(cursor, chr, pos, cpgIndex)
 
                         if rows is not None:
                             region = "putativePromoterRegion=" + "".join(
@@ -890,140 +1161,103 @@ def getExonsEtAl(
     fh_out.close()
     fh_log.close()
     fh.close()
-    conn.close()
+    pool.release(conn)
 
 
 """Overlap with tfbsConsSites
 """
 
+allowed_chrom = [
+    "1",
+    "2",
+    "3",
+    "4",
+    "5",
+    "6",
+    "7",
+    "8",
+    "9",
+    "10",
+    "11",
+    "12",
+    "13",
+    "14",
+    "15",
+    "16",
+    "17",
+    "18",
+    "19",
+    "20",
+    "21",
+    "22",
+    "X",
+    "Y",
+]
+
 
 def addOverlapWithTfbsConsSites(
-    vcf, format="vcf", table="tfbsConsSites", tmpextin=".2", tmpextout=".3", sep="\t"
+    vcf,
+    format="vcf",
+    table="tfbsConsSites",
+    tmpextin=".2",
+    tmpextout=".3",
+    sep="\t",
+    index=None,
 ):
 
-    allowed_chrom = [
-        "1",
-        "2",
-        "3",
-        "4",
-        "5",
-        "6",
-        "7",
-        "8",
-        "9",
-        "10",
-        "11",
-        "12",
-        "13",
-        "14",
-        "15",
-        "16",
-        "17",
-        "18",
-        "19",
-        "20",
-        "21",
-        "22",
-        "X",
-        "Y",
-    ]
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if line.startswith("##"):
-            fh_out.write(line + "\n")
-
-        # header line
-        elif line.startswith("#CHROM") or line.startswith("CHROM"):
-            fh_out.write(line + "\n")
-
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex = chr.replace("chr", "")
-
-            if chrIndex in allowed_chrom:
-                isOverlap = False
-                sql = (
-                    "select chrom, chromStart, chromEnd, name "
-                    + "from tfbsConsSites"
-                    + chrIndex
-                    + " where  chromStart <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd;"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = (
-                            str(row[3])
-                            + "."
-                            + str(row[0])
-                            + "."
-                            + str(row[1])
-                            + "."
-                            + str(row[2])
-                        )
-                        t = t.strip()
-                        records.append("tfbsRegion" + "=" + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-
-                    fh_out.write("\t".join(fields) + "\n")
+    runStage(
+        vcf,
+        lookupTfbsConsSites,
+        log=logOverlap,
+        label=table,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+        table=table,
+        index=index,
+    )
 
-                else:  # chrom is not on the list
-                    fh_out.write(line + "\n")
 
-            else:  # chrom is not on the list
-                fh_out.write(line + "\n")
+def lookupTfbsConsSites(
+    fields, cursor, counts, inds, table="tfbsConsSites", index=None
+):
+    chr = fields[inds[0]].strip()
+    # For some reason this table has no "chr" preceeding number
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
 
-        linenum = linenum + 1
+    pos = fields[inds[1]].strip()
+    chrIndex = chr.replace("chr", "")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+    if chrIndex not in allowed_chrom:
+        return None
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    if index is not None:
+        rows = index.overlapping(chr, pos)
+    else:
+        rows = rb.for_table("tfbsConsSites" + chrIndex, cursor).overlap(
+            "tfbsConsSites" + chrIndex,
+            None,
+            None,
+            "chromStart",
+            "chromEnd",
+            int(pos),
+            columns=["chrom", "chromStart", "chromEnd", "name"],
+        )
+
+    if len(rows) == 0:
+        return None
+
+    counts["line_count"] += 1
+    records = []
+    for row in rows:
+        counts["var_count"] += 1
+        t = str(row[3]) + "." + str(row[0]) + "." + str(row[1]) + "." + str(row[2])
+        t = t.strip()
+        records.append("tfbsRegion" + "=" + t)
+
+    return ";".join(records)
 
 
 """Overlap with GadAll table
@@ -1031,367 +1265,251 @@ def addOverlapWithTfbsConsSites(
 
 
 def addOverlapWithGadAll(
-    vcf, format="vcf", table="gadAll", tmpextin="", tmpextout=".1", sep="\t"
+    vcf, format="vcf", table="gadAll", tmpextin="", tmpextout=".1", sep="\t", index=None
 ):
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+    runStage(
+        vcf,
+        lookupGadAll,
+        apply=applyGadAll,
+        log=logOverlap,
+        label=table,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+        table=table,
+        index=index,
+    )
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
+def lookupGadAll(fields, cursor, counts, inds, table="gadAll", index=None):
+    chr = fields[inds[0]].strip()
+    # For some reason this table has no "chr" preceeding number
+    if chr.startswith("chr"):
+        chr = str(chr).replace("chr", "")
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    pos = fields[inds[1]].strip()
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
+    if index is not None:
+        rows = index.overlapping(chr, pos)
+    else:
+        rows = rb.for_table(table, cursor).overlap(
+            table, "chromosome", chr, "chromStart", "chromEnd", int(pos)
+        )
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
+    if len(rows) == 0:
+        return None
 
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chromosome="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+    counts["line_count"] += 1
+    records = []
+    r_tmp = []
+    for row in rows:
+        counts["var_count"] += 1
+        if not fu.isOnTheList(r_tmp, str(row[3])):
+            r_tmp.append(str(row[3]))
+            records.append(str(table) + "=" + str(row[3]))
 
-                if len(rows) > 0:
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]))
-                            records.append(str(table) + "=" + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-                    fh_out.write("\t ".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
+    return ";".join(records)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+def applyGadAll(fields, annotation):
+    if annotation is None:
+        return fields
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    fields = appendInfo(fields, annotation)
+    # Matching lines have always been written out joined with "\t ";
+    # keep the padded columns so later stages see the same input
+    return fields[:1] + [" " + str(x) for x in fields[1:]]
 
 
 """ Overlap with gwasCatalog table """
 
 
 def addOverlapWithGwasCatalog(
-    vcf, format="vcf", table="gwasCatalog", tmpextin="", tmpextout=".1", sep="\t"
+    vcf,
+    format="vcf",
+    table="gwasCatalog",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    index=None,
 ):
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND chromEnd = '
-                    + str(pos)
-                    + ";"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+    runStage(
+        vcf,
+        lookupGwasCatalog,
+        log=logOverlap,
+        label=table,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+        table=table,
+        index=index,
+    )
 
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(
-                            str(table)
-                            + "="
-                            + str("pubMedID")
-                            + "="
-                            + str(row[5])
-                            + ",trait="
-                            + str(row[10])
-                        )
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-                    fh_out.write("\t".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+def lookupGwasCatalog(fields, cursor, counts, inds, table="gwasCatalog", index=None):
+    chr = fields[inds[0]].strip()
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+    pos = fields[inds[1]].strip()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    if index is not None:
+        rows = index.overlapping(chr, pos)
+    else:
+        rows = rb.for_table(table, cursor).point(
+            table, "chrom", chr, "chromEnd", int(pos)
+        )
+
+    if len(rows) == 0:
+        return None
+
+    counts["line_count"] += 1
+    records = []
+    for row in rows:
+        counts["var_count"] += 1
+        records.append(
+            str(table)
+            + "="
+            + str("pubMedID")
+            + "="
+            + str(row[5])
+            + ",trait="
+            + str(row[10])
+        )
+
+    return ";".join(records)
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
 
-
-def addOverlapWitHUGOGeneNomenclature(
-    vcf, format="vcf", table="hugo", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + "," + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append("HGNC_GeneAnnotation" + "=" + t)
-                        records_count = records_count + 1
-
-                    records_str = ",".join(records).replace(";", ",")
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + records_str
-                    else:
-                        fields[7] = fields[7] + ";" + records_str
-                    fh_out.write("\t".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
-
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+
+def addOverlapWitHUGOGeneNomenclature(
+    vcf, format="vcf", table="hugo", tmpextin="", tmpextout=".1", sep="\t", index=None
+):
+
+    runStage(
+        vcf,
+        lookupHugo,
+        log=logOverlap,
+        label=table,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+        table=table,
+        index=index,
     )
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
 
+def lookupHugo(fields, cursor, counts, inds, table="hugo", index=None):
+    chr = fields[inds[0]].strip()
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
 
-"""Overlap with segdup regions genomicSuperDups
-"""
+    pos = fields[inds[1]].strip()
 
+    if index is not None:
+        rows = index.overlapping(chr, pos)
+    else:
+        rows = rb.for_table(table, cursor).overlap(
+            table, "chrom", chr, "chromStart", "chromEnd", int(pos)
+        )
 
-def addOverlapWithGenomicSuperDups(
-    vcf, format="vcf", table="genomicSuperDups", tmpextin="", tmpextout=".1", sep="\t"
-):
+    if len(rows) == 0:
+        return None
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+    counts["line_count"] += 1
+    records = []
+    r_tmp = []
+    for row in rows:
+        counts["var_count"] += 1
+        t = str(str(row[5]) + "," + str(row[6])).strip()
+        if not fu.isOnTheList(r_tmp, t):
+            r_tmp.append(t)
+            records.append("HGNC_GeneAnnotation" + "=" + t)
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    return ",".join(records).replace(";", ",")
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+"""Overlap with segdup regions genomicSuperDups
+"""
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ""
-                otherStart = ""
-                otherEnd = ""
-                l = str(isOverlap)
+def addOverlapWithGenomicSuperDups(
+    vcf,
+    format="vcf",
+    table="genomicSuperDups",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    index=None,
+):
 
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+    runStage(
+        vcf,
+        lookupGenomicSuperDups,
+        apply=applyGenomicSuperDups,
+        log=logOverlap,
+        label=table,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+        table=table,
+        index=index,
+    )
 
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = (
-                        fields[7]
-                        + ";"
-                        + str(table)
-                        + "="
-                        + str(isOverlap)
-                        + ";"
-                        + "otherChrom="
-                        + str(otherChrom)
-                        + ";otherStart="
-                        + str(otherStart)
-                        + ";otherEnd="
-                        + str(otherEnd)
-                    )
 
-                fh_out.write("\t".join(fields) + "\n")
+def lookupGenomicSuperDups(
+    fields, cursor, counts, inds, table="genomicSuperDups", index=None
+):
+    chr = fields[inds[0]].strip()
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+    pos = fields[inds[1]].strip()
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+    if index is not None:
+        rows = index.first(chr, pos)
+    else:
+        hits = rb.for_table(table, cursor).overlap(
+            table, "chrom", chr, "chromStart", "chromEnd", int(pos)
+        )
+        rows = hits[0] if len(hits) > 0 else None
+
+    if rows is None:
+        return None
+
+    counts["line_count"] += 1
+    counts["var_count"] += 1
+    isOverlap = True
+    otherChrom = rows[7]
+    otherStart = rows[8]
+    otherEnd = rows[9]
+    return (
+        str(table)
+        + "="
+        + str(isOverlap)
+        + ";"
+        + "otherChrom="
+        + str(otherChrom)
+        + ";otherStart="
+        + str(otherStart)
+        + ";otherEnd="
+        + str(otherEnd)
     )
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+
+def applyGenomicSuperDups(fields, annotation):
+    # Always separated with ';', even when INFO already ends with one
+    if annotation is not None:
+        fields[7] = fields[7] + ";" + annotation
+    return fields
 
 
 """Searches Genes Databases and returns Genes/Cytobands 
@@ -1421,7 +1539,8 @@ def addOverlapWithRefGene(
     endName = "txEnd"
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
+    pool = dbp.get_pool()
+    conn = pool.acquire()
     cursor = conn.cursor()
     linenum = 1
 
@@ -1490,7 +1609,7 @@ def addOverlapWithRefGene(
     )
     fh_log.close()
 
-    conn.close()
+    pool.release(conn)
     fh.close()
     fh_out.close()
 
@@ -1500,19 +1619,30 @@ def addOverlapWithRefGene(
 
 
 def addOverlapWithCytoband(
-    vcf, format="vcf", table="cytoBand", tmpextin="", tmpextout=".1", sep="\t"
+    vcf,
+    format="vcf",
+    table="cytoBand",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    index=None,
 ):
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    runStage(
+        vcf,
+        lookupCytoband,
+        log=logOverlap,
+        label=table,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+        table=table,
+        index=index,
+    )
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
+
+def lookupCytoband(fields, cursor, counts, inds, table="cytoBand", index=None):
     colindex = 12
     startName = "txStart"
     endName = "txEnd"
@@ -1522,72 +1652,31 @@ def addOverlapWithCytoband(
         startName = "chromStart"
         endName = "chromEnd"
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND ('
-                    + startName
-                    + " <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= "
-                    + endName
-                    + ");"
-                )
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+    chr = fields[inds[0]].strip()
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
 
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ";".join([str(x) for x in overlapsWith])
+    pos = fields[inds[1]].strip()
 
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + "=" + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ";" + str(table) + "=" + str(cytoband)
-                fh_out.write("\t".join(fields) + "\n")
+    if index is not None:
+        rows = index.overlapping(chr, pos)
+    else:
+        rows = rb.for_table(table, cursor).overlap(
+            table, "chrom", chr, startName, endName, int(pos)
+        )
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+    if len(rows) == 0:
+        return None
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+    counts["line_count"] += 1
+    overlapsWith = []
+    for row in rows:
+        counts["var_count"] += 1
+        overlapsWith.append(str(row[colindex]))
+    overlapsWith = u.dedup(overlapsWith)
+    cytoband = ";".join([str(x) for x in overlapsWith])
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    return str(table) + "=" + str(cytoband)
 
 
 """Method to find overlap with CNV tables
@@ -1595,77 +1684,50 @@ def addOverlapWithCytoband(
 
 
 def addOverlapWithCnvDatabase(
-    vcf, format="vcf", table="dgv_Cnv", tmpextin="", tmpextout=".1", sep="\t"
+    vcf,
+    format="vcf",
+    table="dgv_Cnv",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    index=None,
 ):
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+    runStage(
+        vcf,
+        lookupCnvDatabase,
+        log=logOverlap,
+        label=table,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+        table=table,
+        index=index,
+    )
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
 
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + "=" + str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ";" + str(table) + "=" + str(isOverlap)
-                fh_out.write("\t".join(fields) + "\n")
+def lookupCnvDatabase(fields, cursor, counts, inds, table="dgv_Cnv", index=None):
+    chr = fields[inds[0]].strip()
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+    pos = fields[inds[1]].strip()
+    if index is not None:
+        rows = index.first(chr, pos)
+    else:
+        hits = rb.for_table(table, cursor).overlap(
+            table, "chrom", chr, "chromStart", "chromEnd", int(pos)
+        )
+        rows = hits[0] if len(hits) > 0 else None
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+    if rows is None:
+        return None
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    counts["line_count"] += 1
+    counts["var_count"] += 1
+    isOverlap = True
+    return str(table) + "=" + str(isOverlap)
 
 
 """Method to find overlap with targetScanS tables
@@ -1673,85 +1735,50 @@ def addOverlapWithCnvDatabase(
 
 
 def addOverlapWithMiRNA(
-    vcf, format="vcf", table="targetScanS", tmpextin="", tmpextout=".1", sep="\t"
+    vcf,
+    format="vcf",
+    table="targetScanS",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    index=None,
 ):
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = (
-                        str(rows[4])
-                        + ","
-                        + str(rows[1])
-                        + "_"
-                        + str(rows[2])
-                        + "_"
-                        + str(rows[3])
-                    )
-                    t = "miRNAsites=" + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ";" + t
-                fh_out.write("\t".join(fields) + "\n")
+    runStage(
+        vcf,
+        lookupMiRNA,
+        log=logOverlap,
+        label="miRNAsites",
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+        table=table,
+        index=index,
+    )
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In miRNAsites: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+def lookupMiRNA(fields, cursor, counts, inds, table="targetScanS", index=None):
+    chr = fields[inds[0]].strip()
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    pos = fields[inds[1]].strip()
+    if index is not None:
+        rows = index.first(chr, pos)
+    else:
+        hits = rb.for_table(table, cursor).overlap(
+            table, "chrom", chr, "chromStart", "chromEnd", int(pos)
+        )
+        rows = hits[0] if len(hits) > 0 else None
+
+    if rows is None:
+        return None
+
+    counts["line_count"] += 1
+    counts["var_count"] += 1
+    t = str(rows[4]) + "," + str(rows[1]) + "_" + str(rows[2]) + "_" + str(rows[3])
+    return "miRNAsites=" + t.strip()
 
 
 ### EOF
@@ -0,0 +1,126 @@
+# annotation_cache.py
+#
+# Cross-job cache of per-variant stage annotations
+#
+# Each entry holds what one stage's lookup returned for one variant,
+# together with the counters that lookup bumped, so a cached variant is
+# annotated and counted exactly as if it had been looked up. Entries are
+# keyed by (reference fingerprint, stage, chrom, pos, ref, alt) and kept
+# in a local SQLite file shared by all annotator processes on the host.
+# The cache is bounded (least recently used entries are evicted beyond
+# max_entries, and entries expire after ttl seconds) and is emptied when
+# the fingerprint of the reference data changes (see
+# driver.reference_fingerprint: the release and where the tables are
+# read from).
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import json
+import time
+import sqlite3
+import threading
+
+SCHEMA = [
+    "create table if not exists entries "
+    + "(key text primary key, value text, created real, used real)",
+    "create index if not exists entries_used on entries (used)",
+    "create table if not exists meta (name text primary key, value text)",
+]
+
+"""SQLite-backed annotation cache
+
+get_many() and put_many() work on one stage and a block of keys at a
+time. Methods are thread-safe, so concurrent stages can share a cache.
+"""
+
+
+class AnnotationCache(object):
+    def __init__(self, path, fingerprint, max_entries=1000000, ttl=30 * 24 * 3600):
+        self.fingerprint = str(fingerprint)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("pragma journal_mode=wal")
+        for sql in SCHEMA:
+            self.db.execute(sql)
+        self.check_fingerprint()
+
+    # Entries of other reference data are never served
+    def check_fingerprint(self):
+        with self.lock, self.db:
+            row = self.db.execute(
+                "select value from meta where name = 'fingerprint'"
+            ).fetchone()
+            if row is None or row[0] != self.fingerprint:
+                self.db.execute("delete from entries")
+                self.db.execute(
+                    "insert or replace into meta values ('fingerprint', ?)",
+                    (self.fingerprint,),
+                )
+
+    def key(self, stage, variant):
+        return "\t".join([self.fingerprint, stage] + [str(v) for v in variant])
+
+    def get_many(self, stage, variants):
+        keys = list(set([self.key(stage, v) for v in variants]))
+        now = time.time()
+        found = {}
+        with self.lock, self.db:
+            # SQLite limits the number of host parameters per statement
+            for i in range(0, len(keys), 500):
+                chunk = keys[i : i + 500]
+                rows = self.db.execute(
+                    "select key, value, created from entries where key in ("
+                    + ",".join(["?"] * len(chunk))
+                    + ")",
+                    chunk,
+                ).fetchall()
+                for key, value, created in rows:
+                    if now - created <= self.ttl:
+                        found[key] = json.loads(value)
+            self.db.executemany(
+                "update entries set used = ? where key = ?",
+                [(now, key) for key in found],
+            )
+
+        hits = {}
+        for v in variants:
+            entry = found.get(self.key(stage, v))
+            if entry is not None:
+                hits[v] = (entry[0], entry[1])
+        return hits
+
+    def put_many(self, stage, entries):
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany(
+                "insert or replace into entries values (?, ?, ?, ?)",
+                [
+                    (self.key(stage, v), json.dumps([payload, deltas]), now, now)
+                    for v, (payload, deltas) in entries.items()
+                ],
+            )
+
+    def evict(self):
+        with self.lock, self.db:
+            self.db.execute(
+                "delete from entries where created < ?", (time.time() - self.ttl,)
+            )
+            count = self.db.execute("select count(*) from entries").fetchone()[0]
+            if count > self.max_entries:
+                self.db.execute(
+                    "delete from entries where key in "
+                    + "(select key from entries order by used limit ?)",
+                    (count - self.max_entries,),
+                )
+
+    def close(self):
+        self.evict()
+        self.db.close()
+
+
+### EOF
@@ -13,9 +13,14 @@ import json
 import os
 import sys
 import time
+import threading
 import subprocess
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from boto3.dynamodb.conditions import Key, Attr
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
+
+import aws_clients as aws
 
 # Get configuration
 from configparser import ConfigParser, ExtendedInterpolation
@@ -26,18 +31,356 @@ config = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
 config.read(os.path.join(base_dir, "annotator_config.ini"))
 
 
-"""Reads request messages from SQS and runs AnnTools as a subprocess.
+"""Number of annotation jobs to run at once: MaxJobs (0 = one per CPU),
+capped so that JobMemoryMb per job fits in the instance's memory
+"""
+def job_slots():
+    slots = config.getint('jobs', 'MaxJobs', fallback=0)
+    if slots <= 0:
+        slots = os.cpu_count() or 1
+
+    job_memory = config.getint('jobs', 'JobMemoryMb', fallback=0)
+    if job_memory > 0:
+        try:
+            memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+            slots = min(slots, memory // job_memory)
+        except (ValueError, OSError, AttributeError):
+            # No sysconf (or no such name) on this platform: CPU limit only
+            pass
+    return max(1, slots)
+
+
+"""Warm fork server: imports the pipeline and loads the in-memory
+reference tables once (driver.warm), then forks a job from itself for
+each list of run.py arguments received on 'conn'. Each job runs the
+pipeline and the run.py post-processing in the child, which already has
+the modules, configuration and tables of the server.
+
+The server is started before the supervisor runs any thread of its own
+and runs none itself, so a job never inherits a lock held by a thread
+that does not exist in the child. It sends ('ready',) once warm,
+('started', pid) for every job and ('exited', pid, code) as each exits,
+and stops when the supervisor closes its end of 'conn' (a copy of
+which, 'supervisor_conn', the fork leaves open here until closed). It is not a
+daemonic process, as jobs forked from it inherit that flag and could
+not start processes of their own (PipelineMode = parallel).
+"""
+def serve_jobs(conn, supervisor_conn=None):
+    if supervisor_conn is not None:
+        supervisor_conn.close()
+
+    import driver
+    import run
+    driver.warm()
+    conn.send(('ready',))
+
+    jobs = set()
+    while True:
+        if conn.poll(config.getfloat('jobs', 'ReapInterval', fallback=1)):
+            try:
+                ann_args = conn.recv()
+            except EOFError:
+                # The supervisor is gone
+                break
+            pid = os.fork()
+            if pid == 0:
+                conn.close()
+                code = 1
+                try:
+                    code = run.run_job(*ann_args)
+                except SystemExit as e:
+                    code = e.code if isinstance(e.code, int) else 1
+                except BaseException as e:
+                    print(f"Job failed: {e}")
+                finally:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(code)
+            jobs.add(pid)
+            conn.send(('started', pid))
+
+        for pid in list(jobs):
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done != 0:
+                jobs.discard(pid)
+                conn.send(('exited', pid, os.waitstatus_to_exitcode(status)))
+
+
+"""Runs annotation jobs as child processes, at most 'slots' at a time.
+
+A cold supervisor starts a fresh python run.py for every job. A warm
+one (WarmWorker) has each job forked by a warm fork server (serve_jobs),
+so jobs skip interpreter startup and imports and share the in-memory
+reference tables copy-on-write; every job still gets a process of its
+own, whose memory is returned when it exits. The fork server is started
+here, so the supervisor must be created before any other thread (e.g.
+the visibility heartbeat) is started.
+
+Finished children are reaped (so none is left a zombie) and their exit
+codes recorded in exit_codes, by job ID, for the most recent jobs; each
+job's SQS receipt handle is handed back with its exit code by collect().
+"""
+class JobSupervisor(object):
+    def __init__(self, slots, warm=False):
+        self.slots = slots
+        self.running = {}
+        self.finished = []
+        self.exit_codes = {}
+        # running is also read by the visibility heartbeat thread
+        self.lock = threading.Lock()
+        self.warm = warm
+        if warm:
+            context = multiprocessing.get_context('fork')
+            self.conn, server_conn = context.Pipe()
+            # Not daemonic (see serve_jobs); stopped by close()
+            self.server = context.Process(target=serve_jobs, args=(server_conn, self.conn))
+            self.server.start()
+            server_conn.close()
+            # Exit codes the fork server reported, by pid
+            self.exited = {}
+            # Raises EOFError if the server failed to warm up
+            self.conn.recv()
+
+    # Stops the fork server; jobs still running are left to finish
+    def close(self):
+        if self.warm:
+            self.conn.close()
+            self.server.join(config.getfloat('jobs', 'ReapInterval', fallback=1) + 5)
+            if self.server.is_alive():
+                self.server.terminate()
+
+    # Reads one message from the fork server
+    def receive(self):
+        message = self.conn.recv()
+        if message[0] == 'exited':
+            self.exited[message[1]] = message[2]
+        return message
+
+    def free_slots(self):
+        self.reap()
+        return self.slots - len(self.running)
+
+    def launch(self, job_id, args, receipt_handle=None):
+        if self.warm:
+            self.conn.send(args)
+            message = self.receive()
+            while message[0] != 'started':
+                message = self.receive()
+            pid = message[1]
+            process = None
+        else:
+            process = subprocess.Popen(['python', 'run.py'] + args, cwd=base_dir)
+            pid = process.pid
+        with self.lock:
+            self.running[pid] = (job_id, process, time.time(), receipt_handle)
+
+    # Receipt handles of the messages of the running jobs
+    def receipt_handles(self):
+        with self.lock:
+            return [job[3] for job in self.running.values() if job[3] is not None]
+
+    # Collects the children that have exited, for collect()
+    def reap(self):
+        if self.warm:
+            while self.conn.poll():
+                self.receive()
+        for pid, (job_id, process, started, receipt_handle) in list(self.running.items()):
+            if self.warm:
+                code = self.exited.pop(pid, None)
+            else:
+                code = process.poll()
+            if code is None:
+                continue
+            with self.lock:
+                del self.running[pid]
+            self.exit_codes[job_id] = code
+            if len(self.exit_codes) > 1000:
+                del self.exit_codes[next(iter(self.exit_codes))]
+            self.finished.append((job_id, code, receipt_handle))
+            print(f"Job {job_id} exited with code {code} after {time.time() - started:.1f} seconds")
+
+    # Jobs finished since the last call: [(job_id, exit code, receipt handle)]
+    def collect(self):
+        self.reap()
+        finished = self.finished
+        self.finished = []
+        return finished
+
+    # Blocks while every slot is taken
+    def wait_for_slot(self):
+        while self.free_slots() <= 0:
+            time.sleep(config.getfloat('jobs', 'ReapInterval', fallback=1))
+
+
+"""Receipt handles of processed messages, deleted from the queue in
+batches of up to 10 (the delete_message_batch limit) when flushed
+"""
+class Acknowledger(object):
+    def __init__(self):
+        self.handles = []
+
+    def add(self, receipt_handle):
+        self.handles.append(receipt_handle)
+
+    def flush(self, sqs):
+        #ref doc: https://docs.aws.amazon.com/AWSSimpleQueueService/latest/APIReference/API_DeleteMessageBatch.html
+        while len(self.handles) > 0:
+            batch = self.handles[:10]
+            self.handles = self.handles[10:]
+            try:
+                response = sqs.delete_message_batch(
+                    QueueUrl=config['sqs']['RequestQueueUrl'],
+                    Entries=[{'Id': str(i), 'ReceiptHandle': handle} for i, handle in enumerate(batch)]
+                )
+            except ClientError as e:
+                # Keep them for the next flush
+                print(f"Failed to delete messages: {e.response['Error']['Message']}")
+                self.handles = batch + self.handles
+                return
+            for failed in response.get('Failed', []):
+                print(f"Failed to delete message: {failed.get('Message')}")
+
+
+"""Keeps the messages of running jobs invisible on the queue.
+
+Every HeartbeatInterval seconds the visibility timeout of each running
+job's message is set again to VisibilityTimeout seconds, so a job that
+runs longer than that is not delivered, and annotated, a second time.
+Once the job exits the heartbeat stops and the message is deleted
+(see handle_requests_queue).
+"""
+class VisibilityHeartbeat(object):
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+        self.interval = config.getint('sqs', 'HeartbeatInterval', fallback=60)
+        self.timeout = config.getint('sqs', 'VisibilityTimeout', fallback=300)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.beat()
+
+    def beat(self):
+        #ref doc: https://docs.aws.amazon.com/AWSSimpleQueueService/latest/APIReference/API_ChangeMessageVisibilityBatch.html
+        sqs = aws.client('sqs')
+        handles = self.supervisor.receipt_handles()
+        for i in range(0, len(handles), 10):
+            try:
+                response = sqs.change_message_visibility_batch(
+                    QueueUrl=config['sqs']['RequestQueueUrl'],
+                    Entries=[{'Id': str(k), 'ReceiptHandle': handle, 'VisibilityTimeout': self.timeout}
+                        for k, handle in enumerate(handles[i:i + 10])]
+                )
+            except ClientError as e:
+                print(f"Failed to extend message visibility: {e.response['Error']['Message']}")
+                continue
+            for failed in response.get('Failed', []):
+                print(f"Failed to extend message visibility: {failed.get('Message')}")
+
+
+"""Moves jobs from PENDING to RUNNING, one conditional update_item per
+job, all issued at once; returns the IDs of the jobs that moved, and of
+those that could not because they are no longer PENDING (e.g. a
+duplicate delivery of a job that is running or done).
 
-Move existing annotator code here
+Not a single TransactWriteItems: a transaction fails as a whole when any
+condition fails, and a job that is no longer PENDING must not hold back
+the others.
 """
+def claim_jobs(job_ids):
+    if len(job_ids) == 0:
+        return set(), set()
+
+    # The low-level client is thread-safe and shared (aws_clients.py)
+    dynamodb = aws.client('dynamodb')
 
+    def claim(job_id):
+        try:
+            dynamodb.update_item(
+                TableName=config['gas']['AnnotationsTable'],
+                Key={'job_id': {'S': job_id}},
+                UpdateExpression='SET job_status = :val',
+                ConditionExpression='job_status = :status',
+                ExpressionAttributeValues={':val': {'S': 'RUNNING'}, ':status': {'S': 'PENDING'}}
+            )
+            return job_id, 'claimed'
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                print(f"Job {job_id} is not PENDING; not running it again")
+                return job_id, 'rejected'
+            print(f"Failed to update status of job {job_id}: {e}")
+        except BotoCoreError as e:
+            print('DynamoDB error:', e)
+        return job_id, None
 
-def handle_requests_queue(sqs=None):
+    with ThreadPoolExecutor(max_workers=len(job_ids)) as executor:
+        results = list(executor.map(claim, job_ids))
+    claimed = set([job_id for job_id, result in results if result == 'claimed'])
+    rejected = set([job_id for job_id, result in results if result == 'rejected'])
+    return claimed, rejected
 
-    # Read messages from the queue
-    sqs = boto3.client('sqs', region_name=config['aws']['AwsRegionName'])
 
-    s3_rsc = boto3.resource('s3', region_name = config['aws']['AwsRegionName'],config = botocore.client.Config(signature_version=config['aws']['SignatureVersion']))
+"""Moves a job whose process failed from RUNNING to FAILED, so it is
+neither left RUNNING nor run again; returns False if the update failed
+"""
+def fail_job(job_id):
+    try:
+        aws.client('dynamodb').update_item(
+            TableName=config['gas']['AnnotationsTable'],
+            Key={'job_id': {'S': job_id}},
+            UpdateExpression='SET job_status = :val',
+            ConditionExpression='job_status = :status',
+            ExpressionAttributeValues={':val': {'S': 'FAILED'}, ':status': {'S': 'RUNNING'}}
+        )
+        return True
+    except ClientError as e:
+        # ConditionalCheckFailedException: the job already left RUNNING
+        # (e.g. it was marked COMPLETED before the process failed)
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return True
+        print(f"Failed to mark job {job_id} FAILED: {e}")
+    except BotoCoreError as e:
+        print('DynamoDB error:', e)
+    return False
+
+
+"""Reads request messages from SQS and runs AnnTools in a child process.
+
+Only as many messages are received as the supervisor has free slots, so
+messages beyond that stay on the queue for this or another instance.
+The jobs received together have their status set together (claim_jobs).
+A message is deleted (acknowledged) once its job has exited, after a
+failed job has been marked FAILED; until then the heartbeat keeps it
+from being redelivered. The message of a job that is no longer PENDING
+is deleted without running it, as is a message that cannot be parsed.
+A job's input is downloaded only once the job has been claimed, and a
+job whose input cannot be downloaded is marked FAILED. Acknowledgements
+are deleted in batches.
+"""
+
+
+def handle_requests_queue(supervisor, acks):
+
+    # Wait for a job slot before taking more work off the queue
+    supervisor.wait_for_slot()
+
+    # Read messages from the queue (clients are built once per process)
+    sqs = aws.client('sqs')
+
+    # Acknowledge the jobs that exited since the last poll; a failed job
+    # is marked FAILED first. If that update fails its message is left
+    # to reappear, and is deleted then as the job is no longer PENDING
+    for job_id, code, receipt_handle in supervisor.collect():
+        if code == 0:
+            acks.add(receipt_handle)
+        elif fail_job(job_id):
+            print(f"Job {job_id} failed; marked FAILED")
+            acks.add(receipt_handle)
+    acks.flush(sqs)
 
 
     # Receive message from SQS 
@@ -48,35 +391,43 @@ def handle_requests_queue(sqs=None):
     try:
         messages = sqs.receive_message(
             QueueUrl = config['sqs']['RequestQueueUrl'],
-            MaxNumberOfMessages = int(config['sqs']['MaxMessages']),
+            MaxNumberOfMessages = min(int(config['sqs']['MaxMessages']), supervisor.free_slots()),
+            VisibilityTimeout = int(config['sqs']['VisibilityTimeout']),
             WaitTimeSeconds =int(config['sqs']['WaitTime'])) 
     except ClientError as e:
         print(f"Failed to receive messages: {e.response['Error']['Message']}")
+        return
     
 
     # Process messages received
     #ref doc: https://docs.aws.amazon.com/AWSSimpleQueueService/latest/SQSDeveloperGuide/confirm-queue-is-empty.html
     # Use long polling - DO NOT use sleep() to wait between polls
+    jobs = []
     if 'Messages' in messages:
         for message in messages['Messages']:
+            # A message that cannot be used is deleted, as it would only
+            # be delivered again; the others received with it still run
             try:
                 # load the message of json format
                 sns_data = json.loads(message['Body'])
                 job_data = json.loads(sns_data['Message'])
-            except KeyError:
-                return
 
-            # extract job parameters from the message body as before
-            job_id = job_data["job_id"] #uuid
-            user_id = job_data["user_id"] #userX
-            file_name = job_data["input_file_name"] #filename
-            bucket_name = job_data["s3_input_bucket"]
-            s3_key = job_data["s3_key_input_file"] #CNetID/userX/uuid~filename
+                # extract job parameters from the message body as before
+                job_id = job_data["job_id"] #uuid
+                user_id = job_data["user_id"] #userX
+                file_name = job_data["input_file_name"] #filename
+                bucket_name = job_data["s3_input_bucket"]
+                s3_key = job_data["s3_key_input_file"] #CNetID/userX/uuid~filename
+            except (KeyError, ValueError, TypeError) as e:
+                print(f"Malformed request message: {e}")
+                acks.add(message['ReceiptHandle'])
+                continue
             job_name = job_id + '~' + file_name
 
             if not job_id or not bucket_name or not user_id or not file_name or not s3_key:
                 print (f"Missing required data in request")
-                return 
+                acks.add(message['ReceiptHandle'])
+                continue
 
             
 
@@ -88,80 +439,74 @@ def handle_requests_queue(sqs=None):
             except OSError as e:
                 # ref of handling system error: https://www.geeksforgeeks.org/handling-oserror-exception-in-python/
                 print(f"Make jobs folder failed: {e}")
-                return
-
-            # Get the input file S3 object and copy it to a local file
-            # ref of download data from s3: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/download_file.html
-            try:
-                s3_rsc.meta.client.download_file(bucket_name, s3_key, '{}'.format(job_name))
-            except ClientError as e:
-                print(f"Failed to download input file from S3: {e}")
-                return
-                
-            if os.path.exists('./{}'.format(job_name)):  
-                try:
-                    os.system('mv ./{} {}'.format(job_name, jobs_dir)) 
-                except OSError as e:
-                    print(f"Move file failed:{e}")
-                    return
-            else:
-                print("Move file failed. File does not exists")
-                return
+                continue
 
             local_file_abs_dir = '{}/{}'.format(jobs_dir, job_name)
             s3_jobs_dir = '/'.join(s3_key.split('/')[0:2])
-                
-                
-            
-            # Launch annotation job as a background process
-            # ref doc of subprocess: https://docs.python.org/3/library/subprocess.html
-            # Run the AnnTools command
-            ann_process = subprocess.Popen(['sh', '-c', 'cd {} && python run.py {} {}'.format(base_dir, local_file_abs_dir, s3_jobs_dir)])
+            jobs.append((job_id, bucket_name, s3_key, local_file_abs_dir, s3_jobs_dir, message['ReceiptHandle']))
 
-            try:
-                dynamodb = boto3.resource("dynamodb",region_name=config['aws']['AwsRegionName'] )
-                table = dynamodb.Table(config['gas']['AnnotationsTable'])
-                # Update job status in DynamoDB conditionally
-            except ClientError as e:
-                print (f"Failed connecting to database: {e}")
-                return
+    # Update job status in DynamoDB conditionally, for all the jobs at
+    # once; a job that did not move from PENDING to RUNNING is not run,
+    # and its message is deleted if the job is no longer PENDING (any
+    # other failure leaves the message to reappear and be tried again).
+    # Inputs are fetched only for the jobs claimed, so nothing is
+    # downloaded for a job that is not run
+    claimed, rejected = claim_jobs([job[0] for job in jobs])
 
+    # With StreamInput the pipeline reads the S3 object itself
+    # (see s3_stream.py) and no local copy is made; run.py still
+    # names its outputs after the local path
+    stream_input = config.getboolean('s3', 'StreamInput', fallback=False)
+
+    for job_id, bucket_name, s3_key, local_file_abs_dir, s3_jobs_dir, receipt_handle in jobs:
+        if job_id in rejected:
+            acks.add(receipt_handle)
+        if job_id not in claimed:
+            continue
+
+        # Get the input file S3 object and copy it to a local file; a
+        # job whose input cannot be fetched is marked FAILED, as it is
+        # RUNNING now and would not be run again
+        # ref of download data from s3: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/download_file.html
+        if not stream_input:
             try:
-                response = table.update_item(
-                    Key={'job_id': job_id},
-                    UpdateExpression='SET job_status = :val',
-                    ConditionExpression='job_status = :status',
-                    ExpressionAttributeValues={':val': 'RUNNING',':status': 'PENDING'},
-                    ReturnValues="UPDATED_NEW"
-                )
-            except BotoCoreError as e:
-                # Handle the specific DynamoDB error (e.g., ConditionalCheckFailedException)
-                print('DynamoDB error:', e)
-                return 
-            except ClientError as e:
-                print (f"Failed connecting to database: {e}")
-                return 
-            try:
-                # Delete messages
-                #ref doc: https://docs.aws.amazon.com/AWSSimpleQueueService/latest/SQSDeveloperGuide/step-receive-delete-message.html
-                # Delete the message from the queue after processing
-                receipt_handle = message['ReceiptHandle']
-                sqs.delete_message(
-                    QueueUrl=config['sqs']['RequestQueueUrl'],
-                    ReceiptHandle=receipt_handle
-                )
+                aws.client('s3').download_file(bucket_name, s3_key, local_file_abs_dir)
             except ClientError as e:
-                print(f"Failed to delete message: {e.response['Error']['Message']}")
-                return 
+                print(f"Failed to download input file from S3: {e}")
+                if fail_job(job_id):
+                    acks.add(receipt_handle)
+                continue
+
+        ann_args = [local_file_abs_dir, s3_jobs_dir]
+        if stream_input:
+            ann_args.append('s3://{}/{}'.format(bucket_name, s3_key))
+
+        # Launch annotation job as a background process
+        # ref doc of subprocess: https://docs.python.org/3/library/subprocess.html
+        # Run the AnnTools command; the message is deleted when the job
+        # has succeeded (see above)
+        #ref doc: https://docs.aws.amazon.com/AWSSimpleQueueService/latest/SQSDeveloperGuide/step-receive-delete-message.html
+        supervisor.launch(job_id, ann_args, receipt_handle)
+
+    # Delete the messages of the jobs not run now, not after a slot frees
+    acks.flush(sqs)
 
 
 def main():
 
-    # Get handles to queue
+    # Get handles to queue; the supervisor (and its fork server) is
+    # started before the heartbeat thread
+    supervisor = JobSupervisor(job_slots(), warm=config.getboolean('jobs', 'WarmWorker', fallback=False))
+    print(f"Running up to {supervisor.slots} annotation jobs at once")
+    acks = Acknowledger()
+    VisibilityHeartbeat(supervisor).start()
 
     # Poll queue for new results and process them
-    while True:
-        handle_requests_queue()
+    try:
+        while True:
+            handle_requests_queue(supervisor, acks)
+    finally:
+        supervisor.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,99 @@
+# aws_clients.py
+#
+# Per-process registry of AWS clients
+#
+# Building a boto3 client costs tens of milliseconds (loading the service
+# model, resolving endpoints and credentials), so the annotator and the
+# jobs it runs build each one once and reuse it. Clients are shared by
+# all threads of a process, with MaxPoolConnections HTTP connections
+# each so concurrent range reads and part uploads do not queue for one.
+# boto3 resources are not thread-safe and are kept per thread instead;
+# clients and resources are all built under one lock, as the default
+# boto3 session they come from is not thread-safe either.
+# A forked job builds its own, as clients must not cross a fork.
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import threading
+import boto3
+import botocore
+
+# Get configuration
+from configparser import ConfigParser, ExtendedInterpolation
+
+base_dir = os.path.abspath(os.path.dirname(__file__))
+
+config = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
+config.read(os.path.join(base_dir, "annotator_config.ini"))
+
+_clients = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+"""Starts a forked child with no clients (and an unheld lock)
+"""
+
+
+def _reset():
+    global _clients, _lock, _local
+    _clients = {}
+    _lock = threading.Lock()
+    _local = threading.local()
+
+
+os.register_at_fork(after_in_child=_reset)
+
+"""Client configuration: connection pool size, plus the signature
+version for S3
+"""
+
+
+def client_config(service):
+    options = {
+        "max_pool_connections": config.getint("aws", "MaxPoolConnections", fallback=10)
+    }
+    if service == "s3":
+        options["signature_version"] = config.get(
+            "aws", "SignatureVersion", fallback="s3v4"
+        )
+    return botocore.client.Config(**options)
+
+
+def region_name():
+    return config.get("aws", "AwsRegionName", fallback="us-east-1")
+
+
+"""The process's client for 'service', built on first use
+"""
+
+
+def client(service):
+    with _lock:
+        if service not in _clients:
+            _clients[service] = boto3.client(
+                service, region_name=region_name(), config=client_config(service)
+            )
+        return _clients[service]
+
+
+"""The calling thread's resource for 'service', built on first use
+"""
+
+
+def resource(service):
+    if not hasattr(_local, "resources"):
+        _local.resources = {}
+    if service not in _local.resources:
+        # Built from the shared default session, which is not thread-safe
+        with _lock:
+            _local.resources[service] = boto3.resource(
+                service, region_name=region_name(), config=client_config(service)
+            )
+    return _local.resources[service]
+
+
+### EOF
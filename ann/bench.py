@@ -0,0 +1,331 @@
+# bench.py
+#
+# Annotation throughput benchmarks against a local reference database
+#
+# Builds a synthetic SQLite reference database (bench_refdb.py), the
+# sort-merge extracts and dbSNP snapshot from it, and synthetic VCFs
+# (bench_vcf.py), then times each stage on its own and the full
+# driver.run for every input size. Each case runs in a fresh process so
+# its peak RSS is its own. Results can be saved as a baseline under
+# bench_baselines/ and later runs compared against it:
+#
+#   python bench.py --sizes 10000,100000 --save mybox
+#   python bench.py --sizes 10000,100000 --compare mybox
+#
+# The [ann] settings of annotator_config.ini apply, except that the
+# annotation cache is off so every run does the same work.
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import db_pool as dbp
+import driver
+import pipeline as pl
+import metrics as mt
+import merge_join as mj
+import dbsnp_snapshot as snap
+import bench_refdb as brd
+import bench_vcf as bv
+import annotate as ann
+
+base_dir = os.path.abspath(os.path.dirname(__file__))
+
+BASELINE_DIR = os.path.join(base_dir, "bench_baselines")
+
+# [ann] settings recorded with the results
+SETTINGS = [
+    "BlockSize",
+    "StageThreads",
+    "QueryInflight",
+    "Workers",
+    "ShardSize",
+    "DbSnpWindow",
+    "BigRefGeneWindow",
+    "TableBackends",
+    "MergeTables",
+    "CompressOutput",
+    "IndexOutput",
+    "DbPoolSize",
+]
+
+"""Points this process at the benchmark reference database and the
+extracts and snapshot built from it
+"""
+
+
+def use_reference(work):
+    dbp.config.set("ann", "ReferenceDb", os.path.join(work, "reference.db"))
+    driver.config.set("ann", "AnnotationCache", "off")
+    driver.config.set("ann", "Metrics", "on")
+    driver.EXTRACT_DIR = os.path.join(work, "extracts")
+    driver.DBSNP_SNAPSHOT_DIR = os.path.join(work, "dbsnp_snapshot")
+
+
+"""Builds the reference database and, unless 'extracts' is off, the
+sort-merge extracts and dbSNP snapshot, skipping what already exists
+"""
+
+
+def prepare(work, extracts=True):
+    use_reference(work)
+    if not os.path.exists(os.path.join(work, "reference.db")):
+        brd.build_synthetic(os.path.join(work, "reference.db"))
+        print("Reference database - done.")
+
+    if not extracts:
+        shutil.rmtree(driver.EXTRACT_DIR, ignore_errors=True)
+        shutil.rmtree(driver.DBSNP_SNAPSHOT_DIR, ignore_errors=True)
+        return
+
+    os.makedirs(driver.EXTRACT_DIR, exist_ok=True)
+    with dbp.connection() as conn:
+        for name in mj.EXTRACTS:
+            path = mj.extract_path(driver.EXTRACT_DIR, name)
+            if not os.path.exists(path):
+                mj.dump_extract(conn, name, path)
+    if not snap.exists(driver.DBSNP_SNAPSHOT_DIR):
+        snap.build_snapshot(
+            mj.extract_path(driver.EXTRACT_DIR, "dbSNP"), driver.DBSNP_SNAPSHOT_DIR
+        )
+    print("Extracts - done.")
+
+
+def input_path(work, size):
+    return os.path.join(work, f"bench_{size}.vcf")
+
+
+def make_input(work, size):
+    path = input_path(work, size)
+    if not os.path.exists(path):
+        known = bv.known_variants(
+            os.path.join(work, "reference.db"), ann.allowed_chrom, size
+        )
+        bv.write_vcf(path, size, known=known, known_fraction=0.2)
+    return path
+
+
+"""Stage 'name' with the stages it depends on, as the driver would run
+it on 'infile'
+"""
+
+
+def stage_chain(infile, name):
+    stages = driver.route_stages(infile, driver.STAGES)
+    by_name = dict((s.name, s) for s in stages)
+    wanted = [name]
+    for stage_name in wanted:
+        wanted.extend([d for d in by_name[stage_name].depends_on if d not in wanted])
+    return [s for s in stages if s.name in wanted]
+
+
+def run_stage(infile, name):
+    block_size = driver.config.getint("ann", "BlockSize", fallback=1000)
+    threads = driver.config.getint("ann", "StageThreads", fallback=1)
+    inflight = driver.config.getint("ann", "QueryInflight", fallback=1)
+
+    mt.reset()
+    pl.run_fused(
+        infile,
+        infile + ".annot",
+        stage_chain(infile, name),
+        format="vcf",
+        block_size=block_size,
+        threads=threads,
+        inflight=inflight,
+    )
+    values = mt.snapshot().get(name, {})
+    return {
+        "wall_seconds": values.get("wall_seconds", 0),
+        "cpu_seconds": values.get("cpu_seconds", 0),
+        "variants": values.get("variants", 0),
+        "queries": values.get("queries", 0),
+        "db_seconds": values.get("db_seconds", 0),
+    }
+
+
+def run_driver(infile, mode):
+    finalout = driver.run(infile, "vcf", mode=mode)
+    fh = open(driver.metrics_path(infile))
+    report = json.load(fh)
+    fh.close()
+    for path in [finalout, finalout + ".tbi"]:
+        if os.path.exists(path):
+            os.remove(path)
+    return dict((field, report[field]) for field in mt.FIELDS)
+
+
+"""Runs one case in this (fresh) process: 'stage:<name>' or
+'run:<mode>' over the input of 'size' variants
+"""
+
+
+def run_case(work, case, size):
+    use_reference(work)
+    case_dir = os.path.join(work, "case")
+    shutil.rmtree(case_dir, ignore_errors=True)
+    os.makedirs(case_dir)
+    infile = os.path.join(case_dir, os.path.basename(input_path(work, size)))
+    shutil.copy(input_path(work, size), infile)
+
+    kind, _, name = case.partition(":")
+    if kind == "stage":
+        result = run_stage(infile, name)
+    else:
+        result = run_driver(infile, name)
+    shutil.rmtree(case_dir, ignore_errors=True)
+
+    rss, children_rss = mt.peak_rss()
+    result.update(
+        {
+            "case": case,
+            "size": size,
+            "variants_per_second": mt.rate(result["variants"], result["wall_seconds"]),
+            "peak_rss_kb": max(rss, children_rss),
+        }
+    )
+    for field in mt.FIELDS:
+        result[field] = round(result[field], 4)
+    return result
+
+
+"""Runs fn(*args) in a child process and returns its result
+
+The child is forked from this small parent, before any reference data
+is loaded, so its peak RSS is the case's; parallel mode workers are in
+turn forked from it and see the same settings.
+"""
+
+
+def run_isolated(fn, *args):
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(fn, *args).result()
+
+
+"""Worse-than-baseline results: throughput below, or peak RSS above,
+the baseline by more than 'tolerance' (a fraction)
+"""
+
+
+def compare(results, baseline, tolerance):
+    previous = dict(((r["case"], r["size"]), r) for r in baseline["results"])
+    regressions = []
+    for result in results:
+        before = previous.get((result["case"], result["size"]))
+        if before is None:
+            continue
+        label = f"{result['case']} @ {result['size']}"
+        if (
+            before["variants_per_second"]
+            and result["variants_per_second"] is not None
+            and result["variants_per_second"]
+            < before["variants_per_second"] * (1 - tolerance)
+        ):
+            regressions.append(
+                f"{label}: {result['variants_per_second']} variants/s "
+                f"(baseline {before['variants_per_second']})"
+            )
+        if result["peak_rss_kb"] > before["peak_rss_kb"] * (1 + tolerance):
+            regressions.append(
+                f"{label}: peak RSS {result['peak_rss_kb']} KiB "
+                f"(baseline {before['peak_rss_kb']})"
+            )
+    return regressions
+
+
+def print_result(result):
+    print(
+        f"{result['case']:<36} {result['size']:>9} "
+        f"{str(result['variants_per_second']):>12} variants/s "
+        f"{result['wall_seconds']:>10.2f} s {result['peak_rss_kb']:>9} KiB"
+    )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark annotation throughput")
+    parser.add_argument(
+        "--sizes", default="10000,100000,1000000", help="variants per input"
+    )
+    parser.add_argument("--modes", default="fused,parallel", help="driver.run modes")
+    parser.add_argument(
+        "--no-stages", action="store_true", help="skip the per-stage cases"
+    )
+    parser.add_argument(
+        "--no-extracts",
+        action="store_true",
+        help="query every stage instead of using sort-merge extracts",
+    )
+    parser.add_argument("--work", default=os.path.join(base_dir, "bench_work"))
+    parser.add_argument("--save", help="save the results as this baseline")
+    parser.add_argument("--compare", help="compare the results to this baseline")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="allowed slowdown (fraction)"
+    )
+    args = parser.parse_args()
+
+    os.makedirs(args.work, exist_ok=True)
+    run_isolated(prepare, args.work, not args.no_extracts)
+
+    cases = []
+    if not args.no_stages:
+        cases.extend(["stage:" + s.name for s in driver.STAGES])
+    cases.extend(["run:" + mode for mode in args.modes.split(",")])
+
+    results = []
+    for size in [int(s) for s in args.sizes.split(",")]:
+        make_input(args.work, size)
+        for case in cases:
+            results.append(run_isolated(run_case, args.work, case, size))
+            print_result(results[-1])
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+        },
+        "extracts": not args.no_extracts,
+        "settings": dict(
+            (key, driver.config.get("ann", key, fallback=None)) for key in SETTINGS
+        ),
+        "results": results,
+    }
+    fh = open(os.path.join(args.work, "results.json"), "w")
+    json.dump(report, fh, indent=2)
+    fh.close()
+
+    if args.save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        fh = open(os.path.join(BASELINE_DIR, args.save + ".json"), "w")
+        json.dump(report, fh, indent=2)
+        fh.close()
+        print(f"Saved baseline {args.save}")
+
+    if args.compare:
+        fh = open(os.path.join(BASELINE_DIR, args.compare + ".json"))
+        baseline = json.load(fh)
+        fh.close()
+        if baseline["host"] != report["host"]:
+            print(f"Note: baseline was taken on {baseline['host']}")
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if len(regressions) > 0:
+            sys.exit(1)
+        print(f"No regressions against {args.compare}")
+
+### EOF
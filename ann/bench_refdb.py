@@ -0,0 +1,509 @@
+# bench_refdb.py
+#
+# Local SQLite copy of the reference database for benchmarks
+#
+# Creates the reference tables the stages query, with the columns in
+# the order of the RDS tables (most stages read 'select *' rows by
+# position), and fills them either with synthetic UCSC-like rows or
+# with a random sample of every RDS table. Point [ann] ReferenceDb at
+# the file to run the pipeline without RDS (see bench.py).
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import sys
+import random
+import sqlite3
+import argparse
+
+import annotate as ann
+import db_pool as dbp
+
+"""Reference tables and their columns; tfbsConsSites is split into one
+table per chromosome (tfbsConsSites1 ... tfbsConsSitesY)
+"""
+TRANSCRIPT_COLUMNS = [
+    "id",
+    "CHR",
+    "start",
+    "end",
+    "haplotypeReference",
+    "haplotypeAlternate",
+    "name",
+    "name2",
+    "transcriptStrand",
+    "positionType",
+    "frame",
+    "mrnaCoord",
+    "codonCoord",
+    "spliceDist",
+    "referenceCodon",
+    "referenceAA",
+    "variantCodon",
+    "variantAA",
+    "changesAA",
+    "functionalClass",
+    "codingCoordStr",
+    "proteinCoordStr",
+    "inCodingRegion",
+    "spliceInfo",
+    "uorfChange",
+]
+
+CNV_COLUMNS = ["bin", "chrom", "chromStart", "chromEnd", "name"]
+
+TABLES = {
+    "dbSNP": ["CHR", "POS", "POS_END", "RSID", "REF", "ALT", "QUAL", "GMAF", "INFO"],
+    "chrom_pos_equal_base": TRANSCRIPT_COLUMNS,
+    "chrom_pos_equal_nobase": TRANSCRIPT_COLUMNS,
+    "chrom_pos_unequal": TRANSCRIPT_COLUMNS,
+    "refGene": [
+        "bin",
+        "name",
+        "chrom",
+        "strand",
+        "txStart",
+        "txEnd",
+        "cdsStart",
+        "cdsEnd",
+        "exonCount",
+        "exonStarts",
+        "exonEnds",
+        "score",
+        "name2",
+        "cdsStartStat",
+        "cdsEndStat",
+        "exonFrames",
+    ],
+    "cpgIslandExt": [
+        "bin",
+        "chrom",
+        "chromStart",
+        "chromEnd",
+        "name",
+        "length",
+        "cpgNum",
+        "gcNum",
+        "perCpg",
+        "perGc",
+        "obsExp",
+    ],
+    "cytoBand": ["chrom", "chromStart", "chromEnd", "name", "gieStain"],
+    "gadAll": ["chromosome", "chromStart", "chromEnd", "geneSymbol", "association"],
+    "gwasCatalog": [
+        "bin",
+        "chrom",
+        "chromStart",
+        "chromEnd",
+        "name",
+        "pubMedID",
+        "author",
+        "pubDate",
+        "journal",
+        "title",
+        "trait",
+    ],
+    "targetScanS": ["bin", "chrom", "chromStart", "chromEnd", "name", "score"],
+    "hugo": [
+        "chrom",
+        "chromStart",
+        "chromEnd",
+        "hgncId",
+        "status",
+        "symbol",
+        "name",
+    ],
+    "dgv_Cnv": CNV_COLUMNS,
+    "abParts_IG_T_CelReceptors": CNV_COLUMNS,
+    "mcCarroll_Cnv": CNV_COLUMNS,
+    "conrad_Cnv": CNV_COLUMNS,
+    "genomicSuperDups": [
+        "bin",
+        "chrom",
+        "chromStart",
+        "chromEnd",
+        "name",
+        "score",
+        "strand",
+        "otherChrom",
+        "otherStart",
+        "otherEnd",
+    ],
+}
+for c in ann.allowed_chrom:
+    TABLES["tfbsConsSites" + c] = CNV_COLUMNS
+
+"""Columns indexed like the RDS tables: (chrom, start) of each lookup
+"""
+INDEXES = {
+    "dbSNP": ("CHR", "POS"),
+    "chrom_pos_equal_base": ("CHR", "start"),
+    "chrom_pos_equal_nobase": ("CHR", "start"),
+    "chrom_pos_unequal": ("CHR", "start"),
+    "refGene": ("chrom", "txStart"),
+    "gadAll": ("chromosome", "chromStart"),
+}
+
+"""Synthetic rows per megabase of each chromosome, and the range of
+interval lengths, for the interval tables
+"""
+DENSITY = {
+    "dbSNP": 2000,
+    "chrom_pos_equal_base": 500,
+    "chrom_pos_equal_nobase": 500,
+    "chrom_pos_unequal": 200,
+    "refGene": 10,
+    "cpgIslandExt": 10,
+    "gadAll": 20,
+    "gwasCatalog": 10,
+    "targetScanS": 15,
+    "hugo": 10,
+    "dgv_Cnv": 40,
+    "abParts_IG_T_CelReceptors": 0.5,
+    "mcCarroll_Cnv": 1,
+    "conrad_Cnv": 3,
+    "genomicSuperDups": 15,
+    "tfbsConsSites": 300,
+}
+
+LENGTHS = {
+    "cpgIslandExt": (200, 3000),
+    "gadAll": (1000, 50000),
+    "gwasCatalog": (1, 1),
+    "targetScanS": (7, 8),
+    "hugo": (1000, 50000),
+    "dgv_Cnv": (1000, 100000),
+    "abParts_IG_T_CelReceptors": (10000, 100000),
+    "mcCarroll_Cnv": (1000, 50000),
+    "conrad_Cnv": (500, 20000),
+    "genomicSuperDups": (1000, 50000),
+    "tfbsConsSites": (10, 30),
+}
+
+BASES = "ACGT"
+POSITION_TYPES = [
+    "CDS",
+    "intron",
+    "utr3",
+    "utr5",
+    "non_coding_exon",
+    "non_coding_intron",
+]
+
+"""UCSC bin of a 0-based, half-open range (binFromRangeStandard)
+"""
+
+
+def ucsc_bin(start, end):
+    start = start >> 17
+    end = (end - 1) >> 17
+    for offset in [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]:
+        if start == end:
+            return offset + start
+        start = start >> 3
+        end = end >> 3
+    return 0
+
+
+"""Columns compare strings case-insensitively, like the RDS tables
+"""
+
+
+def create_table(conn, table, columns):
+    columns = ", ".join([column + " COLLATE NOCASE" for column in columns])
+    conn.execute(f"create table {table} ({columns})")
+
+
+def create_tables(conn):
+    for table, columns in TABLES.items():
+        create_table(conn, table, columns)
+
+
+def create_indexes(conn, tables=None):
+    if tables is None:
+        tables = list(TABLES)
+    for table, columns in INDEXES.items():
+        if table in tables:
+            conn.execute(f"create index {table}_pos on {table} ({', '.join(columns)})")
+    for table, columns in TABLES.items():
+        if table in tables and table not in INDEXES and "chrom" in columns:
+            conn.execute(f"create index {table}_pos on {table} (chrom, chromStart)")
+
+
+def insert(conn, table, rows):
+    placeholders = ", ".join(["?"] * len(TABLES[table]))
+    conn.executemany(f"insert into {table} values ({placeholders})", rows)
+
+
+def intervals(rnd, count, span, lengths):
+    for i in range(count):
+        start = rnd.randint(0, span - lengths[1])
+        yield i, start, start + rnd.randint(*lengths)
+
+
+def dbsnp_rows(rnd, chrom, count, span):
+    for i in range(count):
+        pos = rnd.randint(1, span)
+        ref = rnd.choice(BASES)
+        varclass = "SNV" if rnd.random() < 0.9 else "DIV"
+        alt = rnd.choice(BASES.replace(ref, ""))
+        if varclass == "DIV":
+            alt = ref + "".join(rnd.choice(BASES) for k in range(rnd.randint(1, 4)))
+        gmaf = rnd.choice([".", ".", str(round(rnd.random() / 2, 3))])
+        yield (chrom, pos, pos, f"rs{chrom}{i}", ref, alt, ".", gmaf, varclass)
+
+
+def transcript_rows(rnd, table, chrom, count, span):
+    for i in range(count):
+        start = rnd.randint(1, span)
+        end = start
+        if table == "chrom_pos_unequal":
+            end = start + rnd.randint(1, 50)
+        coding = rnd.random() < 0.5
+        yield (
+            i,
+            chrom,
+            start,
+            end,
+            rnd.choice(BASES),
+            rnd.choice(BASES),
+            f"NM_{rnd.randint(1, 50000)}",
+            f"GENE{rnd.randint(1, 20000)}",
+            rnd.choice("+-"),
+            rnd.choice(POSITION_TYPES),
+            rnd.randint(0, 2),
+            rnd.randint(1, 5000),
+            rnd.randint(1, 3),
+            rnd.choice([0, 0, rnd.randint(1, 10)]),
+            "AAA",
+            "K",
+            "AAG",
+            "K",
+            rnd.choice(["0", "1"]),
+            rnd.choice(["missense", "silent", "nonsense"]) if coding else "",
+            f"c.{rnd.randint(1, 5000)}",
+            f"p.{rnd.randint(1, 1500)}" if coding else "",
+            1 if coding else 0,
+            "",
+            "",
+        )
+
+
+def refgene_rows(rnd, chrom, count, span):
+    for i, start, end in intervals(rnd, count, span, (1000, 60000)):
+        exons = rnd.randint(1, 12)
+        points = sorted(rnd.sample(range(start, end), 2 * exons))
+        if rnd.random() < 0.2:
+            # non-coding transcript
+            cds_start = cds_end = end
+        else:
+            cds_start = rnd.randint(points[0], points[-1])
+            cds_end = rnd.randint(cds_start, points[-1])
+        yield (
+            ucsc_bin(start, end),
+            f"NM_{chrom}{i}",
+            chrom,
+            rnd.choice("+-"),
+            start,
+            end,
+            cds_start,
+            cds_end,
+            exons,
+            ("".join(f"{p}," for p in points[0::2])).encode("utf-8"),
+            ("".join(f"{p}," for p in points[1::2])).encode("utf-8"),
+            0,
+            f"GENE{rnd.randint(1, 20000)}",
+            "cmpl",
+            "cmpl",
+            "",
+        )
+
+
+def interval_rows(rnd, table, chrom, count, span):
+    base = "tfbsConsSites" if table.startswith("tfbsConsSites") else table
+    for i, start, end in intervals(rnd, count, span, LENGTHS[base]):
+        bin = ucsc_bin(start, end)
+        if table == "cpgIslandExt":
+            length = end - start
+            cpg = rnd.randint(length // 20, length // 5)
+            gc = rnd.randint(length // 2, length)
+            yield (
+                bin,
+                chrom,
+                start,
+                end,
+                f"CpG: {cpg}",
+                length,
+                cpg,
+                gc,
+                round(200.0 * cpg / length, 1),
+                round(100.0 * gc / length, 1),
+                round(rnd.uniform(0.6, 1.2), 2),
+            )
+        elif table == "gadAll":
+            yield (
+                chrom[3:],
+                start,
+                end,
+                f"GENE{rnd.randint(1, 20000)}",
+                rnd.choice(["Y", "N", ""]),
+            )
+        elif table == "gwasCatalog":
+            # a single SNP: chromEnd is its position
+            yield (
+                ucsc_bin(end - 1, end),
+                chrom,
+                end - 1,
+                end,
+                f"rs{rnd.randint(1, 10**8)}",
+                rnd.randint(10**7, 3 * 10**7),
+                "Author",
+                "2012-01-01",
+                "Journal",
+                "Title",
+                f"Trait {rnd.randint(1, 500)}",
+            )
+        elif table == "targetScanS":
+            yield (bin, chrom, start, end, f"GENE:miR-{rnd.randint(1, 900)}", 0)
+        elif table == "hugo":
+            yield (
+                chrom,
+                start,
+                end,
+                f"HGNC:{rnd.randint(1, 40000)}",
+                "Approved",
+                f"GENE{rnd.randint(1, 20000)}",
+                "gene name; with description",
+            )
+        elif table == "genomicSuperDups":
+            other = rnd.randint(0, 10**6)
+            yield (
+                bin,
+                chrom,
+                start,
+                end,
+                f"chr{rnd.choice(ann.allowed_chrom)}:{other}",
+                rnd.randint(0, 1000),
+                rnd.choice("+-"),
+                f"chr{rnd.choice(ann.allowed_chrom)}",
+                other,
+                other + end - start,
+            )
+        else:
+            yield (bin, chrom, start, end, f"{base}_{chrom}_{i}")
+
+
+def cytoband_rows(chrom, span, width=1000000):
+    for k, start in enumerate(range(0, span, width)):
+        arm = "p" if start < span // 2 else "q"
+        stain = ["gneg", "gpos25", "gpos50", "gpos75", "gpos100"][k % 5]
+        yield (chrom, start, min(start + width, span), f"{arm}{k + 1}", stain)
+
+
+"""Fills 'path' with synthetic reference tables
+
+'span' bases on each of 'chroms' chromosomes, with DENSITY rows per
+megabase scaled by 'density'. The same seed gives the same file.
+"""
+
+
+def build_synthetic(path, chroms=None, span=2000000, density=1.0, seed=1):
+    rnd = random.Random(seed)
+    if chroms is None:
+        chroms = ann.allowed_chrom
+
+    conn = sqlite3.connect(path)
+    create_tables(conn)
+
+    def count(table):
+        return max(1, int(DENSITY[table] * density * span / 1000000))
+
+    for c in chroms:
+        chrom = "chr" + c
+        insert(conn, "dbSNP", dbsnp_rows(rnd, c, count("dbSNP"), span))
+        for table in [
+            "chrom_pos_equal_base",
+            "chrom_pos_equal_nobase",
+            "chrom_pos_unequal",
+        ]:
+            insert(conn, table, transcript_rows(rnd, table, c, count(table), span))
+        insert(conn, "refGene", refgene_rows(rnd, chrom, count("refGene"), span))
+        insert(conn, "cytoBand", cytoband_rows(chrom, span))
+        for table in LENGTHS:
+            name = table + c if table == "tfbsConsSites" else table
+            insert(conn, name, interval_rows(rnd, name, chrom, count(table), span))
+        conn.commit()
+
+    create_indexes(conn)
+    conn.commit()
+    conn.close()
+
+
+"""Fills 'path' with a random 'fraction' of the rows of every table (or
+of 'tables') of the RDS reference database, keeping the RDS column
+names; a fraction of 1 copies the tables whole, e.g. for the sqlite
+reference backend (ref_backend.py)
+"""
+
+
+def build_sample(path, fraction, seed=1, tables=None):
+    if tables is None:
+        tables = list(TABLES)
+    conn = sqlite3.connect(path)
+    with dbp.connection() as rds:
+        cursor = rds.cursor()
+        for table in tables:
+            cursor.execute(f"select * from {table} where rand({seed}) < {fraction};")
+            rows = cursor.fetchall()
+            columns = [d[0] for d in cursor.description]
+            create_table(conn, table, columns)
+            placeholders = ", ".join(["?"] * len(columns))
+            conn.executemany(f"insert into {table} values ({placeholders})", rows)
+            conn.commit()
+            print(f"{table}: {len(rows)} rows")
+
+    create_indexes(conn, tables)
+    conn.commit()
+    conn.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Build a local SQLite reference database for benchmarks"
+    )
+    parser.add_argument("path")
+    parser.add_argument(
+        "--chroms", default=",".join(ann.allowed_chrom), help="e.g. 1,2,X"
+    )
+    parser.add_argument("--span", type=int, default=2000000)
+    parser.add_argument("--density", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--sample",
+        type=float,
+        default=None,
+        help="copy this fraction of each RDS table instead of synthetic rows",
+    )
+    parser.add_argument(
+        "--tables", help="with --sample, only these tables, e.g. hugo,gadAll"
+    )
+    args = parser.parse_args()
+
+    if os.path.exists(args.path):
+        print(f"{args.path} already exists")
+        sys.exit(1)
+
+    if args.sample is not None:
+        tables = None if args.tables is None else args.tables.split(",")
+        build_sample(args.path, args.sample, args.seed, tables)
+    else:
+        build_synthetic(
+            args.path, args.chroms.split(","), args.span, args.density, args.seed
+        )
+    print("Reference database - done.")
+
+### EOF
@@ -0,0 +1,160 @@
+# bench_vcf.py
+#
+# Synthetic VCF inputs for benchmarks
+#
+# Writes single-sample VCFs with a chosen number of variants, mix of
+# chromosomes, share of indels and degree of sortedness. A share of the
+# variants can be drawn from the dbSNP table of a reference database
+# built with bench_refdb.py, so the dbSNP stage finds matches.
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import random
+import sqlite3
+import argparse
+
+import annotate as ann
+
+BASES = "ACGT"
+
+"""Parses a chromosome mix such as '1:3,2:2,X' (weights default to 1)
+"""
+
+
+def parse_chroms(spec):
+    chroms = []
+    weights = []
+    for item in spec.split(","):
+        chrom, _, weight = item.strip().partition(":")
+        chroms.append(chrom)
+        weights.append(float(weight) if weight else 1.0)
+    return chroms, weights
+
+
+"""Up to 'n' known variants (chrom, pos, ref, alt) from the dbSNP table
+of a SQLite reference database, on the given chromosomes
+"""
+
+
+def known_variants(db, chroms, n, seed=1):
+    conn = sqlite3.connect(db)
+    placeholders = ", ".join(["?"] * len(chroms))
+    rows = conn.execute(
+        f"select CHR, POS, REF, ALT from dbSNP where CHR in ({placeholders})",
+        chroms,
+    ).fetchall()
+    conn.close()
+    rnd = random.Random(seed)
+    return rnd.sample(rows, min(n, len(rows)))
+
+
+def random_variant(rnd, chrom, span, indel_fraction):
+    pos = rnd.randint(1, span)
+    ref = rnd.choice(BASES)
+    if rnd.random() >= indel_fraction:
+        return (chrom, pos, ref, rnd.choice(BASES.replace(ref, "")))
+    inserted = "".join(rnd.choice(BASES) for k in range(rnd.randint(1, 6)))
+    if rnd.random() < 0.5:
+        return (chrom, pos, ref, ref + inserted)
+    return (chrom, pos, ref + inserted, ref)
+
+
+"""Writes a VCF of 'n' variants to 'path'
+
+chroms/weights: chromosomes and their relative share of the variants;
+positions are uniform over 1..span
+indel_fraction: share of insertions and deletions (the rest are SNVs)
+unsorted_fraction: share of records moved out of coordinate order
+(0 = sorted by chromosome, in 'chroms' order, and position)
+known/known_fraction: variants to draw that share of the records from,
+e.g. known_variants() of the reference database
+"""
+
+
+def write_vcf(
+    path,
+    n,
+    chroms=None,
+    weights=None,
+    span=2000000,
+    indel_fraction=0.1,
+    unsorted_fraction=0.0,
+    known=None,
+    known_fraction=0.0,
+    seed=1,
+):
+    rnd = random.Random(seed)
+    if chroms is None:
+        chroms = ann.allowed_chrom
+
+    records = []
+    picks = rnd.choices(chroms, weights=weights, k=n)
+    for chrom in picks:
+        if known and rnd.random() < known_fraction:
+            records.append(tuple(rnd.choice(known)))
+        else:
+            records.append(random_variant(rnd, chrom, span, indel_fraction))
+
+    order = dict((chrom, i) for i, chrom in enumerate(chroms))
+    records.sort(key=lambda r: (order.get(r[0], len(order)), int(r[1])))
+
+    moved = rnd.sample(range(n), int(n * unsorted_fraction))
+    shuffled = [records[i] for i in moved]
+    rnd.shuffle(shuffled)
+    for i, record in zip(moved, shuffled):
+        records[i] = record
+
+    fh = open(path, "w")
+    fh.write("##fileformat=VCFv4.1\n")
+    fh.write("##source=bench_vcf.py\n")
+    fh.write('##INFO=<ID=DP,Number=1,Type=Integer,Description="Read depth">\n')
+    fh.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+    fh.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n")
+    for chrom, pos, ref, alt in records:
+        fh.write(
+            f"{chrom}\t{pos}\t.\t{ref}\t{alt}\t{rnd.randint(20, 99)}\tPASS\t"
+            f"DP={rnd.randint(5, 60)}\tGT\t{rnd.choice(['0/1', '1/1'])}\n"
+        )
+    fh.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Write a synthetic VCF")
+    parser.add_argument("path")
+    parser.add_argument("n", type=int, help="number of variants")
+    parser.add_argument(
+        "--chroms",
+        default=",".join(ann.allowed_chrom),
+        help="chromosome mix, e.g. 1:3,2:2,X",
+    )
+    parser.add_argument("--span", type=int, default=2000000)
+    parser.add_argument("--indel-fraction", type=float, default=0.1)
+    parser.add_argument("--unsorted-fraction", type=float, default=0.0)
+    parser.add_argument("--db", help="reference database to draw known variants from")
+    parser.add_argument("--known-fraction", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    chroms, weights = parse_chroms(args.chroms)
+    known = None
+    if args.db is not None and args.known_fraction > 0:
+        known = known_variants(args.db, chroms, args.n, args.seed)
+    write_vcf(
+        args.path,
+        args.n,
+        chroms,
+        weights,
+        args.span,
+        args.indel_fraction,
+        args.unsorted_fraction,
+        known,
+        args.known_fraction,
+        args.seed,
+    )
+    print(f"{args.path}: {args.n} variants")
+
+### EOF
@@ -0,0 +1,304 @@
+# db_pool.py
+#
+# Pooled connections to the reference (AnnTools) database
+#
+# The RDS secret is cached for DbSecretTtl seconds and connections are
+# kept open and handed out again, so the annotation stages (and, in a
+# long-running worker, consecutive jobs) share a few connections instead
+# of paying a Secrets Manager call and a TLS handshake each.
+#
+# With ReferenceDb set, connections go to a local SQLite copy of the
+# reference tables instead (see bench_refdb.py), e.g. for benchmarks.
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import json
+import time
+import threading
+import sqlite3
+import contextlib
+import pymysql
+import boto3
+from botocore.exceptions import ClientError
+
+import file_utils as fu
+import metrics as mt
+
+# Get configuration
+from configparser import ConfigParser, ExtendedInterpolation
+
+base_dir = os.path.abspath(os.path.dirname(__file__))
+
+config = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
+config.read(os.path.join(base_dir, "annotator_config.ini"))
+
+AWS_REGION_NAME = (
+    os.environ["AWS_REGION_NAME"] if ("AWS_REGION_NAME" in os.environ) else "us-east-1"
+)
+
+_secret = None
+_secret_time = 0
+_secret_lock = threading.Lock()
+
+"""Get the reference database credentials from AWS Secrets Manager,
+re-reading them only after 'ttl' seconds
+"""
+
+
+def get_rds_secret(ttl=None):
+    global _secret, _secret_time
+
+    if ttl is None:
+        ttl = config.getint("ann", "DbSecretTtl", fallback=3600)
+
+    with _secret_lock:
+        if _secret is None or (time.time() - _secret_time) > ttl:
+            asm = boto3.client("secretsmanager", region_name=AWS_REGION_NAME)
+            try:
+                asm_response = asm.get_secret_value(SecretId="rds/anntools_database")
+                _secret = json.loads(asm_response["SecretString"])
+                _secret_time = time.time()
+            except ClientError as e:
+                print(
+                    f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}"
+                )
+                raise e
+        return _secret
+
+
+"""SQLite stand-in for a pymysql connection to the reference database
+
+Accepts the pymysql cursor classes and %s placeholders the stages use;
+the reference tables are only read.
+"""
+
+
+class SqliteConnection(object):
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+    def cursor(self, cursorclass=None):
+        return SqliteCursor(self.conn.cursor())
+
+    def ping(self, reconnect=True):
+        pass
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+
+class SqliteCursor(object):
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, args=None):
+        if args is None:
+            self.cursor.execute(sql)
+        else:
+            self.cursor.execute(sql.replace("%s", "?"), args)
+
+    def fetchall(self):
+        return tuple(self.cursor.fetchall())
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size=1):
+        return tuple(self.cursor.fetchmany(size))
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def close(self):
+        self.cursor.close()
+
+
+"""Which reference database connect() opens: the ReferenceDb file, or
+the RDS host and port
+"""
+
+
+def identity():
+    reference_db = config.get("ann", "ReferenceDb", fallback="")
+    if reference_db:
+        return "sqlite:" + fu.fileIdentity(reference_db)
+
+    rds_secret = get_rds_secret()
+    return f"mysql:{rds_secret['host']}:{rds_secret['port']}/annotator"
+
+
+"""Open a new (unpooled) connection to the reference database
+"""
+
+
+def connect():
+    reference_db = config.get("ann", "ReferenceDb", fallback="")
+    if reference_db:
+        return SqliteConnection(reference_db)
+
+    rds_secret = get_rds_secret()
+    return pymysql.connect(
+        host=rds_secret["host"],
+        port=rds_secret["port"],
+        user=rds_secret["username"],
+        passwd=rds_secret["password"],
+        db="annotator",
+        # Reads only; autocommit keeps a reused connection from holding
+        # an old transaction snapshot between jobs
+        autocommit=True,
+    )
+
+
+"""A small thread-safe pool of reference database connections
+
+acquire() hands out an idle connection (a hit) or opens a new one
+(a miss) while fewer than max_size are open; otherwise it waits for a
+release, and raises TimeoutError after 'timeout' seconds (None waits
+for ever) rather than hang on a pool too small for its users. Idle
+connections are pinged on reuse and reconnect if the server dropped
+them.
+"""
+
+
+class ConnectionPool(object):
+    def __init__(self, max_size=4, timeout=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self.idle = []
+        self.open = 0
+        self.cond = threading.Condition()
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def acquire(self):
+        start = time.time()
+        conn = None
+        with self.cond:
+            while True:
+                if len(self.idle) > 0:
+                    conn = self.idle.pop()
+                    self.hits = self.hits + 1
+                    break
+                if self.open < self.max_size:
+                    self.open = self.open + 1
+                    self.misses = self.misses + 1
+                    break
+                self.waits = self.waits + 1
+                if self.timeout is None:
+                    self.cond.wait()
+                    continue
+                remaining = start + self.timeout - time.time()
+                if remaining <= 0:
+                    self.wait_time = self.wait_time + (time.time() - start)
+                    raise TimeoutError(
+                        f"No reference database connection free after "
+                        f"{self.timeout}s: all {self.max_size} (DbPoolSize) in use"
+                    )
+                self.cond.wait(remaining)
+            self.wait_time = self.wait_time + (time.time() - start)
+
+        if conn is None:
+            try:
+                # Cursors count queries and DB time per stage (metrics.py)
+                conn = mt.TimedConnection(connect())
+            except Exception:
+                with self.cond:
+                    self.open = self.open - 1
+                    self.cond.notify()
+                raise
+        else:
+            conn.ping(reconnect=True)
+        return conn
+
+    def release(self, conn, discard=False):
+        with self.cond:
+            if discard:
+                self.open = self.open - 1
+            else:
+                self.idle.append(conn)
+            self.cond.notify()
+        if discard:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except Exception:
+            # The connection may be broken or hold unread results;
+            # do not hand it to the next user
+            self.release(conn, discard=True)
+            raise
+        else:
+            self.release(conn)
+
+    def close(self):
+        with self.cond:
+            idle = self.idle
+            self.idle = []
+            self.open = self.open - len(idle)
+        for conn in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def stats(self):
+        with self.cond:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "open": self.open,
+                "idle": len(self.idle),
+                "waits": self.waits,
+                "wait_time": round(self.wait_time, 4),
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+"""Returns the process-wide pool
+
+A forked child never reuses its parent's sockets: it gets a fresh pool
+"""
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            timeout = config.getfloat("ann", "DbAcquireTimeout", fallback=60)
+            _pool = ConnectionPool(
+                max_size=config.getint("ann", "DbPoolSize", fallback=4),
+                timeout=timeout if timeout > 0 else None,
+            )
+        return _pool
+
+
+def connection():
+    return get_pool().connection()
+
+
+def stats():
+    return get_pool().stats()
+
+
+### EOF
@@ -0,0 +1,258 @@
+# dbsnp_snapshot.py
+#
+# Memory-mapped columnar snapshot of the dbSNP table
+#
+# Each chromosome is one binary file holding a sorted POS array, one REF
+# code per row and offsets into a heap of "rsid<TAB>GMAF<TAB>REF"
+# strings. The files are opened with mmap, so every annotator process on
+# the host shares the same page cache instead of pulling dbSNP rows over
+# the network, and a block of variants is resolved with bisects over the
+# POS array.
+#
+# Build the snapshot (from the sorted dbSNP extract, see merge_join.py)
+# with:
+#   python dbsnp_snapshot.py <extract_dir> <snapshot_dir>
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import sys
+import json
+import mmap
+import time
+import array
+import bisect
+import struct
+import shutil
+import merge_join as mj
+
+MAGIC = b"DBSNAP1\x00"
+HEADER = struct.Struct("<8sQQ")  # magic, rows, heap size
+MANIFEST = "dbSNP.snap.json"
+
+REF_CODES = {"A": 1, "C": 2, "G": 3, "T": 4}
+
+"""REF code of a base; 0 for anything that is not a single A/C/G/T,
+in which case the REF text in the heap is compared instead
+"""
+
+
+def ref_code(ref):
+    return REF_CODES.get(str(ref).upper(), 0)
+
+
+def snapshot_path(snapshot_dir, chrom):
+    return os.path.join(snapshot_dir, "dbSNP." + chrom + ".snap")
+
+
+"""Writes one chromosome file from (pos, ref, rsid, gmaf) rows sorted by pos
+
+The columns are spooled to temporary files so a chromosome never has
+to fit in memory.
+"""
+
+
+def write_chrom(path, rows, chunk=65536):
+    parts = [path + ext for ext in (".pos", ".ref", ".off", ".heap")]
+    fh_pos, fh_ref, fh_off, fh_heap = [open(p, "wb") for p in parts]
+
+    positions = array.array("I")
+    codes = bytearray()
+    offsets = array.array("Q", [0])
+    heap_size = 0
+    count = 0
+    for pos, ref, rsid, gmaf in rows:
+        record = (str(rsid) + "\t" + str(gmaf) + "\t" + str(ref)).encode("utf-8")
+        fh_heap.write(record)
+        heap_size = heap_size + len(record)
+        positions.append(int(pos))
+        codes.append(ref_code(ref))
+        offsets.append(heap_size)
+        count = count + 1
+        if len(positions) >= chunk:
+            positions.tofile(fh_pos)
+            fh_ref.write(codes)
+            offsets.tofile(fh_off)
+            positions = array.array("I")
+            codes = bytearray()
+            offsets = array.array("Q")
+    positions.tofile(fh_pos)
+    fh_ref.write(codes)
+    offsets.tofile(fh_off)
+
+    # Offsets start on an 8-byte boundary
+    fh_ref.write(b"\x00" * (-(4 * count + count) % 8))
+
+    for fh_part in (fh_pos, fh_ref, fh_off, fh_heap):
+        fh_part.close()
+
+    fh = open(path, "wb")
+    fh.write(HEADER.pack(MAGIC, count, heap_size))
+    for part in parts:
+        fh_part = open(part, "rb")
+        shutil.copyfileobj(fh_part, fh)
+        fh_part.close()
+        os.remove(part)
+    fh.close()
+
+
+"""Builds the snapshot from the dbSNP extract of merge_join.py
+
+Rows keep the extract order (POS, then table order), so matches come
+back in the same order as from the dbSNP query. The extract only holds
+varclass SNV, which is recorded in the manifest.
+"""
+
+
+def build_snapshot(extract_path, snapshot_dir):
+    os.makedirs(snapshot_dir, exist_ok=True)
+
+    fh = open(extract_path, "rb")
+    state = {"chrom": None, "line": fh.readline()}
+
+    def chrom_rows():
+        while state["line"]:
+            row = [
+                mj.decode_value(v)
+                for v in state["line"].decode("utf-8").rstrip("\n").split("\t")
+            ]
+            if row[0] != state["chrom"]:
+                return
+            # chrom, pos, pos, ordinal, REF, dbSNP.*
+            yield (row[1], row[4], row[5 + 3], row[5 + 7])
+            state["line"] = fh.readline()
+
+    chroms = {}
+    while state["line"]:
+        chrom = state["line"].decode("utf-8").split("\t", 1)[0]
+        if chrom in chroms:
+            raise ValueError(f"{extract_path}: chromosome {chrom} is not grouped")
+        state["chrom"] = chrom
+        path = snapshot_path(snapshot_dir, chrom)
+        write_chrom(path, chrom_rows())
+        chroms[chrom] = os.path.basename(path)
+    fh.close()
+
+    fh_manifest = open(os.path.join(snapshot_dir, MANIFEST), "w")
+    json.dump(
+        {"varclass": "SNV", "built": int(time.time()), "chroms": chroms}, fh_manifest
+    )
+    fh_manifest.close()
+
+
+"""One memory-mapped chromosome file
+"""
+
+
+class ChromSnapshot(object):
+    def __init__(self, path):
+        self.fh = open(path, "rb")
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, heap_size = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a dbSNP snapshot")
+
+        view = memoryview(self.mm)
+        start = HEADER.size
+        self.positions = view[start : start + 4 * count].cast("I")
+        start = start + 4 * count
+        self.codes = view[start : start + count]
+        start = start + count + (-(4 * count + count) % 8)
+        self.offsets = view[start : start + 8 * (count + 1)].cast("Q")
+        self.heap_start = start + 8 * (count + 1)
+
+    def record(self, i):
+        start = self.heap_start + self.offsets[i]
+        end = self.heap_start + self.offsets[i + 1]
+        return self.mm[start:end].decode("utf-8").split("\t")
+
+
+"""Read-only view of a dbSNP snapshot
+
+find() resolves a sorted list of positions to row ranges in one sweep
+over the POS array; matches() filters a range on REF, case-insensitively
+as MySQL compares REF, and returns its (rsid, GMAF) pairs.
+"""
+
+
+class DbSnpSnapshot(object):
+    def __init__(self, snapshot_dir):
+        fh = open(os.path.join(snapshot_dir, MANIFEST))
+        manifest = json.load(fh)
+        fh.close()
+        self.dir = snapshot_dir
+        self.varclass = manifest["varclass"]
+        self.files = manifest["chroms"]
+        self.chroms = {}
+
+    def chrom(self, chrom):
+        if chrom not in self.chroms:
+            name = self.files.get(chrom)
+            self.chroms[chrom] = (
+                None if name is None else ChromSnapshot(os.path.join(self.dir, name))
+            )
+        return self.chroms[chrom]
+
+    def find(self, chrom, positions):
+        snap = self.chrom(str(chrom))
+        spans = {}
+        if snap is None:
+            return spans
+
+        lo = 0
+        n = len(snap.positions)
+        for pos in positions:
+            lo = bisect.bisect_left(snap.positions, pos, lo, n)
+            hi = lo
+            while hi < n and snap.positions[hi] == pos:
+                hi = hi + 1
+            if hi > lo:
+                spans[pos] = (lo, hi)
+            lo = hi
+        return spans
+
+    def matches(self, chrom, span, ref, compRef):
+        snap = self.chrom(str(chrom))
+        codes = [ref_code(ref), ref_code(compRef)]
+        wanted = [ref.upper(), compRef.upper()]
+        ids = []
+        for i in range(span[0], span[1]):
+            code = snap.codes[i]
+            if code != 0 and code not in codes:
+                continue
+            rsid, gmaf, snp_ref = snap.record(i)
+            if snp_ref.upper() in wanted:
+                ids.append((rsid, gmaf))
+        return ids
+
+
+_snapshots = {}
+
+"""Resource loader for pipeline.Stage; snapshots stay mapped for the
+life of the process
+"""
+
+
+def open_snapshot(cursor, path):
+    if path not in _snapshots:
+        _snapshots[path] = DbSnpSnapshot(path)
+    return _snapshots[path]
+
+
+def exists(snapshot_dir):
+    return os.path.exists(os.path.join(snapshot_dir, MANIFEST))
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 3:
+        print("Usage: python dbsnp_snapshot.py <extract_dir> <snapshot_dir>")
+        sys.exit(1)
+
+    build_snapshot(mj.extract_path(sys.argv[1], "dbSNP"), sys.argv[2])
+    print("dbSNP snapshot - done.")
+
+### EOF
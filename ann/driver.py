@@ -12,157 +12,686 @@ __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
 import sys
 import os
+import json
+import time
+import hashlib
+import functools
 import file_utils as fu
 import annotate as ann
+import db_pool as dbp
+import pipeline as pl
+import ref_index as ri
+import ref_backend as rb
+import merge_join as mj
+import dbsnp_snapshot as snap
+import annotation_cache as ac
+import vcf_io as vio
+import s3_stream as s3
+import metrics as mt
 
+# Get configuration
+from configparser import ConfigParser, ExtendedInterpolation
 
-def run(infile, format):
+base_dir = os.path.abspath(os.path.dirname(__file__))
+
+config = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
+config.read(os.path.join(base_dir, "annotator_config.ini"))
+
+# Variants per batched dbSNP query; 0 queries dbSNP once per variant
+DBSNP_WINDOW = config.getint("ann", "DbSnpWindow", fallback=0)
+
+# Variants per batched BigRefGene query; 0 queries each variant's tiers
+# one by one
+BIGREFGENE_WINDOW = config.getint("ann", "BigRefGeneWindow", fallback=0)
+
+
+# Promoter classification in refGene reads cpgIslandExt from memory (when
+# its TableBackends entry is 'memory'), memoised per position as every
+# overlapping transcript asks again
+def cpg_islands():
+    if rb.backend_name("cpgIslandExt") == "memory":
+        return {
+            "cpgIndex": functools.partial(
+                rb.get_memo_index,
+                table="cpgIslandExt",
+                columns=ann.CPG_ISLAND_COLUMNS,
+            )
+        }
+    return {}
+
+
+# Stages joined against sorted extracts (see merge_join.py) when the
+# input VCF is coordinate-sorted
+MERGE_TABLES = [
+    t.strip() for t in config.get("ann", "MergeTables", fallback="").split(",")
+]
+EXTRACT_DIR = config.get(
+    "ann", "ExtractDir", fallback=os.path.join(base_dir, "extracts")
+)
+
+# Memory-mapped dbSNP snapshot (see dbsnp_snapshot.py), used when built
+DBSNP_SNAPSHOT_DIR = config.get(
+    "ann", "DbSnpSnapshotDir", fallback=os.path.join(base_dir, "dbsnp_snapshot")
+)
+
+
+"""Annotation stages, in the order they are applied
+
+Lookups only read CHROM/POS/REF/ALT unless a stage lists depends_on,
+so the others can run concurrently (StageThreads)
+"""
+STAGES = [
+    pl.Stage(
+        "dbSNP",
+        ann.lookupDbSnp,
+        ann.applyDbSnp,
+        ann.logDbSnp,
+        lookup_block=(
+            functools.partial(ann.lookupDbSnpBlock, window=DBSNP_WINDOW)
+            if DBSNP_WINDOW > 0
+            else None
+        ),
+        counter=ann.countDbSnp,
+        varclass="SNV",
+    ),
+    pl.Stage(
+        "BigRefGene",
+        ann.lookupBigRefGene,
+        ann.applyBigRefGene,
+        lookup_block=(
+            functools.partial(ann.lookupBigRefGeneBlock, window=BIGREFGENE_WINDOW)
+            if BIGREFGENE_WINDOW > 0
+            else None
+        ),
+        counter=ann.countBigRefGene,
+    ),
+    pl.Stage(
+        "refGene",
+        ann.lookupGenes,
+        ann.applyGenes,
+        ann.logGenes,
+        depends_on=["BigRefGene"],  # reads the positionType it adds to INFO
+        cache_key=ann.positionTypeOf,
+        resources=cpg_islands(),
+        table="refGene",
+        promoter_offset=500,
+    ),
+    pl.Stage(
+        "cytoBand",
+        ann.lookupCytoband,
+        log=ann.logOverlap,
+        table="cytoBand",
+    ),
+    pl.Stage(
+        "gadAll", ann.lookupGadAll, ann.applyGadAll, ann.logOverlap, table="gadAll"
+    ),
+    pl.Stage(
+        "gwasCatalog", ann.lookupGwasCatalog, log=ann.logOverlap, table="gwasCatalog"
+    ),
+    pl.Stage(
+        "miRNAsites",
+        ann.lookupMiRNA,
+        log=ann.logOverlap,
+        table="targetScanS",
+    ),
+    pl.Stage("hugo", ann.lookupHugo, log=ann.logOverlap, table="hugo"),
+    pl.Stage(
+        "dgv_Cnv",
+        ann.lookupCnvDatabase,
+        log=ann.logOverlap,
+        table="dgv_Cnv",
+    ),
+    pl.Stage(
+        "abParts_IG_T_CelReceptors",
+        ann.lookupCnvDatabase,
+        log=ann.logOverlap,
+        table="abParts_IG_T_CelReceptors",
+    ),
+    pl.Stage(
+        "mcCarroll_Cnv",
+        ann.lookupCnvDatabase,
+        log=ann.logOverlap,
+        table="mcCarroll_Cnv",
+    ),
+    pl.Stage(
+        "conrad_Cnv",
+        ann.lookupCnvDatabase,
+        log=ann.logOverlap,
+        table="conrad_Cnv",
+    ),
+    pl.Stage(
+        "genomicSuperDups",
+        ann.lookupGenomicSuperDups,
+        ann.applyGenomicSuperDups,
+        ann.logOverlap,
+        table="genomicSuperDups",
+    ),
+    pl.Stage(
+        "tfbsConsSites",
+        ann.lookupTfbsConsSites,
+        log=ann.logOverlap,
+        table="tfbsConsSites",
+    ),
+]
+
+
+"""Resolves the dbSNP stage against the memory-mapped snapshot when
+one has been built for its varclass
+"""
+
+
+def snapshot_stages(stages):
+    if not snap.exists(DBSNP_SNAPSHOT_DIR):
+        return stages
+
+    return [
+        (
+            s.using(
+                snapshot=functools.partial(snap.open_snapshot, path=DBSNP_SNAPSHOT_DIR)
+            )
+            if s.name == "dbSNP" and s.options.get("varclass") == "SNV"
+            else s
+        )
+        for s in stages
+    ]
+
+
+"""Swaps the per-variant queries of the MERGE_TABLES stages for a
+sort-merge join when 'infile' is sorted and the extracts exist;
+unsorted input keeps the per-variant lookups
+"""
+
+
+def merge_stages(infile, format, stages):
+    merged = [
+        s.name
+        for s in stages
+        if s.name in MERGE_TABLES
+        and rb.backend_name(s.options.get("table", s.name)) != "memory"
+        and "snapshot" not in s.resources
+        and os.path.exists(mj.extract_path(EXTRACT_DIR, s.name))
+    ]
+    if len(merged) == 0 or not mj.is_sorted(infile, format=format):
+        return stages
+
+    print(f"Sort-merge join: {', '.join(merged)}")
+    return [
+        (
+            s.using(
+                index=functools.partial(
+                    mj.open_extract, path=mj.extract_path(EXTRACT_DIR, s.name)
+                )
+            )
+            if s.name in merged
+            else s
+        )
+        for s in stages
+    ]
+
+
+"""Fingerprint of the reference data the stages read, so the annotation
+cache drops its entries when any of it changes: ReferenceRelease, the
+reference database (the ReferenceDb file, or the RDS host) and the
+TableBackends that read tables from elsewhere
+"""
+
+
+def reference_fingerprint():
+    source = "\n".join(
+        [config.get("ann", "ReferenceRelease"), dbp.identity(), rb.identity()]
+    )
+    return hashlib.sha1(source.encode()).hexdigest()[:16]
+
+
+"""Opener for the cross-job annotation cache, or None when it is off
+"""
+
+
+def annotation_cache():
+    if not config.getboolean("ann", "AnnotationCache", fallback=False):
+        return None
+
+    return functools.partial(
+        ac.AnnotationCache,
+        config.get(
+            "ann", "CacheFile", fallback=os.path.join(base_dir, "annotation_cache.db")
+        ),
+        reference_fingerprint(),
+        max_entries=config.getint("ann", "CacheMaxEntries", fallback=1000000),
+        ttl=config.getint("ann", "CacheTtl", fallback=30 * 24 * 3600),
+    )
+
+
+"""Whether to write the annotated VCF as BGZF (.annot.vcf.gz)
+
+CompressOutput: 'on', 'off', or 'auto' to compress only when the input
+was uploaded gzipped
+"""
+
+
+def compress_output(infile):
+    setting = config.get("ann", "CompressOutput", fallback="off").lower()
+    if setting == "auto":
+        return vio.is_gzipped(infile)
+    return setting in ["on", "true", "yes", "1"]
+
+
+"""Whether to tabix index a compressed result (.annot.vcf.gz.tbi); only
+coordinate-sorted results can be indexed
+"""
+
+
+def index_output():
+    return config.getboolean("ann", "IndexOutput", fallback=False)
+
+
+"""Path of the count log written for 'infile'
+"""
+
+
+def count_log(infile):
+    return vio.base_name(infile) + ".count.log"
+
+
+"""Path of the per-stage metrics report written for 'infile'
+"""
+
+
+def metrics_path(infile):
+    return vio.base_name(infile) + ".metrics.json"
+
+
+"""Writes the per-stage metrics report (see metrics.py) for a run
+"""
+
+
+def write_metrics(infile, source, mode, finalout, start, cpu):
+    if source is not None:
+        bytes_read = s3.object_size(source)
+    else:
+        bytes_read = os.path.getsize(infile)
+    written = [finalout, finalout + ".tbi", count_log(infile)]
+
+    report = mt.report(
+        [stage.name for stage in STAGES],
+        time.time() - start,
+        mt.cpu_time() - cpu,
+        mode=mode,
+        bytes_read=bytes_read,
+        bytes_written=sum([os.path.getsize(p) for p in written if os.path.exists(p)]),
+    )
+    fh = open(metrics_path(infile), "w")
+    json.dump(report, fh, indent=2)
+    fh.close()
+
+
+"""Picks the stage variants (snapshot, sort-merge join) for one input
+file; module-level so parallel mode can hand it to worker processes
+"""
+
+
+def route_stages(infile, stages):
+    return merge_stages(infile, "vcf", snapshot_stages(stages))
+
+
+"""Rejects a DbPoolSize smaller than the connections a fused run holds
+at once (pipeline.connections_needed), which would leave the run
+waiting on itself
+"""
+
+
+def check_pool_size(threads, inflight):
+    needed = pl.connections_needed(threads, inflight)
+    size = dbp.get_pool().max_size
+    if size < needed:
+        raise ValueError(
+            f"DbPoolSize = {size} is too small for StageThreads = {threads} "
+            f"and QueryInflight = {inflight}: a run holds up to {needed} "
+            f"connections"
+        )
+
+
+"""Loads, ahead of any job, the reference data every job of this process
+(and every process forked from it) would otherwise load itself: the
+tables with a memory backend, and the interval indexes the stages'
+overlap lookups use on them (ref_index.INDEXABLE_TABLES), including the
+cpgIslandExt one behind cpg_islands(). The pooled connection used is
+closed again, so forked jobs open their own.
+"""
+
+
+def warm():
+    check_pool_size(
+        config.getint("ann", "StageThreads", fallback=1),
+        config.getint("ann", "QueryInflight", fallback=1),
+    )
+    with dbp.connection() as conn:
+        cursor = conn.cursor()
+        for table in rb.TABLE_BACKENDS:
+            if rb.backend_name(table) != "memory":
+                continue
+            names = [table]
+            if table == "tfbsConsSites":
+                names = [table + chrom for chrom in ann.allowed_chrom]
+            for name in names:
+                backend = rb.for_table(name, cursor)
+                if table in ri.INDEXABLE_TABLES:
+                    backend.interval_index(*ri.INDEXABLE_TABLES[table], pad=0)
+    dbp.get_pool().close()
+
+
+"""Runs the annotation pipeline on 'infile'
+
+mode: 'fused' (default) reads and writes the VCF once;
+'parallel' runs the fused chain over chromosome/block shards of the
+input in a pool of Workers processes;
+'multipass' runs each stage over the whole file and keeps one
+intermediate file per stage, which is handy for debugging
+inflight: per-record queries kept in flight per stage in fused and
+parallel mode (1 = one at a time); defaults to QueryInflight
+
+'infile' may be gzipped (.vcf.gz); the count log is named after it
+without the .gz. Returns the path of the annotated VCF; its tabix
+index, when one was written, is that path + '.tbi'
+source: where to read the input from when it is not at 'infile' (an
+s3:// URI); outputs are still named after 'infile'. Streamed input is
+not checked for sort order up front, so it skips the sort-merge join;
+multipass mode downloads it to 'infile' first
+upload: optional s3:// prefix the results are uploaded under, named
+as locally; the annotated VCF is streamed up while it is written
+(except in multipass mode), then the count log and index are uploaded
+concurrently
+"""
+
+
+def run(infile, format, mode=None, inflight=None, source=None, upload=None):
+
+    if mode is None:
+        mode = config.get("ann", "PipelineMode", fallback="fused")
+    if inflight is None:
+        inflight = config.getint("ann", "QueryInflight", fallback=1)
 
     print("Running . . .")
+    mt.reset()
+    start = time.time()
+    cpu = mt.cpu_time()
+
+    block_size = config.getint("ann", "BlockSize", fallback=1000)
+    threads = config.getint("ann", "StageThreads", fallback=1)
+    check_pool_size(threads, int(inflight))
+    if source is not None and mode == "multipass":
+        s3.download(source, infile)
+        source = None
+
+    compress = compress_output(source or infile)
+    index = compress and index_output()
+    outfile = vio.base_name(infile) + ".annot"
+    finalout = outfile.replace(".vcf.annot", ".annot.vcf")
+    if compress:
+        finalout = finalout + ".gz"
+
+    result_uri = None
+    if upload is not None and mode != "multipass":
+        result_uri = upload.rstrip("/") + "/" + os.path.basename(finalout)
+
+    if mode == "multipass":
+        run_multipass(infile, format)
+        if compress:
+            vio.compress_file(outfile, index=index)
+    elif mode == "parallel":
+        pl.run_parallel(
+            infile,
+            outfile,
+            STAGES,
+            route=route_stages,
+            format="vcf",
+            block_size=block_size,
+            shard_size=config.getint("ann", "ShardSize", fallback=100000),
+            workers=config.getint("ann", "Workers", fallback=0) or None,
+            threads=threads,
+            cache=annotation_cache(),
+            inflight=int(inflight),
+            compress=compress,
+            index=index,
+            source=source,
+            upload=result_uri,
+        )
+        print("Parallel pipeline - done.")
+    else:
+        pl.run_fused(
+            infile,
+            outfile,
+            (
+                route_stages(infile, STAGES)
+                if source is None
+                else snapshot_stages(STAGES)
+            ),
+            format="vcf",
+            block_size=block_size,
+            threads=threads,
+            cache=annotation_cache(),
+            inflight=int(inflight),
+            compress=compress,
+            index=index,
+            source=source,
+            upload=result_uri,
+        )
+        print("Fused pipeline - done.")
+
+    os.rename(outfile, finalout)
+    if os.path.exists(outfile + ".tbi"):
+        os.rename(outfile + ".tbi", finalout + ".tbi")
+    elif index:
+        print("Result not indexed: records are not coordinate-sorted")
+
+    if config.getboolean("ann", "Metrics", fallback=False):
+        write_metrics(infile, source, mode, finalout, start, cpu)
+
+    if upload is not None:
+        files = [count_log(infile), metrics_path(infile), finalout + ".tbi"]
+        if result_uri is None:
+            files.append(finalout)
+        s3.upload_files(
+            [
+                (path, upload.rstrip("/") + "/" + os.path.basename(path))
+                for path in files
+                if os.path.exists(path)
+            ]
+        )
+        print("Results uploaded.")
+
+    print(f"Reference DB connections: {dbp.stats()}")
+    return finalout
 
-    ann.getSnpsFromDbSnp(vcf=infile, format="vcf", tmpextin="", tmpextout=".1")
+
+"""Runs each stage over the whole file in turn
+
+A gzipped input is decompressed next to it first (the per-stage files
+are plain text), or in place when its name has no .gz; the decompressed
+copy is removed at the end.
+"""
+
+
+def run_multipass(infile, format):
+
+    source = infile
+    if vio.is_gzipped(infile):
+        infile = vio.base_name(infile)
+        if infile == source:
+            # No .gz to drop: decompress in place so the names still match
+            vio.decompress(source, infile + ".gunzip")
+            os.replace(infile + ".gunzip", infile)
+        else:
+            vio.decompress(source, infile)
+
+    with mt.scope("dbSNP"):
+        ann.getSnpsFromDbSnp(
+            vcf=infile, format="vcf", tmpextin="", tmpextout=".1", window=DBSNP_WINDOW
+        )
     print("dbSNP - done.")
     tmpextin = 1
     tmpextout = 2
 
-    ann.getBigRefGene(
-        vcf=infile,
-        format="vcf",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
+    with mt.scope("BigRefGene"):
+        ann.getBigRefGene(
+            vcf=infile,
+            format="vcf",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+            window=BIGREFGENE_WINDOW,
+        )
     print("BigRefGene - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.getGenes(
-        vcf=infile,
-        format="vcf",
-        table="refGene",
-        promoter_offset=500,
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
+    cpgIndex = None
+    if rb.backend_name("cpgIslandExt") == "memory":
+        with dbp.connection() as conn:
+            cpgIndex = rb.get_memo_index(
+                conn.cursor(), "cpgIslandExt", columns=ann.CPG_ISLAND_COLUMNS
+            )
+
+    with mt.scope("refGene"):
+        ann.getGenes(
+            vcf=infile,
+            format="vcf",
+            table="refGene",
+            promoter_offset=500,
+            cpgIndex=cpgIndex,
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
     print("BigRefGene - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWithCytoband(
-        vcf=infile,
-        format="vcf",
-        table="cytoBand",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
+    with mt.scope("cytoBand"):
+        ann.addOverlapWithCytoband(
+            vcf=infile,
+            format="vcf",
+            table="cytoBand",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
     print("Cytoband - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWithGadAll(
-        vcf=infile,
-        format="vcf",
-        table="gadAll",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
+    with mt.scope("gadAll"):
+        ann.addOverlapWithGadAll(
+            vcf=infile,
+            format="vcf",
+            table="gadAll",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
     print("gadAll - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWithGwasCatalog(
-        vcf=infile,
-        format="vcf",
-        table="gwasCatalog",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
+    with mt.scope("gwasCatalog"):
+        ann.addOverlapWithGwasCatalog(
+            vcf=infile,
+            format="vcf",
+            table="gwasCatalog",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
     print("GwasCatalog - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWithMiRNA(
-        vcf=infile,
-        format="vcf",
-        table="targetScanS",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
+    with mt.scope("miRNAsites"):
+        ann.addOverlapWithMiRNA(
+            vcf=infile,
+            format="vcf",
+            table="targetScanS",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
     print("miRNA - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWitHUGOGeneNomenclature(
-        vcf=infile,
-        format="vcf",
-        table="hugo",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
+    with mt.scope("hugo"):
+        ann.addOverlapWitHUGOGeneNomenclature(
+            vcf=infile,
+            format="vcf",
+            table="hugo",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
     print("HUGO Gene Nomenclature Committee - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="dgv_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
+    with mt.scope("dgv_Cnv"):
+        ann.addOverlapWithCnvDatabase(
+            vcf=infile,
+            format="vcf",
+            table="dgv_Cnv",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
     print("dgv_Cnv - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="abParts_IG_T_CelReceptors",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
+    with mt.scope("abParts_IG_T_CelReceptors"):
+        ann.addOverlapWithCnvDatabase(
+            vcf=infile,
+            format="vcf",
+            table="abParts_IG_T_CelReceptors",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
     print("abParts_IG_T_CelReceptors - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="mcCarroll_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
+    with mt.scope("mcCarroll_Cnv"):
+        ann.addOverlapWithCnvDatabase(
+            vcf=infile,
+            format="vcf",
+            table="mcCarroll_Cnv",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
     print("mcCarroll_Cnv - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="conrad_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
+    with mt.scope("conrad_Cnv"):
+        ann.addOverlapWithCnvDatabase(
+            vcf=infile,
+            format="vcf",
+            table="conrad_Cnv",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
     print("conrad_Cnv - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWithGenomicSuperDups(
-        vcf=infile,
-        format="vcf",
-        table="genomicSuperDups",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
+    with mt.scope("genomicSuperDups"):
+        ann.addOverlapWithGenomicSuperDups(
+            vcf=infile,
+            format="vcf",
+            table="genomicSuperDups",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
     print("genomicSuperDups - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWithTfbsConsSites(
-        vcf=infile,
-        table="tfbsConsSites",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
+    with mt.scope("tfbsConsSites"):
+        ann.addOverlapWithTfbsConsSites(
+            vcf=infile,
+            table="tfbsConsSites",
+            tmpextin="." + str(tmpextin),
+            tmpextout="." + str(tmpextout),
+        )
     print("addOverlapWithTfbsConsSites - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
@@ -172,8 +701,18 @@ def run(infile, format):
         fu.delete(infile + "." + str(i))
 
     os.rename(infile + "." + str(tmpextin), infile + ".annot")
-    finalout = (infile + ".annot").replace(".vcf.annot", ".annot.vcf")
-    os.rename(infile + ".annot", finalout)
+    if infile != source:
+        fu.delete(infile)
+
+    # Every stage saw every record
+    records = 0
+    fh = open(infile + ".annot")
+    for line in fh:
+        if not ann.isCommentLine(line.strip()):
+            records = records + 1
+    fh.close()
+    for stage in STAGES:
+        mt.add(stage.name, variants=records)
 
 
 ### EOF
@@ -98,6 +98,18 @@ def fileSize(filename):
     return int(os.path.getsize(filename))
 
 
+"""Path, size and modification time of a file (just the path if it does
+not exist), which change when the file is rebuilt
+"""
+
+
+def fileIdentity(filename):
+    if not isExist(filename):
+        return filename
+    st = os.stat(filename)
+    return f"{os.path.abspath(filename)}:{st.st_size}:{int(st.st_mtime)}"
+
+
 def delete(filename):
     if os.path.exists(filename) and os.path.isfile(filename):
         os.unlink(filename)
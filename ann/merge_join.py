@@ -0,0 +1,292 @@
+# merge_join.py
+#
+# Sort-merge join of a coordinate-sorted VCF against sorted
+# reference extracts
+#
+# An extract is a tab-separated dump of one reference table, grouped
+# by chromosome and sorted by start, with a JSON sidecar (<extract>.idx)
+# holding the byte offset of each chromosome. A SortedExtract walks it
+# in step with the VCF, keeping only the intervals that can still
+# overlap the current position, so each stage becomes a linear scan
+# instead of one query per variant.
+#
+# Build the extracts with:
+#   python merge_join.py <extract_dir> [name ...]
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import sys
+import json
+import heapq
+import pymysql
+import annotate as ann
+import db_pool as dbp
+import vcf_io as vio
+
+"""Queries used to build each extract
+
+Every query returns chrom, start, end (inclusive bounds, matching the
+stage's per-variant query) followed by the row the stage reads. Rows
+are numbered in table order and sorted by chrom, start and that number
+(dump_extract), so a variant gets its matches by start and then in
+table order, as from the per-variant query. The refGene window bakes
+in the default promoter_offset of 500; dbSNP is dumped for varclass
+SNV only and carries REF ahead of the row so the lookup can filter on
+it.
+"""
+EXTRACTS = {
+    "dbSNP": ["select CHR, POS, POS, REF, dbSNP.* from dbSNP " + 'where INFO = "SNV";'],
+    "refGene": ["select chrom, txStart - 500, txEnd + 500, refGene.* from refGene;"],
+    "cytoBand": ["select chrom, chromStart, chromEnd, cytoBand.* from cytoBand;"],
+    "gadAll": ["select chromosome, chromStart, chromEnd, gadAll.* from gadAll;"],
+    "gwasCatalog": [
+        "select chrom, chromEnd, chromEnd, gwasCatalog.* from gwasCatalog;"
+    ],
+    "hugo": ["select chrom, chromStart, chromEnd, hugo.* from hugo;"],
+    "tfbsConsSites": [
+        'select "chr'
+        + c
+        + '", chromStart, chromEnd, chrom, chromStart, chromEnd, name '
+        + "from tfbsConsSites"
+        + c
+        + ";"
+        for c in ann.allowed_chrom
+    ],
+}
+
+
+class UnsortedInput(Exception):
+    pass
+
+
+"""Extract rows are tab-separated, with MySQL-style escapes
+"""
+
+
+def encode_value(value):
+    if value is None:
+        return "\\N"
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+
+def decode_value(text):
+    if text == "\\N":
+        return None
+    if "\\" not in text:
+        return text
+
+    out = []
+    i = 0
+    while i < len(text):
+        if text[i] == "\\" and i + 1 < len(text):
+            out.append({"t": "\t", "n": "\n"}.get(text[i + 1], text[i + 1]))
+            i = i + 2
+        else:
+            out.append(text[i])
+            i = i + 1
+    return "".join(out)
+
+
+def extract_path(extract_dir, name):
+    return os.path.join(extract_dir, name + ".tsv")
+
+
+def sort_key(line):
+    chrom, start, end, ordinal = line.split("\t", 4)[:4]
+    return (chrom, int(start), int(ordinal))
+
+
+def write_run(lines, path):
+    lines.sort(key=sort_key)
+    fh = open(path, "w")
+    fh.writelines(lines)
+    fh.close()
+
+
+"""Dumps one extract
+
+Rows are streamed from an unbuffered cursor and sorted in runs of
+'run_size' lines that are spilled to disk and merged, so neither the
+table nor the extract is ever held in memory. Each line is
+chrom, start, end, table ordinal, row.
+"""
+
+
+def dump_extract(conn, name, path, batch=10000, run_size=500000):
+    runs = []
+    lines = []
+    ordinal = 0
+    for sql in EXTRACTS[name]:
+        cursor = conn.cursor(pymysql.cursors.SSCursor)
+        cursor.execute(sql)
+        rows = cursor.fetchmany(batch)
+        while len(rows) > 0:
+            for row in rows:
+                values = [encode_value(v) for v in row]
+                values.insert(3, str(ordinal))
+                lines.append("\t".join(values) + "\n")
+                ordinal = ordinal + 1
+            if len(lines) >= run_size:
+                runs.append(path + ".run" + str(len(runs)))
+                write_run(lines, runs[-1])
+                lines = []
+            rows = cursor.fetchmany(batch)
+        cursor.close()
+    runs.append(path + ".run" + str(len(runs)))
+    write_run(lines, runs[-1])
+    lines = []
+
+    fh_runs = [open(run) for run in runs]
+    fh = open(path, "wb")
+    offsets = {}
+    for line in heapq.merge(*fh_runs, key=sort_key):
+        chrom = line.split("\t", 1)[0]
+        if chrom not in offsets:
+            offsets[chrom] = fh.tell()
+        fh.write(line.encode("utf-8"))
+    fh.close()
+    for fh_run, run in zip(fh_runs, runs):
+        fh_run.close()
+        os.remove(run)
+
+    fh_idx = open(path + ".idx", "w")
+    json.dump(offsets, fh_idx)
+    fh_idx.close()
+
+
+"""Streams one extract in step with a sorted VCF
+
+overlapping(chrom, pos) must be called with each chromosome in one
+contiguous run and non-decreasing positions within it; otherwise
+UnsortedInput is raised. Memory is bounded by the number of intervals
+overlapping the current position. Matches are returned by start and
+then in table order, like IntervalIndex and the reference backends,
+so the stages can use any of them.
+"""
+
+
+class SortedExtract(object):
+    def __init__(self, path):
+        fh_idx = open(path + ".idx")
+        self.offsets = json.load(fh_idx)
+        fh_idx.close()
+        self.fh = open(path, "rb")
+        self.chrom = None
+        self.seen = set()
+        self.pending = None
+        self.active = []
+        self.last_pos = None
+
+    def _next(self):
+        line = self.fh.readline()
+        if not line:
+            return None
+        row = [decode_value(v) for v in line.decode("utf-8").rstrip("\n").split("\t")]
+        if row[0] != self.chrom:
+            return None
+        return (int(row[1]), int(row[2]), int(row[3]), tuple(row[4:]))
+
+    def _seek(self, chrom):
+        if chrom in self.seen:
+            raise UnsortedInput(f"chromosome {chrom} is not contiguous")
+        self.seen.add(chrom)
+        self.chrom = chrom
+        self.active = []
+        self.last_pos = None
+        self.pending = None
+        if chrom in self.offsets:
+            self.fh.seek(self.offsets[chrom])
+            self.pending = self._next()
+
+    def overlapping(self, chrom, pos):
+        chrom = str(chrom)
+        pos = int(pos)
+        if chrom != self.chrom:
+            self._seek(chrom)
+        elif pos < self.last_pos:
+            raise UnsortedInput(f"{chrom}:{pos} follows {chrom}:{self.last_pos}")
+        self.last_pos = pos
+
+        # Admit every interval that starts at or before pos
+        while self.pending is not None and self.pending[0] <= pos:
+            start, end, ordinal, row = self.pending
+            heapq.heappush(self.active, (end, start, ordinal, row))
+            self.pending = self._next()
+
+        # Retire the ones that end before it
+        while len(self.active) > 0 and self.active[0][0] < pos:
+            heapq.heappop(self.active)
+
+        return [a[3] for a in sorted(self.active, key=lambda a: (a[1], a[2]))]
+
+    def first(self, chrom, pos):
+        hits = self.overlapping(chrom, pos)
+        if len(hits) > 0:
+            return hits[0]
+        return None
+
+    def close(self):
+        self.fh.close()
+
+
+"""Resource loader for pipeline.Stage: a fresh reader for every run
+"""
+
+
+def open_extract(cursor, path):
+    return SortedExtract(path)
+
+
+"""True when every chromosome of the VCF is one contiguous run
+with non-decreasing positions
+"""
+
+
+def is_sorted(vcf, format="vcf", sep="\t"):
+    inds = ann.getFormatSpecificIndices(format=format)
+    seen = set()
+    chrom = None
+    last_pos = 0
+    fh = vio.open_vcf(vcf)
+    for line in fh:
+        if line.startswith("#"):
+            continue
+        fields = line.strip().split(sep)
+        c = fields[inds[0]].strip().replace("chr", "")
+        pos = int(fields[inds[1]].strip())
+        if c != chrom:
+            if c in seen:
+                fh.close()
+                return False
+            seen.add(c)
+            chrom = c
+        elif pos < last_pos:
+            fh.close()
+            return False
+        last_pos = pos
+    fh.close()
+    return True
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2:
+        print("Usage: python merge_join.py <extract_dir> [name ...]")
+        sys.exit(1)
+
+    extract_dir = sys.argv[1]
+    names = sys.argv[2:] if len(sys.argv) > 2 else list(EXTRACTS.keys())
+    os.makedirs(extract_dir, exist_ok=True)
+
+    with dbp.connection() as conn:
+        for name in names:
+            dump_extract(conn, name, extract_path(extract_dir, name))
+            print(f"{name} - done.")
+
+### EOF
@@ -0,0 +1,202 @@
+# metrics.py
+#
+# Per-stage timing and throughput instrumentation
+#
+# Work is attributed to the stage running on the current thread (see
+# scope()), so concurrent stages and in-flight query threads each land
+# in their own stage. Pooled connections hand out timed cursors that
+# count SQL queries and the time spent in execute()/fetch*() for that
+# stage. driver.run turns the totals into a JSON report written next
+# to the count log.
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import time
+import resource
+import threading
+import contextlib
+from collections import Counter
+
+FIELDS = ["wall_seconds", "cpu_seconds", "variants", "queries", "db_seconds"]
+
+# Work done outside any stage (index loads, extracts, setup queries)
+OTHER = "other"
+
+_stats = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def add(stage, **values):
+    with _lock:
+        _stats.setdefault(stage, Counter()).update(values)
+
+
+def snapshot():
+    with _lock:
+        return dict((stage, dict(values)) for stage, values in _stats.items())
+
+
+"""Adds the snapshots of other processes (parallel mode shards)
+"""
+
+
+def merge(snapshots):
+    for snap in snapshots:
+        for stage, values in snap.items():
+            add(stage, **values)
+
+
+def current():
+    return getattr(_local, "stage", None) or OTHER
+
+
+"""Attributes the work done on this thread to 'stage' until exit
+
+The thread's CPU time is always recorded; 'wall' is off for helper
+threads whose wall time the stage's own thread already covers.
+"""
+
+
+@contextlib.contextmanager
+def scope(stage, wall=True):
+    previous = getattr(_local, "stage", None)
+    _local.stage = stage
+    start = time.time()
+    cpu = time.thread_time()
+    try:
+        yield
+    finally:
+        values = {"cpu_seconds": time.thread_time() - cpu}
+        if wall:
+            values["wall_seconds"] = time.time() - start
+        add(stage, **values)
+        _local.stage = previous
+
+
+"""Cursor wrapper counting queries and database time for the current
+stage; everything else is passed through
+"""
+
+
+class TimedCursor(object):
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def timed(self, method, *args, **kwargs):
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            add(current(), db_seconds=time.time() - start)
+
+    def execute(self, *args, **kwargs):
+        add(current(), queries=1)
+        return self.timed(self.cursor.execute, *args, **kwargs)
+
+    def fetchall(self):
+        return self.timed(self.cursor.fetchall)
+
+    def fetchone(self):
+        return self.timed(self.cursor.fetchone)
+
+    def fetchmany(self, *args, **kwargs):
+        return self.timed(self.cursor.fetchmany, *args, **kwargs)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+"""Connection wrapper whose cursors are TimedCursors
+"""
+
+
+class TimedConnection(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self, *args, **kwargs):
+        return TimedCursor(self.conn.cursor(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+"""Peak resident set size in KiB of this process and of its largest
+waited-for child (parallel mode workers)
+"""
+
+
+def peak_rss():
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+"""CPU seconds used by this process and its waited-for children
+"""
+
+
+def cpu_time():
+    total = 0.0
+    for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+        usage = resource.getrusage(who)
+        total = total + usage.ru_utime + usage.ru_stime
+    return total
+
+
+def rate(variants, seconds):
+    return round(variants / seconds, 1) if seconds > 0 else None
+
+
+"""Builds the report for one run from the recorded stage totals
+
+'stages' gives the report order; work outside them is reported as
+'other'. Every stage sees every record, so the job's variant count is
+the largest stage count.
+"""
+
+
+def report(stages, wall, cpu, **extra):
+    stats = snapshot()
+    rows = []
+    for name in stages + [OTHER]:
+        values = stats.get(name, {})
+        if name == OTHER and len(values) == 0:
+            continue
+        row = {"name": name}
+        for field in FIELDS:
+            row[field] = round(values.get(field, 0), 4)
+        row["variants_per_second"] = rate(row["variants"], row["wall_seconds"])
+        rows.append(row)
+
+    variants = max([row["variants"] for row in rows] + [0])
+    rss, children_rss = peak_rss()
+    job = {
+        "wall_seconds": round(wall, 4),
+        "cpu_seconds": round(cpu, 4),
+        "variants": variants,
+        "variants_per_second": rate(variants, wall),
+        "queries": sum([row["queries"] for row in rows]),
+        "db_seconds": round(sum([row["db_seconds"] for row in rows]), 4),
+        "peak_rss_kb": rss,
+        "peak_rss_children_kb": children_rss,
+    }
+    job.update(extra)
+    job["stages"] = rows
+    return job
+
+
+### EOF
@@ -0,0 +1,539 @@
+# pipeline.py
+#
+# Fused annotation pipeline: every variant is parsed once, passed
+# through each annotation stage in memory and written once
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import copy
+import shutil
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import annotate as ann
+import db_pool as dbp
+import query_layer as ql
+import metrics as mt
+import vcf_io as vio
+
+"""One annotation stage of the pipeline
+
+name: label used for the count log (and to key the stage counters)
+lookup/apply/log: the stage functions from annotate.py
+lookup_block: optional batched lookup for a whole block of records,
+  used instead of calling lookup once per record
+resources: option name -> loader(cursor), for in-memory data such as
+  reference indexes; loaded by prepare() and passed to lookup as options,
+  and closed by release() when they have a close() method
+depends_on: names of earlier stages whose annotations this stage's
+  lookup reads; any other stage's lookup may run concurrently with it
+cache_key: optional function(fields) -> str for any input besides
+  CHROM/POS/REF/ALT that the lookup reads, added to the cache key
+counter: optional function(annotation) -> Counter giving the counters
+  the lookup bumps for one record; with it, records that need counters
+  of their own (cache misses) still go through lookup_block
+options: extra keyword arguments passed through to lookup
+
+With an annotation cache (see annotation_cache.py) passed to prepare(),
+lookups are served from the cache where possible; the counters stored
+with each entry are replayed so the count log is unchanged. With a
+query layer (see query_layer.py), stages that query the database per
+record (no lookup_block, only thread-safe resources) keep several
+queries in flight.
+"""
+
+
+class Stage(object):
+    def __init__(
+        self,
+        name,
+        lookup,
+        apply=ann.appendInfo,
+        log=None,
+        lookup_block=None,
+        resources=None,
+        depends_on=None,
+        cache_key=None,
+        counter=None,
+        **options,
+    ):
+        self.name = name
+        self.lookup = lookup
+        self.apply = apply
+        self.log = log
+        self.lookup_block = lookup_block
+        self.resources = resources or {}
+        self.depends_on = depends_on or []
+        self.cache_key = cache_key
+        self.counter = counter
+        self.options = options
+        self.run_options = options
+        self.cache = None
+        self.layer = None
+
+    def prepare(self, cursor, cache=None, layer=None):
+        self.run_options = dict(self.options)
+        for name, load in self.resources.items():
+            self.run_options[name] = load(cursor)
+        self.cache = cache
+        # Stateful resources (e.g. a sort-merge extract) are not shared
+        # across threads
+        if all(
+            [
+                getattr(self.run_options[name], "thread_safe", False)
+                for name in self.resources
+            ]
+        ):
+            self.layer = layer
+
+    def release(self):
+        for name in self.resources:
+            resource = self.run_options.get(name)
+            if hasattr(resource, "close"):
+                resource.close()
+        self.run_options = self.options
+        self.cache = None
+        self.layer = None
+
+    def using(self, **resources):
+        # A copy of this stage with some resources swapped out
+        stage = copy.copy(self)
+        stage.resources = dict(self.resources, **resources)
+        return stage
+
+    def lookup_all(self, block, cursor, counts, inds):
+        with mt.scope(self.name):
+            mt.add(self.name, variants=len(block))
+            return self.run_lookups(block, cursor, counts, inds)
+
+    def run_lookups(self, block, cursor, counts, inds):
+        if self.cache is not None:
+            return self.lookup_cached(block, cursor, counts, inds)
+        if self.layer is not None and self.lookup_block is None:
+            annotations = []
+            for annotation, deltas in self.lookup_records(block, cursor, inds):
+                counts.update(deltas)
+                annotations.append(annotation)
+            return annotations
+        if self.lookup_block is not None:
+            return self.lookup_block(block, cursor, counts, inds, **self.run_options)
+        return [
+            self.lookup(fields, cursor, counts, inds, **self.run_options)
+            for fields in block
+        ]
+
+    def lookup_one(self, fields, cursor, counts, inds):
+        if self.lookup_block is not None:
+            return self.lookup_block(
+                [fields], cursor, counts, inds, **self.run_options
+            )[0]
+        return self.lookup(fields, cursor, counts, inds, **self.run_options)
+
+    def lookup_records(self, records, cursor, inds):
+        # One (annotation, counters) pair per record
+        if self.lookup_block is not None and self.counter is not None:
+            annotations = self.lookup_block(
+                records, cursor, Counter(), inds, **self.run_options
+            )
+            return [(a, self.counter(a)) for a in annotations]
+        if self.layer is not None:
+            return self.layer.lookup_records(self, records, inds)
+        results = []
+        for fields in records:
+            deltas = Counter()
+            results.append((self.lookup_one(fields, cursor, deltas, inds), deltas))
+        return results
+
+    def variant(self, fields, inds):
+        variant = [fields[i].strip() for i in inds[:4]]
+        if self.cache_key is not None:
+            variant.append(self.cache_key(fields))
+        return tuple(variant)
+
+    def lookup_cached(self, block, cursor, counts, inds):
+        # Each miss gets counters of its own, so it can be cached with them
+        variants = [self.variant(fields, inds) for fields in block]
+        hits = self.cache.get_many(self.name, variants)
+        missed = [
+            (fields, variant)
+            for fields, variant in zip(block, variants)
+            if variant not in hits
+        ]
+        results = self.lookup_records([m[0] for m in missed], cursor, inds)
+        misses = dict(
+            (variant, (annotation, dict(deltas)))
+            for (fields, variant), (annotation, deltas) in zip(missed, results)
+        )
+
+        annotations = []
+        for variant in variants:
+            if variant in hits:
+                annotation, deltas = hits[variant]
+                counts["cache_hits"] += 1
+            else:
+                annotation, deltas = misses[variant]
+                counts["cache_misses"] += 1
+            counts.update(deltas)
+            annotations.append(annotation)
+        self.cache.put_many(self.name, misses)
+        return annotations
+
+    def annotate(self, block, cursor, counts, inds):
+        annotations = self.lookup_all(block, cursor, counts, inds)
+        return self.apply_all(block, annotations)
+
+    def apply_all(self, block, annotations):
+        with mt.scope(self.name):
+            return [
+                self.apply(fields, annotation)
+                for fields, annotation in zip(block, annotations)
+            ]
+
+    def write_log(self, fh_log, counts):
+        if self.log is not None:
+            self.log(fh_log, counts, self.name)
+
+
+"""Reads a VCF as alternating runs of header lines and blocks of split records
+Yields (header_line, None) or (None, block); order in the file is preserved
+"""
+
+
+def read_blocks(fh, block_size=1000, sep="\t"):
+    block = []
+    for line in fh:
+        line = line.strip()
+        if ann.isCommentLine(line):
+            if block:
+                yield None, block
+                block = []
+            yield line, None
+        else:
+            block.append(line.split(sep))
+            if len(block) >= block_size:
+                yield None, block
+                block = []
+    if block:
+        yield None, block
+
+
+def write_block(fh_out, block):
+    fh_out.write(
+        "".join(["\t".join([str(x) for x in fields]) + "\n" for fields in block])
+    )
+
+
+"""Writes the count log in stage order, exactly as the per-file stages do
+"""
+
+
+def write_count_log(logfile, stages, counts):
+    fh_log = open(logfile, "w")
+    for stage in stages:
+        stage.write_log(fh_log, counts[stage.name])
+    for stage in stages:
+        hits = counts[stage.name]["cache_hits"]
+        misses = counts[stage.name]["cache_misses"]
+        if hits + misses > 0:
+            fh_log.write(
+                f"Annotation cache {stage.name}: {hits} hits, {misses} misses\n"
+            )
+    fh_log.close()
+
+
+def new_counts(stages):
+    return dict((stage.name, Counter()) for stage in stages)
+
+
+"""Runs one stage's lookups on a pooled connection of its own
+"""
+
+
+def lookup_task(stage, block, counts, inds):
+    with dbp.connection() as conn:
+        return stage.lookup_all(block, conn.cursor(), counts, inds)
+
+
+"""Annotates one block with all 'stages' using a thread pool
+
+Stages are a DAG through depends_on: every stage whose dependencies
+have been applied has its lookups run concurrently, then annotations
+are applied strictly in stage order, so the INFO keys come out exactly
+as from the sequential chain. Each stage only touches its own counters.
+"""
+
+
+def annotate_concurrently(block, stages, counts, inds, executor):
+    annotations = {}
+    applied = set()
+    next_apply = 0
+    while next_apply < len(stages):
+        wave = [
+            stage
+            for stage in stages
+            if stage.name not in annotations
+            and all([d in applied for d in stage.depends_on])
+        ]
+        futures = [
+            (
+                stage,
+                executor.submit(lookup_task, stage, block, counts[stage.name], inds),
+            )
+            for stage in wave
+        ]
+        for stage, future in futures:
+            annotations[stage.name] = future.result()
+
+        while next_apply < len(stages) and stages[next_apply].name in annotations:
+            stage = stages[next_apply]
+            block = stage.apply_all(block, annotations[stage.name])
+            applied.add(stage.name)
+            next_apply = next_apply + 1
+    return block
+
+
+"""Pooled connections run_fused holds at once: its own, one per stage
+thread and 'inflight' for the query layer
+"""
+
+
+def connections_needed(threads=1, inflight=1):
+    return 1 + (threads if threads > 1 else 0) + (inflight if inflight > 1 else 0)
+
+
+"""Annotates 'infile' with all 'stages' in a single pass and writes 'outfile'
+
+threads > 1 runs independent stage lookups concurrently on that many
+threads (see annotate_concurrently). 'cache' is an optional function
+opening the annotation cache for this run. inflight > 1 keeps that many
+per-record queries in flight (see query_layer.py). 'infile' may be
+gzipped; 'compress' writes 'outfile' as BGZF (see vcf_io.py) and
+'index' also writes its tabix index, outfile + '.tbi'. The input is
+read from 'source' (e.g. an s3:// URI, see s3_stream.py) when given;
+'infile' still names the count log. 'upload' (an s3:// URI) streams
+'outfile' to S3 while it is written. Returns the per-stage counters
+"""
+
+
+def run_fused(
+    infile,
+    outfile,
+    stages,
+    format="vcf",
+    block_size=1000,
+    threads=1,
+    cache=None,
+    inflight=1,
+    compress=False,
+    index=False,
+    source=None,
+    upload=None,
+):
+    inds = ann.getFormatSpecificIndices(format=format)
+    counts = new_counts(stages)
+
+    fh = vio.open_vcf(source or infile)
+    fh_out = vio.open_output(outfile, compress, index, upload)
+    executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+    opened = None
+    layer = None
+    try:
+        with dbp.connection() as conn:
+            cursor = conn.cursor()
+
+            if cache is not None:
+                opened = cache()
+            layer = ql.QueryLayer(inflight) if inflight > 1 else None
+            for stage in stages:
+                stage.prepare(cursor, opened, layer)
+
+            for header, block in read_blocks(fh, block_size=block_size):
+                if header is not None:
+                    fh_out.write(header + "\n")
+                    continue
+
+                if executor is not None:
+                    block = annotate_concurrently(block, stages, counts, inds, executor)
+                else:
+                    for stage in stages:
+                        block = stage.annotate(block, cursor, counts[stage.name], inds)
+                write_block(fh_out, block)
+    except Exception:
+        # No partial result object on S3 (see vcf_io.abort_output)
+        vio.abort_output(fh_out)
+        raise
+    finally:
+        # Also after a failure, so an in-process caller (driver.run, bench)
+        # gets its pooled connections back
+        if executor is not None:
+            executor.shutdown()
+        for stage in stages:
+            stage.release()
+        if layer is not None:
+            layer.close()
+        if opened is not None:
+            opened.close()
+        fh.close()
+
+    fh_out.close()
+
+    write_count_log(vio.base_name(infile) + ".count.log", stages, counts)
+    return counts
+
+
+"""Splits 'infile' into shard files under 'shard_dir', yielding each
+shard's path as soon as the shard is complete
+
+A new shard starts when the chromosome changes (once the current shard
+holds at least 'min_size' records, so interleaved input does not end up
+as one shard per record) or when it reaches 'shard_size' records, so a
+chr1-sized input is still spread over several workers. Header lines stay
+where they are; concatenating the shards gives back the input. Workers
+can start on the first shards while the input is still being read.
+"""
+
+
+def split_shards(infile, shard_dir, shard_size=100000, min_size=1000, sep="\t"):
+    os.makedirs(shard_dir, exist_ok=True)
+    shards = 0
+    fh_shard = None
+    chrom = None
+    count = 0
+
+    fh = vio.open_vcf(infile)
+    for line in fh:
+        record = not ann.isCommentLine(line.strip())
+        if record:
+            c = line.split(sep, 1)[0].strip()
+            if fh_shard is not None and (
+                count >= shard_size or (c != chrom and count >= min_size)
+            ):
+                fh_shard.close()
+                fh_shard = None
+                yield path
+            chrom = c
+
+        if fh_shard is None:
+            path = os.path.join(shard_dir, f"shard{shards:05d}.vcf")
+            fh_shard = open(path, "w")
+            shards = shards + 1
+            count = 0
+        fh_shard.write(line)
+        if record:
+            count = count + 1
+    fh.close()
+
+    if fh_shard is not None:
+        fh_shard.close()
+        yield path
+
+
+"""Annotates one shard in a worker process; returns its counters and
+the worker's stage metrics (see metrics.py)
+"""
+
+
+def run_shard(
+    path,
+    stages,
+    route=None,
+    format="vcf",
+    block_size=1000,
+    threads=1,
+    cache=None,
+    inflight=1,
+):
+    mt.reset()
+    if route is not None:
+        stages = route(path, stages)
+    counts = run_fused(
+        path, path + ".annot", stages, format, block_size, threads, cache, inflight
+    )
+    return counts, mt.snapshot()
+
+
+def merge_counts(stages, shard_counts):
+    counts = new_counts(stages)
+    for shard in shard_counts:
+        for name, counter in shard.items():
+            counts[name].update(counter)
+    return counts
+
+
+"""Annotates 'infile' shard by shard in a pool of 'workers' processes
+
+Each shard runs the whole fused chain; the annotated shards are
+concatenated in input order and the count log is written from the
+summed counters, so the output matches run_fused. 'route' (picklable,
+called as route(shard_path, stages)) picks the stage variants for each
+shard, e.g. a sort-merge join for a sorted shard; 'cache' must be
+picklable too, as every worker opens the cache itself. Shards are
+plain text; only the concatenated output is compressed. 'source'
+and 'upload' are as for run_fused.
+"""
+
+
+def run_parallel(
+    infile,
+    outfile,
+    stages,
+    route=None,
+    format="vcf",
+    block_size=1000,
+    shard_size=100000,
+    workers=None,
+    threads=1,
+    cache=None,
+    inflight=1,
+    compress=False,
+    index=False,
+    source=None,
+    upload=None,
+):
+    shard_dir = infile + ".shards"
+    paths = []
+    futures = []
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for path in split_shards(
+            source or infile, shard_dir, shard_size, min_size=block_size
+        ):
+            paths.append(path)
+            futures.append(
+                executor.submit(
+                    run_shard,
+                    path,
+                    stages,
+                    route,
+                    format,
+                    block_size,
+                    threads,
+                    cache,
+                    inflight,
+                )
+            )
+        results = [f.result() for f in futures]
+        counts = merge_counts(stages, [r[0] for r in results])
+        mt.merge([r[1] for r in results])
+
+    fh_out = vio.open_output(outfile, compress, index, upload)
+    try:
+        for path in paths:
+            fh_shard = open(path + ".annot")
+            shutil.copyfileobj(fh_shard, fh_out)
+            fh_shard.close()
+    except Exception:
+        vio.abort_output(fh_out)
+        raise
+    fh_out.close()
+    shutil.rmtree(shard_dir)
+
+    write_count_log(vio.base_name(infile) + ".count.log", stages, counts)
+    return counts
+
+
+### EOF
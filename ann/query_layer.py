@@ -0,0 +1,78 @@
+# query_layer.py
+#
+# Keeps several reference queries in flight per stage
+#
+# The lookups in annotate.py block on cursor.execute()/fetchall() one
+# variant at a time, so the database round trip dominates. A QueryLayer
+# holds 'inflight' pooled connections for the run and offloads the
+# per-variant lookups of a block onto that many threads, each with a
+# connection of its own; results come back in input order. Those
+# connections come on top of the ones run_fused holds (see
+# pipeline.connections_needed).
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import queue
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import db_pool as dbp
+import metrics as mt
+
+"""Bounded pool of in-flight lookups
+
+lookup_records() returns one (annotation, counters) pair per record,
+in the order of the records; each lookup gets a Counter of its own, so
+concurrent lookups never update the same counters.
+"""
+
+
+class QueryLayer(object):
+    def __init__(self, inflight=4):
+        self.inflight = inflight
+        self.pool = dbp.get_pool()
+        self.conns = []
+        try:
+            for i in range(inflight):
+                self.conns.append(self.pool.acquire())
+        except Exception:
+            for conn in self.conns:
+                self.pool.release(conn)
+            raise
+        self.cursors = queue.Queue()
+        for conn in self.conns:
+            self.cursors.put(conn.cursor())
+        self.executor = ThreadPoolExecutor(max_workers=inflight)
+        self.failed = False
+
+    def lookup_one(self, stage, fields, inds):
+        cursor = self.cursors.get()
+        try:
+            counts = Counter()
+            # The stage's own thread accounts for the wall time
+            with mt.scope(stage.name, wall=False):
+                return stage.lookup_one(fields, cursor, counts, inds), counts
+        except Exception:
+            self.failed = True
+            raise
+        finally:
+            self.cursors.put(cursor)
+
+    def lookup_records(self, stage, records, inds):
+        return list(
+            self.executor.map(
+                lambda fields: self.lookup_one(stage, fields, inds), records
+            )
+        )
+
+    def close(self):
+        self.executor.shutdown()
+        for conn in self.conns:
+            # A failed lookup may leave unread results on its connection
+            self.pool.release(conn, discard=self.failed)
+
+
+### EOF
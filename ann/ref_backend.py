@@ -0,0 +1,403 @@
+# ref_backend.py
+#
+# Where the annotation stages read each reference table from
+#
+# The stages ask for rows through a ReferenceBackend rather than
+# building SQL themselves: exact-match (column = value, or IN a list),
+# point (chromosome and position) and range-overlap (start <= pos <=
+# end) lookups. TableBackends in annotator_config.ini picks the backend
+# per table: 'mysql' (the default) queries the reference database over
+# the stage's pooled connection, 'sqlite' reads a local SQLite copy of
+# the table (LocalReferenceDb, see bench_refdb.py), and 'memory' loads
+# the table once per process into in-memory indexes.
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import time
+import sqlite3
+import itertools
+import threading
+
+import ref_index as ri
+import file_utils as fu
+import metrics as mt
+
+# Get configuration
+from configparser import ConfigParser, ExtendedInterpolation
+
+base_dir = os.path.abspath(os.path.dirname(__file__))
+
+config = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
+config.read(os.path.join(base_dir, "annotator_config.ini"))
+
+BACKENDS = ["mysql", "sqlite", "memory"]
+
+"""Parses 'table: backend, table: backend, ...'
+"""
+
+
+def parse_backends(setting):
+    backends = {}
+    for item in setting.split(","):
+        if item.strip() == "":
+            continue
+        table, _, backend = item.partition(":")
+        backend = backend.strip().lower()
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown reference backend '{backend}' for {table}")
+        backends[table.strip()] = backend
+    return backends
+
+
+TABLE_BACKENDS = parse_backends(config.get("ann", "TableBackends", fallback=""))
+
+LOCAL_REFERENCE_DB = config.get("ann", "LocalReferenceDb", fallback="")
+if LOCAL_REFERENCE_DB == "":
+    LOCAL_REFERENCE_DB = os.path.join(base_dir, "reference.db")
+
+"""Lookups a reference backend answers
+
+exact() and point() return the matching rows in table order, overlap()
+returns them by start and then in table order (the order a range scan
+of the table's (chrom, start) index gives). 'columns' are
+the columns to return (default: the whole row, 'table.*'); 'table.*'
+may also be listed among them. Values compare like MySQL's default
+collation, i.e. strings case-insensitively.
+"""
+
+
+class ReferenceBackend(object):
+    thread_safe = True
+
+    # Rows whose columns equal the given values; 'where' is a list of
+    # (column, value) and a value may be a list of alternatives
+    def exact(self, table, where, columns=None):
+        raise NotImplementedError
+
+    # Rows at one position (or any of a list of positions)
+    def point(self, table, chrom_col, chrom, pos_col, pos, columns=None):
+        where = [(pos_col, pos)]
+        if chrom_col is not None:
+            where.insert(0, (chrom_col, chrom))
+        return self.exact(table, where, columns)
+
+    # Rows with start - pad <= pos <= end + pad, for 'pos' or any of a
+    # list of positions; 'chrom_col' None for per-chromosome tables
+    def overlap(
+        self, table, chrom_col, chrom, start_col, end_col, pos, pad=0, columns=None
+    ):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+"""SQL lookups over a DB-API cursor
+"""
+
+
+class SqlBackend(ReferenceBackend):
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def quote(self, value):
+        if isinstance(value, int):
+            return str(value)
+        return '"' + str(value) + '"'
+
+    def equals(self, column, value):
+        if isinstance(value, list):
+            return column + " IN (" + ",".join([self.quote(v) for v in value]) + ")"
+        return column + "=" + self.quote(value)
+
+    def select(self, table, columns, conditions, order=None):
+        if columns is None:
+            columns = ["*"]
+        sql = (
+            "select "
+            + ", ".join(columns)
+            + " from "
+            + table
+            + " where "
+            + " AND ".join(conditions)
+            + ("" if order is None else " order by " + order)
+            + ";"
+        )
+        return self.query(sql)
+
+    def query(self, sql):
+        self.cursor.execute(sql)
+        return self.cursor.fetchall()
+
+    def exact(self, table, where, columns=None):
+        return self.select(
+            table, columns, [self.equals(column, value) for column, value in where]
+        )
+
+    def overlap(
+        self, table, chrom_col, chrom, start_col, end_col, pos, pad=0, columns=None
+    ):
+        if pad != 0:
+            start_col = "(" + start_col + " - " + str(pad) + ")"
+            end_col = "(" + end_col + " + " + str(pad) + ")"
+        ranges = [
+            "("
+            + start_col
+            + " <= "
+            + str(p)
+            + " AND "
+            + str(p)
+            + " <= "
+            + end_col
+            + ")"
+            for p in (pos if isinstance(pos, list) else [pos])
+        ]
+        conditions = ["(" + " OR ".join(ranges) + ")"]
+        if chrom_col is not None:
+            conditions.insert(0, self.equals(chrom_col, chrom))
+        return self.select(table, columns, conditions, order=start_col)
+
+
+"""The reference database (RDS MySQL, or the ReferenceDb stand-in) over
+the stage's pooled connection
+"""
+
+
+class MySqlBackend(SqlBackend):
+    pass
+
+
+"""A local SQLite copy of some reference tables
+
+Each thread gets its own connection (a forked process opens new ones).
+bench_refdb.py declares the columns COLLATE NOCASE, so strings compare
+case-insensitively, as in MySQL.
+"""
+
+
+class SqliteBackend(SqlBackend):
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Local reference database {path} not found")
+        self.path = path
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def quote(self, value):
+        if isinstance(value, int):
+            return str(value)
+        return "'" + str(value).replace("'", "''") + "'"
+
+    def query(self, sql):
+        # Counted like the pooled connections' queries (metrics.py)
+        start = time.time()
+        rows = tuple(self.connection().execute(sql).fetchall())
+        mt.add(mt.current(), queries=1, db_seconds=time.time() - start)
+        return rows
+
+    def close(self):
+        with self.lock:
+            connections = self.connections
+            self.connections = []
+        for conn in connections:
+            conn.close()
+        self.local = threading.local()
+
+
+"""A whole table held in memory
+
+Loaded once with 'select *'; exact matches use hash indexes and
+overlaps use ref_index interval indexes, each built on first use for
+the columns asked about. Interval index entries are (start, row
+number), so overlaps sort by start and then in table order.
+"""
+
+
+class MemoryBackend(ReferenceBackend):
+    def __init__(self, cursor, table):
+        cursor.execute("select * from " + table + ";")
+        self.table = table
+        self.rows = cursor.fetchall()
+        self.columns = [d[0] for d in cursor.description]
+        self.hashes = {}
+        self.intervals = {}
+        self.lock = threading.Lock()
+
+    def key(self, value):
+        return str(value).upper()
+
+    def project(self, row, columns):
+        if columns is None:
+            return row
+        values = []
+        for column in columns:
+            if column in ["*", self.table + ".*"]:
+                values.extend(row)
+            else:
+                values.append(row[self.columns.index(column)])
+        return tuple(values)
+
+    def hash_index(self, names):
+        with self.lock:
+            if names not in self.hashes:
+                positions = [self.columns.index(name) for name in names]
+                index = {}
+                for ordinal, row in enumerate(self.rows):
+                    key = tuple([self.key(row[p]) for p in positions])
+                    index.setdefault(key, []).append(ordinal)
+                self.hashes[names] = index
+            return self.hashes[names]
+
+    def interval_index(self, chrom_col, start_col, end_col, pad):
+        key = (chrom_col, start_col, end_col, pad)
+        with self.lock:
+            if key not in self.intervals:
+                chrom = None if chrom_col is None else self.columns.index(chrom_col)
+                start = self.columns.index(start_col)
+                end = self.columns.index(end_col)
+                self.intervals[key] = ri.IntervalIndex(
+                    [
+                        (
+                            "" if chrom is None else self.key(row[chrom]),
+                            int(row[start]) - pad,
+                            int(row[end]) + pad,
+                            (int(row[start]), ordinal),
+                        )
+                        for ordinal, row in enumerate(self.rows)
+                    ]
+                )
+            return self.intervals[key]
+
+    def exact(self, table, where, columns=None):
+        index = self.hash_index(tuple([column for column, value in where]))
+        alternatives = [v if isinstance(v, list) else [v] for column, v in where]
+        ordinals = set()
+        for values in itertools.product(*alternatives):
+            ordinals.update(index.get(tuple([self.key(v) for v in values]), []))
+        return [self.project(self.rows[i], columns) for i in sorted(ordinals)]
+
+    def overlap(
+        self, table, chrom_col, chrom, start_col, end_col, pos, pad=0, columns=None
+    ):
+        index = self.interval_index(chrom_col, start_col, end_col, pad)
+        chrom = "" if chrom_col is None else self.key(chrom)
+        hits = set()
+        for p in pos if isinstance(pos, list) else [pos]:
+            hits.update(index.overlapping(chrom, p))
+        return [self.project(self.rows[i], columns) for start, i in sorted(hits)]
+
+
+"""Where the tables are read from other than the reference database:
+the TableBackends setting, plus the LocalReferenceDb file when a table
+uses it
+"""
+
+
+def identity():
+    setting = ", ".join(
+        [f"{table}: {backend}" for table, backend in sorted(TABLE_BACKENDS.items())]
+    )
+    if "sqlite" in TABLE_BACKENDS.values():
+        setting = setting + "; " + fu.fileIdentity(LOCAL_REFERENCE_DB)
+    return setting
+
+
+_memory = {}
+_memory_lock = threading.Lock()
+_sqlite = None
+
+
+"""Configured backend of 'table' (tfbsConsSites1..Y go by
+tfbsConsSites)
+"""
+
+
+def backend_name(table):
+    if table.startswith("tfbsConsSites"):
+        table = "tfbsConsSites"
+    return TABLE_BACKENDS.get(table, "mysql")
+
+
+"""The backend to read 'table' from; 'cursor' is the stage's pooled
+cursor, used by the mysql backend and to load memory backends
+
+Memory backends and the SQLite backend are kept for the life of the
+process (a warm worker reuses them across jobs).
+"""
+
+
+def for_table(table, cursor):
+    global _sqlite
+
+    name = backend_name(table)
+    if name == "memory":
+        with _memory_lock:
+            if table not in _memory:
+                _memory[table] = MemoryBackend(cursor, table)
+            return _memory[table]
+    if name == "sqlite":
+        with _memory_lock:
+            if _sqlite is None:
+                _sqlite = SqliteBackend(LOCAL_REFERENCE_DB)
+            return _sqlite
+    return MySqlBackend(cursor)
+
+
+"""Overlap lookups of one table with fixed columns, in the shape of a
+ref_index.IntervalIndex
+"""
+
+
+class OverlapView(object):
+    thread_safe = True
+
+    def __init__(self, backend, table, columns=None):
+        self.backend = backend
+        self.table = table
+        self.chrom_col, self.start_col, self.end_col = ri.INDEXABLE_TABLES[table]
+        self.columns = columns
+
+    def overlapping(self, chrom, pos):
+        return self.backend.overlap(
+            self.table,
+            self.chrom_col,
+            chrom,
+            self.start_col,
+            self.end_col,
+            int(pos),
+            columns=self.columns,
+        )
+
+    def first(self, chrom, pos):
+        hits = self.overlapping(chrom, pos)
+        if len(hits) > 0:
+            return hits[0]
+        return None
+
+
+"""Resource loader for pipeline.Stage: overlap lookups on the backend
+of 'table' (its memory backend, when configured, so the table is held
+once per process) behind a memo of their own
+"""
+
+
+def get_memo_index(cursor, table, columns=None):
+    return ri.MemoIndex(OverlapView(for_table(table, cursor), table, columns))
+
+
+### EOF
@@ -0,0 +1,156 @@
+# ref_index.py
+#
+# In-memory interval indexes for the small reference tables, so
+# overlap checks do not need a round trip to the database
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import bisect
+
+"""Reference tables the stages look up by overlap, with their
+(chrom, start, end) columns; chrom is None for the per-chromosome
+tfbsConsSites tables
+"""
+INDEXABLE_TABLES = {
+    "cytoBand": ("chrom", "chromStart", "chromEnd"),
+    "dgv_Cnv": ("chrom", "chromStart", "chromEnd"),
+    "abParts_IG_T_CelReceptors": ("chrom", "chromStart", "chromEnd"),
+    "mcCarroll_Cnv": ("chrom", "chromStart", "chromEnd"),
+    "conrad_Cnv": ("chrom", "chromStart", "chromEnd"),
+    "genomicSuperDups": ("chrom", "chromStart", "chromEnd"),
+    "targetScanS": ("chrom", "chromStart", "chromEnd"),
+    "cpgIslandExt": ("chrom", "chromStart", "chromEnd"),
+    "gadAll": ("chromosome", "chromStart", "chromEnd"),
+    "hugo": ("chrom", "chromStart", "chromEnd"),
+    "chrom_pos_unequal": ("CHR", "start", "end"),
+    "tfbsConsSites": (None, "chromStart", "chromEnd"),
+}
+
+"""Per-chromosome interval index over the rows of one table
+
+Intervals are kept sorted by start, with a running maximum of the
+end coordinate, so a lookup is a bisect followed by a short backwards
+scan that stops as soon as no earlier interval can reach the position.
+Both bounds are inclusive, as in the 'chromStart <= pos <= chromEnd'
+queries. Matches are returned as full table rows, by start and then in
+table order: the order in which the query's range scan of the
+(chrom, chromStart) index returns them, so first() picks the same row.
+"""
+
+
+class IntervalIndex(object):
+    # Read-only once built
+    thread_safe = True
+
+    def __init__(self, intervals):
+        # intervals: iterable of (chrom, start, end, row)
+        byChrom = {}
+        for ordinal, (chrom, start, end, row) in enumerate(intervals):
+            byChrom.setdefault(str(chrom), []).append(
+                (int(start), int(end), ordinal, row)
+            )
+
+        self.chroms = {}
+        for chrom, entries in byChrom.items():
+            entries.sort(key=lambda e: (e[0], e[2]))
+            starts = [e[0] for e in entries]
+            ends = [e[1] for e in entries]
+            maxEnds = []
+            maxEnd = None
+            for end in ends:
+                maxEnd = end if maxEnd is None else max(maxEnd, end)
+                maxEnds.append(maxEnd)
+            ordinals = [e[2] for e in entries]
+            rows = [e[3] for e in entries]
+            self.chroms[chrom] = (starts, ends, maxEnds, ordinals, rows)
+
+    def __len__(self):
+        return sum([len(c[0]) for c in self.chroms.values()])
+
+    def overlapping(self, chrom, pos):
+        entry = self.chroms.get(str(chrom))
+        if entry is None:
+            return []
+
+        starts, ends, maxEnds, ordinals, rows = entry
+        pos = int(pos)
+        hits = []
+        j = bisect.bisect_right(starts, pos) - 1
+        while j >= 0 and maxEnds[j] >= pos:
+            if ends[j] >= pos:
+                hits.append((ordinals[j], rows[j]))
+            j = j - 1
+
+        # The scan ran backwards over (start, ordinal) order
+        hits.reverse()
+        return [h[1] for h in hits]
+
+    def first(self, chrom, pos):
+        hits = self.overlapping(chrom, pos)
+        if len(hits) > 0:
+            return hits[0]
+        return None
+
+
+"""Loads a whole table into an IntervalIndex
+"""
+
+
+def load_index(
+    cursor, table, chrom="chrom", start="chromStart", end="chromEnd", columns=None
+):
+    if columns is None:
+        columns = table + ".*"
+    sql = (
+        "select "
+        + chrom
+        + ", "
+        + start
+        + ", "
+        + end
+        + ", "
+        + columns
+        + " from "
+        + table
+        + ";"
+    )
+    cursor.execute(sql)
+    return IntervalIndex([(r[0], r[1], r[2], r[3:]) for r in cursor.fetchall()])
+
+
+"""An index with a per-position memo, for lookups that ask about the
+same position many times (e.g. once per overlapping transcript)
+
+The memo is dropped whenever it grows past 'size' entries.
+"""
+
+
+class MemoIndex(object):
+    thread_safe = True
+
+    def __init__(self, index, size=100000):
+        self.index = index
+        self.size = size
+        self.memo = {}
+
+    def overlapping(self, chrom, pos):
+        key = (str(chrom), int(pos))
+        hits = self.memo.get(key)
+        if hits is None:
+            if len(self.memo) >= self.size:
+                self.memo = {}
+            hits = self.index.overlapping(chrom, pos)
+            self.memo[key] = hits
+        return hits
+
+    def first(self, chrom, pos):
+        hits = self.overlapping(chrom, pos)
+        if len(hits) > 0:
+            return hits[0]
+        return None
+
+
+### EOF
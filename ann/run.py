@@ -20,6 +20,8 @@ import botocore
 from botocore.exceptions import ClientError
 from boto3.dynamodb.conditions import Key, Attr
 import json
+from decimal import Decimal
+import aws_clients as aws
 
 # /home/ubuntu/gas/ann/
 base_dir = os.path.abspath(os.path.dirname(__file__))
@@ -47,91 +49,139 @@ class Timer(object):
             print(f"Approximate runtime: {self.secs:.2f} seconds")
 
 
+"""Annotates one job's input and records the result: uploads the files,
+marks the job COMPLETED in DynamoDB and removes the local files.
+
+input_file: local path of the job input, named <jobs dir>/<user>/<job id>~<file>
+result_dir: S3 key prefix of the results, e.g. yueqil/userX
+source: s3:// URI the input is streamed from, when it was not downloaded
+
+Returns the exit status of the job: 0 on success, 1 if the annotation
+failed or the job could not be marked COMPLETED. Called from the
+annotator's warm worker as well as from the command line.
+"""
+def run_job(input_file, result_dir, source=None):
+
+    result_bucket = config['s3']['ResultsBucketName']
+
+    # 1. Annotate and upload the files to S3 results bucket; the result
+    # is streamed up while it is annotated, then the log (and index)
+    # are uploaded concurrently (see s3_stream.py)
+    # upload API ref: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html
+    # ref doc: https://docs.aws.amazon.com/AmazonS3/latest/userguide/mpuoverview.html
+    try:
+        with Timer():
+	        result_path = driver.run(input_file, 'vcf', source=source, upload=f"s3://{result_bucket}/{result_dir}")
+    except ClientError as e:
+        print(f"Failed uploading result file: {e}")
+        return 1
+    except Exception as e:
+        print(f"Annotation failed: {e}")
+        return 1
+
+    # example of input_file: '/home/ubuntu/gas/ann/userX/12234566~filename'
+    # example of input_file: '/home/ubuntu/jobs/userX~12234566~filename'
+    arguments = str(input_file).split('/')
+    job_name = str(arguments[-1])
+    job_id = str(job_name.split('~')[0])
+    file_name = str(job_name.split('~')[1])
+    user_id=str(arguments[-2])
+    job_prefix = job_name.partition('.')[0]
+
+    # Validate job details
+    if not job_id or not job_name or not job_prefix:
+        print('Invalid file path')
+
+    # example of jobs_dir (in ann server): /home/ubuntu/gas/ann/userX
+    jobs_dir = "{}/{}".format(base_dir, user_id)
+
+    # check whether the path is correct
+    if not job_id or not job_name or not job_prefix or not result_dir:
+        print('Invalid file path')
+
+    # File names for results and logs
+    # (the result is .annot.vcf.gz when the driver compressed it)
+    result_file_name = os.path.basename(result_path)
+    log_file_name = os.path.basename(driver.count_log(input_file))
+    # Tabix index of the result, when the driver wrote one
+    index_file_name = None
+    if os.path.exists(f"{result_path}.tbi"):
+        index_file_name = f"{result_file_name}.tbi"
+
+    # Define S3 keys
+    s3_key_result_file = f"{result_dir}/{result_file_name}"
+    s3_key_log_file = f"{result_dir}/{log_file_name}"
+    s3_key_index_file = f"{result_dir}/{index_file_name}"
+
+    # Per-stage metrics report, when the driver wrote one
+    metrics_file_name = None
+    if os.path.exists(driver.metrics_path(input_file)):
+        metrics_file_name = os.path.basename(driver.metrics_path(input_file))
+    s3_key_metrics_file = f"{result_dir}/{metrics_file_name}"
+
+    # 2. Update DynamoDB  
+    #ref doc: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/programming-with-python.html
+    #ref doc: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Expressions.UpdateExpressions.html
+    # The job fails if it cannot be marked COMPLETED
+    status = 0
+    try:
+        table = aws.resource('dynamodb').Table(config['gas']['AnnotationsTable'])
+        complete_time = int(time.time())
+        update_expression = 'SET job_status = :status, s3_results_bucket = :rb, s3_key_result_file = :rf, s3_key_log_file = :lf, complete_time = :ct'
+        values = {
+            ':status': 'COMPLETED',
+            ':rb': result_bucket,
+            ':rf': s3_key_result_file,
+            ':lf': s3_key_log_file,
+            ':ct': complete_time
+        }
+        if index_file_name:
+            update_expression += ', s3_key_index_file = :if'
+            values[':if'] = s3_key_index_file
+        if metrics_file_name:
+            update_expression += ', s3_key_metrics_file = :mf'
+            values[':mf'] = s3_key_metrics_file
+            # DynamoDB takes numbers as Decimal, not float
+            if config.getboolean('gas', 'MetricsOnJobItem', fallback=False):
+                with open(f"{jobs_dir}/{metrics_file_name}") as fh:
+                    update_expression += ', metrics = :m'
+                    values[':m'] = json.load(fh, parse_float=Decimal)
+        table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression=update_expression,
+            ExpressionAttributeValues=values,
+            ReturnValues = "UPDATED_NEW"   
+        )
+    except Exception as e:
+        print(f"Failed to update DynamoDB: {e}")
+        status = 1
+
+    # 3. Clean up local job files
+    try:
+        # A streamed input never had a local copy
+        if os.path.exists(f"{jobs_dir}/{job_name}"):
+            os.remove(f"{jobs_dir}/{job_name}")
+        os.remove(f"{jobs_dir}/{result_file_name}")
+        os.remove(f"{jobs_dir}/{log_file_name}")
+        if index_file_name:
+            os.remove(f"{jobs_dir}/{index_file_name}")
+        if metrics_file_name:
+            os.remove(f"{jobs_dir}/{metrics_file_name}")
+    except OSError as e:
+        print(f"Error during file cleanup: {e}")
+
+    return status
+
+
 if __name__ == '__main__':
 
     # Call the AnnTools pipeline
     if len(sys.argv) > 1:
-        with Timer():
-	        driver.run(sys.argv[1], 'vcf')
-
-        result_bucket = config['s3']['ResultsBucketName']
-        # example of argv[1]: '/home/ubuntu/gas/ann/userX/12234566~filename'
-        # example of argv[1]: '/home/ubuntu/jobs/userX~12234566~filename'
-        arguments = str(sys.argv[1]).split('/')
-        job_name = str(arguments[-1])
-        job_id = str(job_name.split('~')[0])
-        file_name = str(job_name.split('~')[1])
-        user_id=str(arguments[-2])
-        job_prefix = job_name.partition('.')[0]
-
-        # Validate job details
-        if not job_id or not job_name or not job_prefix:
-            print('Invalid file path')
-
-        # example of jobs_dir (in ann server): /home/ubuntu/gas/ann/userX
-        jobs_dir = "{}/{}".format(base_dir, user_id)
-
-        # example of result dir: yueqil/userX
-        result_dir = sys.argv[2] 
-
-        # check whether the path is correct
-        if not job_id or not job_name or not job_prefix or not result_dir:
-            print('Invalid file path')
-
-        s3_client = boto3.client('s3', region_name = config['aws']['AwsRegionName'], config=botocore.client.Config(signature_version=config['aws']['SignatureVersion']))
-
-        # File names for results and logs
-        result_file_name = f"{job_prefix}.annot.vcf"
-        log_file_name = f"{job_prefix}.vcf.count.log"
-
-        # Define S3 keys
-        s3_key_result_file = f"{result_dir}/{result_file_name}"
-        s3_key_log_file = f"{result_dir}/{log_file_name}"
-
-        # 1. Upload the files to S3 results bucket
-        # upload API ref: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html
-        # ref doc: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
-        try:
-            s3_client.upload_file(f"{jobs_dir}/{result_file_name}", result_bucket, s3_key_result_file)
-            s3_client.upload_file(f"{jobs_dir}/{log_file_name}", result_bucket, s3_key_log_file)
-        except ClientError as e:
-            print(f"Failed uploading result file: {e}")
-            sys.exit(1)
-
-        # 2. Update DynamoDB  
-        #ref doc: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/programming-with-python.html
-        #ref doc: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Expressions.UpdateExpressions.html
-        try:
-            dynamodb = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
-            table = dynamodb.Table(config['gas']['AnnotationsTable'])
-        except ClientError as e:
-            print (f"Failed connecting to database: {e}")
-
-        try:
-            complete_time = int(time.time())
-            table.update_item(
-                Key={'job_id': job_id},
-                UpdateExpression='SET job_status = :status, s3_results_bucket = :rb, s3_key_result_file = :rf, s3_key_log_file = :lf, complete_time = :ct',
-                ExpressionAttributeValues={
-                    ':status': 'COMPLETED',
-                    ':rb': result_bucket,
-                    ':rf': s3_key_result_file,
-                    ':lf': s3_key_log_file,
-                    ':ct': complete_time
-                },
-                ReturnValues = "UPDATED_NEW"   
-            )
-        except ClientError as e:
-            print(f"Failed to update DynamoDB: {e}")
-
-        # 3. Clean up local job files
-        try:
-            os.remove(f"{jobs_dir}/{job_name}")
-            os.remove(f"{jobs_dir}/{result_file_name}")
-            os.remove(f"{jobs_dir}/{log_file_name}")
-        except OSError as e:
-            print(f"Error during file cleanup: {e}")
+        # Optional third argument: s3:// URI the input is streamed from,
+        # when it was not downloaded to argv[1]
+        source = sys.argv[3] if len(sys.argv) > 3 else None
 
+        sys.exit(run_job(sys.argv[1], sys.argv[2], source))
     else:
         print("A valid .vcf file must be provided as input to this program.")
 
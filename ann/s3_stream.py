@@ -0,0 +1,274 @@
+# s3_stream.py
+#
+# Streams job input and result files from and to S3
+#
+# Instead of downloading the input and then annotating it, the pipeline
+# reads the object as a stream: the object is fetched in byte ranges of
+# StreamPartSize bytes, with StreamReadahead ranges in flight at a time,
+# so the first records are annotated while the rest is still arriving
+# and large objects are pulled over several connections. Memory use is
+# bounded by part size x read-ahead; nothing is written to local disk.
+#
+# Results go the other way: a multipart upload is fed as the annotated
+# VCF is written and ships each UploadPartSize part while later blocks
+# are still being annotated, UploadInflight parts at a time.
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import io
+import os
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import aws_clients as aws
+
+# Get configuration
+from configparser import ConfigParser, ExtendedInterpolation
+
+base_dir = os.path.abspath(os.path.dirname(__file__))
+
+config = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
+config.read(os.path.join(base_dir, "annotator_config.ini"))
+
+"""True for s3://bucket/key URIs
+"""
+
+
+def is_s3_uri(path):
+    return str(path).startswith("s3://")
+
+
+def parse_uri(uri):
+    bucket, _, key = uri[len("s3://") :].partition("/")
+    return bucket, key
+
+
+def get_client():
+    return aws.client("s3")
+
+
+"""Read-only, sequential binary stream over an S3 object
+
+Parts are fetched with ranged GETs on a small thread pool; 'readahead'
+parts are requested ahead of the reader and handed out in order.
+"""
+
+
+class S3Stream(io.RawIOBase):
+    def __init__(self, client, bucket, key, part_size=8 * 1024 * 1024, readahead=4):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.size = client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        self.executor = ThreadPoolExecutor(max_workers=max(1, readahead))
+        self.parts = collections.deque()
+        self.next_part = 0
+        self.buffer = b""
+        self.offset = 0
+        for i in range(max(1, readahead)):
+            self.request_part()
+
+    def request_part(self):
+        start = self.next_part * self.part_size
+        if start >= self.size:
+            return
+        end = min(start + self.part_size, self.size) - 1
+        self.parts.append(self.executor.submit(self.get_range, start, end))
+        self.next_part = self.next_part + 1
+
+    def get_range(self, start, end):
+        response = self.client.get_object(
+            Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{end}"
+        )
+        return response["Body"].read()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.offset >= len(self.buffer):
+            if len(self.parts) == 0:
+                # Readers that wrap this stream may never close it
+                self.executor.shutdown(wait=False)
+                return 0
+            self.buffer = self.parts.popleft().result()
+            self.offset = 0
+            self.request_part()
+
+        n = min(len(b), len(self.buffer) - self.offset)
+        b[:n] = self.buffer[self.offset : self.offset + n]
+        self.offset = self.offset + n
+        return n
+
+    def close(self):
+        if not self.closed:
+            for part in self.parts:
+                part.cancel()
+            self.executor.shutdown(wait=False)
+        super(S3Stream, self).close()
+
+
+"""Opens an s3://bucket/key URI as a buffered binary stream
+"""
+
+
+def open_uri(uri, client=None):
+    bucket, key = parse_uri(uri)
+    part_size = config.getint("s3", "StreamPartSize", fallback=8 * 1024 * 1024)
+    raw = S3Stream(
+        client or get_client(),
+        bucket,
+        key,
+        part_size=part_size,
+        readahead=config.getint("s3", "StreamReadahead", fallback=4),
+    )
+    return io.BufferedReader(raw, buffer_size=min(part_size, 1024 * 1024))
+
+
+"""Size in bytes of an S3 object
+"""
+
+
+def object_size(uri, client=None):
+    bucket, key = parse_uri(uri)
+    return (client or get_client()).head_object(Bucket=bucket, Key=key)["ContentLength"]
+
+
+"""First 'n' bytes of an S3 object, e.g. to sniff its compression
+"""
+
+
+def read_head(uri, n, client=None):
+    bucket, key = parse_uri(uri)
+    response = (client or get_client()).get_object(
+        Bucket=bucket, Key=key, Range=f"bytes=0-{n - 1}"
+    )
+    return response["Body"].read()
+
+
+"""Downloads an S3 object to 'path', for the modes that need a local file
+"""
+
+
+def download(uri, path, client=None):
+    bucket, key = parse_uri(uri)
+    (client or get_client()).download_file(bucket, key, path)
+
+
+"""Multipart upload fed with write() as the data is produced
+
+Every 'part_size' bytes (S3 needs at least 5 MiB for all but the last
+part) go out as a part on a thread pool; at most 'inflight' parts are
+buffered or in flight, so a writer that outpaces the network waits.
+close() sends the last part and completes the upload; on any error the
+upload is aborted, so no partial object is ever created.
+"""
+
+
+class MultipartUpload(object):
+    def __init__(self, client, bucket, key, part_size=8 * 1024 * 1024, inflight=4):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        self.upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)[
+            "UploadId"
+        ]
+        self.executor = ThreadPoolExecutor(max_workers=max(1, inflight))
+        self.slots = threading.BoundedSemaphore(max(1, inflight))
+        self.parts = []
+        self.buffer = bytearray()
+        self.done = False
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.part_size:
+            self.send(bytes(self.buffer[: self.part_size]))
+            del self.buffer[: self.part_size]
+        return len(data)
+
+    def send(self, data):
+        self.slots.acquire()
+        self.parts.append(
+            self.executor.submit(self.upload_part, len(self.parts) + 1, data)
+        )
+
+    def upload_part(self, number, data):
+        try:
+            response = self.client.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                PartNumber=number,
+                Body=data,
+            )
+            return {"ETag": response["ETag"], "PartNumber": number}
+        finally:
+            self.slots.release()
+
+    def close(self):
+        if self.done:
+            return
+        self.done = True
+        try:
+            if len(self.buffer) > 0 or len(self.parts) == 0:
+                self.send(bytes(self.buffer))
+                self.buffer = bytearray()
+            parts = [part.result() for part in self.parts]
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.executor.shutdown()
+
+    def abort(self):
+        self.done = True
+        self.executor.shutdown(wait=False)
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+        )
+
+
+"""Starts a streaming multipart upload to an s3://bucket/key URI
+"""
+
+
+def open_upload(uri, client=None):
+    bucket, key = parse_uri(uri)
+    return MultipartUpload(
+        client or get_client(),
+        bucket,
+        key,
+        part_size=config.getint("s3", "UploadPartSize", fallback=8 * 1024 * 1024),
+        inflight=config.getint("s3", "UploadInflight", fallback=4),
+    )
+
+
+"""Uploads local files concurrently; 'files' is a list of (path, uri)
+"""
+
+
+def upload_files(files, client=None):
+    client = client or get_client()
+    executor = ThreadPoolExecutor(max_workers=max(1, len(files)))
+    futures = [
+        executor.submit(client.upload_file, path, *parse_uri(uri))
+        for path, uri in files
+    ]
+    executor.shutdown()
+    for future in futures:
+        future.result()
+
+
+### EOF
@@ -0,0 +1,152 @@
+# tabix.py
+#
+# Tabix (.tbi) index of a BGZF compressed VCF
+#
+# The index is built while the annotated VCF is written: the writer
+# feeds it the text it compresses, and since BGZF blocks hold a fixed
+# number of uncompressed bytes, every record's uncompressed offset maps
+# to a virtual file offset (compressed block offset << 16 | offset in
+# block) once the blocks have been written. The result is the standard
+# tabix binning and linear index, so tabix, htslib/pysam and S3
+# byte-range readers can fetch a region without the whole file.
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import struct
+
+# Linear index window (16 kb), as in tabix
+MIN_SHIFT = 14
+
+# tabix preset for VCF: format, sequence/begin/end columns, meta char, skip
+TBX_VCF = (2, 1, 2, 0, ord("#"), 0)
+
+"""UCSC/tabix bin of the 0-based, half-open interval [beg, end)
+"""
+
+
+def reg2bin(beg, end):
+    end = end - 1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+
+"""Tabix index of a VCF, fed the file text in order
+
+feed() takes text in arbitrary pieces and tracks uncompressed byte
+offsets; records span [POS-1, POS-1+len(REF)), or up to INFO END= when
+present, as tabix computes them. Records must be grouped by chromosome
+and sorted by position, otherwise 'sorted' turns False and the file
+cannot be indexed.
+"""
+
+
+class TabixIndex(object):
+    def __init__(self):
+        self.names = []
+        self.refs = {}
+        self.chrom = None
+        self.last_beg = 0
+        self.sorted = True
+        self.pending = ""
+        self.pos = 0
+
+    def feed(self, text):
+        if not self.sorted:
+            return
+        lines = (self.pending + text).split("\n")
+        self.pending = lines.pop()
+        for line in lines:
+            size = len(line.encode()) + 1
+            if len(line) > 0 and not line.startswith("#"):
+                self.add(line, self.pos, self.pos + size)
+            self.pos = self.pos + size
+
+    def finish(self):
+        if self.sorted and len(self.pending) > 0:
+            self.add(self.pending, self.pos, self.pos + len(self.pending.encode()))
+        self.pending = ""
+        return self.sorted
+
+    def add(self, line, start, stop):
+        fields = line.split("\t", 8)
+        try:
+            chrom = fields[0]
+            beg = int(fields[1]) - 1
+            end = beg + len(fields[3])
+            if len(fields) > 7:
+                for kv in fields[7].split(";"):
+                    if kv.startswith("END="):
+                        end = int(kv[4:])
+        except (IndexError, ValueError):
+            self.sorted = False
+            return
+        end = max(end, beg + 1)
+
+        if chrom != self.chrom:
+            if chrom in self.refs:
+                self.sorted = False
+                return
+            self.names.append(chrom)
+            self.refs[chrom] = ({}, [])
+            self.chrom = chrom
+        elif beg < self.last_beg:
+            self.sorted = False
+            return
+        self.last_beg = beg
+
+        bins, linear = self.refs[chrom]
+        chunks = bins.setdefault(reg2bin(beg, end), [])
+        if len(chunks) > 0 and chunks[-1][1] == start:
+            chunks[-1][1] = stop
+        else:
+            chunks.append([start, stop])
+
+        last = (end - 1) >> MIN_SHIFT
+        while len(linear) <= last:
+            linear.append(None)
+        for w in range(beg >> MIN_SHIFT, last + 1):
+            if linear[w] is None:
+                linear[w] = start
+
+    def to_bytes(self, voffset):
+        # Uncompressed .tbi content; 'voffset' maps an uncompressed offset
+        # to its virtual file offset
+        names = b"".join([name.encode() + b"\0" for name in self.names])
+        out = [
+            b"TBI\x01",
+            struct.pack("<i", len(self.names)),
+            struct.pack("<6i", *TBX_VCF),
+            struct.pack("<i", len(names)),
+            names,
+        ]
+        for name in self.names:
+            bins, linear = self.refs[name]
+            out.append(struct.pack("<i", len(bins)))
+            for bin in sorted(bins):
+                out.append(struct.pack("<Ii", bin, len(bins[bin])))
+                for start, stop in bins[bin]:
+                    out.append(struct.pack("<QQ", voffset(start), voffset(stop)))
+
+            # Empty windows point at the previous record, as in tabix
+            out.append(struct.pack("<i", len(linear)))
+            previous = 0
+            for start in linear:
+                if start is not None:
+                    previous = voffset(start)
+                out.append(struct.pack("<Q", previous))
+        return b"".join(out)
+
+
+### EOF
@@ -0,0 +1,97 @@
+# conftest.py
+#
+# A small synthetic reference database, with the sort-merge extracts and
+# dbSNP snapshot built from it, and a VCF drawn partly from its dbSNP
+# rows (see bench.py), for tests that run the annotation pipeline
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import sys
+import shutil
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CHROMS = ["1", "2", "X"]
+SPAN = 500000
+VARIANTS = 600
+
+
+@pytest.fixture(scope="session")
+def reference_dir(tmp_path_factory):
+    import bench
+    import bench_refdb as brd
+    import bench_vcf as bv
+
+    work = str(tmp_path_factory.mktemp("reference"))
+    path = os.path.join(work, "reference.db")
+    brd.build_synthetic(path, chroms=CHROMS, span=SPAN, density=4.0)
+    saved = save_settings()
+    try:
+        bench.prepare(work)
+    finally:
+        restore_settings(saved)
+
+    known = bv.known_variants(path, CHROMS, VARIANTS)
+    bv.write_vcf(
+        os.path.join(work, "input.vcf"),
+        VARIANTS,
+        chroms=CHROMS,
+        span=SPAN,
+        known=known,
+        known_fraction=0.3,
+    )
+    return work
+
+
+def save_settings():
+    import db_pool as dbp
+    import driver
+
+    return (
+        dbp.config.get("ann", "ReferenceDb", fallback=""),
+        dict(driver.config["ann"]),
+        driver.EXTRACT_DIR,
+        driver.DBSNP_SNAPSHOT_DIR,
+    )
+
+
+def restore_settings(saved):
+    import db_pool as dbp
+    import driver
+
+    reference_db, settings, extract_dir, snapshot_dir = saved
+    dbp.config.set("ann", "ReferenceDb", reference_db)
+    for name in ["AnnotationCache", "Metrics"]:
+        driver.config.set("ann", name, settings[name.lower()])
+    driver.EXTRACT_DIR = extract_dir
+    driver.DBSNP_SNAPSHOT_DIR = snapshot_dir
+    dbp.get_pool().close()
+
+
+"""Points the pipeline at the synthetic reference (bench.use_reference)
+for one test, with the input VCF copied to 'input.vcf' in the test's
+own directory; yields that path
+"""
+
+
+@pytest.fixture
+def reference(reference_dir, tmp_path):
+    import bench
+
+    saved = save_settings()
+    bench.use_reference(reference_dir)
+    infile = str(tmp_path / "input.vcf")
+    shutil.copy(os.path.join(reference_dir, "input.vcf"), infile)
+    try:
+        yield infile
+    finally:
+        restore_settings(saved)
+
+
+### EOF
@@ -0,0 +1,129 @@
+# test_annotate.py
+#
+# Batched lookups must annotate every record exactly as the per-record
+# lookups do (see conftest.py for the synthetic reference)
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import sys
+import random
+import sqlite3
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import annotate as ann
+import db_pool as dbp
+
+INDS = ann.getFormatSpecificIndices(format="vcf")
+
+
+def record(chrom, pos, ref, alt):
+    return [str(chrom), str(pos), ".", ref, alt, "50", "PASS", "DP=10"]
+
+
+"""Records hitting each BigRefGene tier: chrom_pos_equal_base rows as
+they are, in lower case, complemented and with other bases at the same
+start; chrom_pos_equal_nobase starts; positions inside
+chrom_pos_unequal ranges; and random positions
+"""
+
+
+def bigrefgene_records(reference_dir):
+    rnd = random.Random(3)
+    conn = sqlite3.connect(os.path.join(reference_dir, "reference.db"))
+    records = []
+    for chrom, start, ref, alt in conn.execute(
+        "select CHR, start, haplotypeReference, haplotypeAlternate "
+        "from chrom_pos_equal_base"
+    ).fetchall()[:150]:
+        records.append(record(chrom, start, ref, alt))
+        records.append(record(chrom, start, ref.lower(), alt.lower()))
+        records.append(
+            record(chrom, start, ann.getComplementary(ref), ann.getComplementary(alt))
+        )
+        records.append(record(chrom, start, rnd.choice("ACGT"), rnd.choice("ACGT")))
+    for chrom, start in conn.execute(
+        "select CHR, start from chrom_pos_equal_nobase"
+    ).fetchall()[:100]:
+        records.append(record(chrom, start, "A", "C"))
+    for chrom, start, end in conn.execute(
+        "select CHR, start, end from chrom_pos_unequal"
+    ).fetchall()[:100]:
+        records.append(record(chrom, rnd.randint(start, end), "G", "T"))
+    for i in range(200):
+        records.append(
+            record(rnd.choice(["1", "2", "X"]), rnd.randint(1, 500000), "A", "G")
+        )
+    conn.close()
+    rnd.shuffle(records)
+    return records
+
+
+def test_bigrefgene_windows_match_per_record(reference, reference_dir):
+    records = bigrefgene_records(reference_dir)
+    with dbp.connection() as conn:
+        cursor = conn.cursor()
+        expected = [
+            ann.lookupBigRefGene(fields, cursor, Counter(), INDS) for fields in records
+        ]
+        assert len([e for e in expected if e is not None]) > len(records) // 2
+        for window in [1, 7, 1000]:
+            assert (
+                ann.lookupBigRefGeneBlock(
+                    records, cursor, Counter(), INDS, window=window
+                )
+                == expected
+            )
+
+
+"""Records at dbSNP positions: REF as it is, in lower case,
+complemented and with another base; plus random positions
+"""
+
+
+def dbsnp_records(reference_dir):
+    rnd = random.Random(5)
+    conn = sqlite3.connect(os.path.join(reference_dir, "reference.db"))
+    records = []
+    for chrom, pos, ref, alt in conn.execute(
+        "select CHR, POS, REF, ALT from dbSNP"
+    ).fetchall()[:200]:
+        records.append(record(chrom, pos, ref, alt))
+        records.append(record(chrom, pos, ref.lower(), alt.lower()))
+        records.append(
+            record(chrom, pos, ann.getComplementary(ref), ann.getComplementary(alt))
+        )
+        records.append(record(chrom, pos, rnd.choice("ACGT"), rnd.choice("ACGT")))
+    for i in range(200):
+        records.append(
+            record(rnd.choice(["1", "2", "X"]), rnd.randint(1, 500000), "C", "T")
+        )
+    conn.close()
+    rnd.shuffle(records)
+    return records
+
+
+def test_dbsnp_windows_match_per_record(reference, reference_dir):
+    records = dbsnp_records(reference_dir)
+    with dbp.connection() as conn:
+        cursor = conn.cursor()
+        expected_counts = Counter()
+        expected = [
+            ann.lookupDbSnp(fields, cursor, expected_counts, INDS) for fields in records
+        ]
+        assert len([e for e in expected if e is not None]) > len(records) // 2
+        for window in [1, 7, 1000]:
+            counts = Counter()
+            assert (
+                ann.lookupDbSnpBlock(records, cursor, counts, INDS, window=window)
+                == expected
+            )
+            assert counts == expected_counts
+
+
+### EOF
@@ -0,0 +1,45 @@
+# test_annotation_cache.py
+#
+# The annotation cache never serves entries written for other reference
+# data
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import annotation_cache as ac
+
+VARIANT = ("chr1", "12345", "A", "G")
+
+
+def test_entries_kept_for_same_fingerprint(tmp_path):
+    cache = ac.AnnotationCache(str(tmp_path / "cache.db"), "ref-a")
+    cache.put_many("cytoBand", {VARIANT: ("p36.33", {"var_count": 1})})
+    cache.close()
+
+    cache = ac.AnnotationCache(str(tmp_path / "cache.db"), "ref-a")
+    assert cache.get_many("cytoBand", [VARIANT]) == {
+        VARIANT: ("p36.33", {"var_count": 1})
+    }
+    cache.close()
+
+
+def test_entries_dropped_for_other_fingerprint(tmp_path):
+    cache = ac.AnnotationCache(str(tmp_path / "cache.db"), "ref-a")
+    cache.put_many("cytoBand", {VARIANT: ("p36.33", {"var_count": 1})})
+    cache.close()
+
+    cache = ac.AnnotationCache(str(tmp_path / "cache.db"), "ref-b")
+    assert cache.get_many("cytoBand", [VARIANT]) == {}
+    count = cache.db.execute("select count(*) from entries").fetchone()[0]
+    assert count == 0
+    cache.close()
+
+
+### EOF
@@ -0,0 +1,370 @@
+# test_annotator.py
+#
+# The annotator's job supervisor, and its handling of the request queue
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import sys
+import json
+import time
+import concurrent.futures
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import annotator
+import driver
+import run
+
+"""Stands in for the python run.py child of a cold supervisor; a job
+exits once its code is set
+"""
+
+
+class FakeProcess(object):
+    launched = []
+
+    def __init__(self, args, cwd=None):
+        self.args = args
+        self.pid = 1000 + len(FakeProcess.launched)
+        self.code = None
+        FakeProcess.launched.append(self)
+
+    def poll(self):
+        return self.code
+
+
+@pytest.fixture
+def cold_supervisor(monkeypatch):
+    FakeProcess.launched = []
+    monkeypatch.setattr(annotator.subprocess, "Popen", FakeProcess)
+    monkeypatch.setitem(annotator.config["jobs"], "ReapInterval", "0.01")
+    return annotator.JobSupervisor(2)
+
+
+def wait_for_jobs(supervisor, count, timeout=120):
+    finished = []
+    deadline = time.time() + timeout
+    while len(finished) < count and time.time() < deadline:
+        finished.extend(supervisor.collect())
+        time.sleep(0.1)
+    return finished
+
+
+"""A job forked from a warm supervisor can start processes of its own,
+as PipelineMode = parallel does
+"""
+
+
+def test_warm_supervisor_runs_parallel_job(reference, monkeypatch):
+    def run_job(input_file, result_dir):
+        finalout = driver.run(input_file, "vcf", mode="parallel")
+        return 0 if os.path.exists(finalout) else 1
+
+    monkeypatch.setattr(run, "run_job", run_job)
+    supervisor = annotator.JobSupervisor(1, warm=True)
+    try:
+        supervisor.launch("job1", [reference, "results"])
+        finished = wait_for_jobs(supervisor, 1)
+    finally:
+        supervisor.close()
+
+    assert finished == [("job1", 0, None)]
+    assert not supervisor.server.is_alive()
+
+
+"""A job holds its slot, and its message's receipt handle, until its
+process exits; then it is collected once, with its exit code
+"""
+
+
+def test_supervisor_slot_accounting(cold_supervisor):
+    supervisor = cold_supervisor
+    assert supervisor.free_slots() == 2
+    supervisor.launch("job1", ["job1.vcf", "results"], "handle1")
+    supervisor.launch("job2", ["job2.vcf", "results"], "handle2")
+    assert FakeProcess.launched[0].args == ["python", "run.py", "job1.vcf", "results"]
+    assert supervisor.free_slots() == 0
+    assert sorted(supervisor.receipt_handles()) == ["handle1", "handle2"]
+    assert supervisor.collect() == []
+
+    FakeProcess.launched[1].code = 3
+    assert supervisor.free_slots() == 1
+    assert supervisor.receipt_handles() == ["handle1"]
+    assert supervisor.collect() == [("job2", 3, "handle2")]
+    assert supervisor.collect() == []
+    assert supervisor.exit_codes == {"job2": 3}
+
+    supervisor.launch("job3", ["job3.vcf", "results"])
+    assert supervisor.free_slots() == 0
+    assert supervisor.receipt_handles() == ["handle1"]
+    FakeProcess.launched[0].code = 0
+    FakeProcess.launched[2].code = 0
+    supervisor.wait_for_slot()
+    assert supervisor.free_slots() == 2
+    assert sorted(supervisor.collect()) == [("job1", 0, "handle1"), ("job3", 0, None)]
+
+
+QUEUE_URL = annotator.config["sqs"]["RequestQueueUrl"]
+TABLE = annotator.config["gas"]["AnnotationsTable"]
+
+
+"""Stubbed SQS and DynamoDB clients (and a recording S3 stand-in) in
+place of the process's AWS clients; the jobs of a batch are claimed one
+at a time, so the stubbed responses are consumed in job order
+"""
+
+
+class S3Downloads(object):
+    def __init__(self):
+        self.downloads = []
+
+    def download_file(self, bucket, key, path):
+        self.downloads.append((bucket, key, path))
+        with open(path, "w") as fh:
+            fh.write("##fileformat=VCFv4.1\n")
+
+
+@pytest.fixture
+def aws_stubs(monkeypatch, tmp_path):
+    clients = {}
+    stubbers = {}
+    for service in ["sqs", "dynamodb"]:
+        clients[service] = boto3.client(
+            service,
+            region_name="us-east-1",
+            aws_access_key_id="testing",
+            aws_secret_access_key="testing",
+        )
+        stubbers[service] = Stubber(clients[service])
+        stubbers[service].activate()
+    clients["s3"] = S3Downloads()
+
+    monkeypatch.setattr(annotator.aws, "client", lambda service: clients[service])
+    monkeypatch.setattr(
+        annotator,
+        "ThreadPoolExecutor",
+        lambda max_workers: concurrent.futures.ThreadPoolExecutor(max_workers=1),
+    )
+    monkeypatch.setattr(annotator, "base_dir", str(tmp_path))
+    monkeypatch.setitem(annotator.config["s3"], "StreamInput", "off")
+    yield stubbers, clients["s3"]
+    for stubber in stubbers.values():
+        stubber.assert_no_pending_responses()
+        stubber.deactivate()
+
+
+def job_message(job_id, receipt_handle):
+    job = {
+        "job_id": job_id,
+        "user_id": "user1",
+        "input_file_name": "input.vcf",
+        "s3_input_bucket": "inputs",
+        "s3_key_input_file": f"cnet/user1/{job_id}~input.vcf",
+    }
+    return {
+        "MessageId": job_id,
+        "ReceiptHandle": receipt_handle,
+        "Body": json.dumps({"Message": json.dumps(job)}),
+    }
+
+
+def expect_status_update(stubber, job_id, status, previous, error=None):
+    params = {
+        "TableName": TABLE,
+        "Key": {"job_id": {"S": job_id}},
+        "UpdateExpression": "SET job_status = :val",
+        "ConditionExpression": "job_status = :status",
+        "ExpressionAttributeValues": {
+            ":val": {"S": status},
+            ":status": {"S": previous},
+        },
+    }
+    if error is None:
+        stubber.add_response("update_item", {}, params)
+    else:
+        stubber.add_client_error(
+            "update_item", service_error_code=error, expected_params=params
+        )
+
+
+def expect_receive(stubber, messages, count=10):
+    stubber.add_response(
+        "receive_message",
+        {"Messages": messages},
+        {
+            "QueueUrl": QUEUE_URL,
+            "MaxNumberOfMessages": count,
+            "VisibilityTimeout": int(annotator.config["sqs"]["VisibilityTimeout"]),
+            "WaitTimeSeconds": int(annotator.config["sqs"]["WaitTime"]),
+        },
+    )
+
+
+def expect_delete(stubber, handles):
+    stubber.add_response(
+        "delete_message_batch",
+        {"Successful": [{"Id": str(i)} for i in range(len(handles))], "Failed": []},
+        {
+            "QueueUrl": QUEUE_URL,
+            "Entries": [
+                {"Id": str(i), "ReceiptHandle": handle}
+                for i, handle in enumerate(handles)
+            ],
+        },
+    )
+
+
+"""Stands in for the supervisor of handle_requests_queue: every slot
+free, jobs recorded as launched, and 'finished' handed back by collect()
+"""
+
+
+class RecordingSupervisor(object):
+    def __init__(self, finished=[]):
+        self.finished = list(finished)
+        self.launched = []
+
+    def wait_for_slot(self):
+        pass
+
+    def free_slots(self):
+        return 10
+
+    def collect(self):
+        finished = self.finished
+        self.finished = []
+        return finished
+
+    def launch(self, job_id, args, receipt_handle=None):
+        self.launched.append((job_id, args, receipt_handle))
+
+
+"""Acknowledgements go out in batches of at most 10, and are kept for
+the next flush when a batch cannot be deleted
+"""
+
+
+def test_acknowledger_deletes_in_batches(aws_stubs):
+    stubbers, s3 = aws_stubs
+    sqs = stubbers["sqs"]
+    handles = [f"handle{i}" for i in range(23)]
+    sqs.add_client_error("delete_message_batch", service_error_code="InternalError")
+    expect_delete(sqs, handles[:10])
+    expect_delete(sqs, handles[10:20])
+    expect_delete(sqs, handles[20:])
+
+    acks = annotator.Acknowledger()
+    for handle in handles:
+        acks.add(handle)
+    acks.flush(annotator.aws.client("sqs"))
+    assert acks.handles == handles
+    acks.flush(annotator.aws.client("sqs"))
+    assert acks.handles == []
+
+
+"""Of a batch of messages: a claimed job is downloaded and launched; a
+job that is no longer PENDING is acknowledged without running it; a job
+whose claim failed otherwise is left on the queue; and messages that
+cannot be parsed are acknowledged. Only claimed jobs are downloaded.
+"""
+
+
+def test_batch_is_claimed_before_download(aws_stubs, tmp_path):
+    stubbers, s3 = aws_stubs
+    messages = [
+        job_message("job1", "handle1"),
+        job_message("job2", "handle2"),
+        job_message("job3", "handle3"),
+        {"MessageId": "bad1", "ReceiptHandle": "handle4", "Body": "not json"},
+        {"MessageId": "bad2", "ReceiptHandle": "handle5", "Body": "{}"},
+    ]
+    expect_receive(stubbers["sqs"], messages)
+    dynamodb = stubbers["dynamodb"]
+    expect_status_update(dynamodb, "job1", "RUNNING", "PENDING")
+    expect_status_update(
+        dynamodb, "job2", "RUNNING", "PENDING", "ConditionalCheckFailedException"
+    )
+    expect_status_update(
+        dynamodb, "job3", "RUNNING", "PENDING", "ProvisionedThroughputExceededException"
+    )
+    expect_delete(stubbers["sqs"], ["handle4", "handle5", "handle2"])
+
+    supervisor = RecordingSupervisor()
+    annotator.handle_requests_queue(supervisor, annotator.Acknowledger())
+
+    local_file = str(tmp_path / "user1" / "job1~input.vcf")
+    assert s3.downloads == [("inputs", "cnet/user1/job1~input.vcf", local_file)]
+    assert supervisor.launched == [("job1", [local_file, "cnet/user1"], "handle1")]
+    assert os.listdir(str(tmp_path / "user1")) == ["job1~input.vcf"]
+
+
+"""Finished jobs are acknowledged: a failed one once it is marked
+FAILED, and left on the queue when that update fails
+"""
+
+
+def test_failed_job_is_marked_failed_and_acknowledged(aws_stubs):
+    stubbers, s3 = aws_stubs
+    dynamodb = stubbers["dynamodb"]
+    expect_status_update(dynamodb, "job2", "FAILED", "RUNNING")
+    expect_status_update(dynamodb, "job3", "FAILED", "RUNNING", "InternalServerError")
+    expect_delete(stubbers["sqs"], ["handle1", "handle2"])
+    expect_receive(stubbers["sqs"], [])
+
+    supervisor = RecordingSupervisor(
+        [("job1", 0, "handle1"), ("job2", 1, "handle2"), ("job3", 1, "handle3")]
+    )
+    annotator.handle_requests_queue(supervisor, annotator.Acknowledger())
+    assert supervisor.launched == []
+
+
+"""The heartbeat resets the visibility timeout of every running job's
+message, 10 to a batch, and goes on past a batch that fails
+"""
+
+
+def test_heartbeat_extends_running_messages(aws_stubs, monkeypatch):
+    stubbers, s3 = aws_stubs
+    sqs = stubbers["sqs"]
+    handles = [f"handle{i}" for i in range(25)]
+    monkeypatch.setitem(annotator.config["sqs"], "VisibilityTimeout", "120")
+
+    def entries(batch):
+        return [
+            {"Id": str(i), "ReceiptHandle": handle, "VisibilityTimeout": 120}
+            for i, handle in enumerate(batch)
+        ]
+
+    sqs.add_response(
+        "change_message_visibility_batch",
+        {"Successful": [], "Failed": []},
+        {"QueueUrl": QUEUE_URL, "Entries": entries(handles[:10])},
+    )
+    sqs.add_client_error(
+        "change_message_visibility_batch",
+        service_error_code="InternalError",
+        expected_params={"QueueUrl": QUEUE_URL, "Entries": entries(handles[10:20])},
+    )
+    sqs.add_response(
+        "change_message_visibility_batch",
+        {"Successful": [], "Failed": []},
+        {"QueueUrl": QUEUE_URL, "Entries": entries(handles[20:])},
+    )
+
+    supervisor = annotator.JobSupervisor(1)
+    supervisor.running = {
+        i: (f"job{i}", None, time.time(), handle) for i, handle in enumerate(handles)
+    }
+    supervisor.running[99] = ("job99", None, time.time(), None)
+    annotator.VisibilityHeartbeat(supervisor).beat()
+
+
+### EOF
@@ -0,0 +1,79 @@
+# test_pipeline.py
+#
+# The fused and parallel pipelines against the synthetic reference
+# (see conftest.py)
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import sys
+import gzip
+import shutil
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_pool as dbp
+import driver
+import pipeline as pl
+
+
+def fail(fields, cursor, counts, inds):
+    raise RuntimeError("lookup failed")
+
+
+"""A failed run hands back every pooled connection it held
+"""
+
+
+def test_failed_run_releases_connections(reference):
+    stages = [pl.Stage("fail", fail)]
+    with pytest.raises(RuntimeError):
+        pl.run_fused(reference, reference + ".annot", stages, threads=2, inflight=3)
+
+    stats = dbp.stats()
+    assert stats["open"] == stats["idle"]
+
+
+"""Annotates a copy of 'infile' in its own directory; returns the
+decompressed annotated VCF and the count log
+"""
+
+
+def annotate_copy(infile, mode):
+    workdir = os.path.join(os.path.dirname(infile), mode)
+    os.makedirs(workdir)
+    copy = os.path.join(workdir, os.path.basename(infile))
+    shutil.copy(infile, copy)
+
+    finalout = driver.run(copy, "vcf", mode=mode)
+    with gzip.open(finalout, "rb") as fh:
+        output = fh.read()
+    with open(driver.count_log(copy), "rb") as fh:
+        counts = fh.read()
+    return output, counts
+
+
+"""The fused and parallel pipelines write the same bytes (annotated
+VCF and count log) as running each stage over the whole file, across
+several blocks and shards
+"""
+
+
+def test_fused_and_parallel_match_multipass(reference, monkeypatch):
+    monkeypatch.setitem(driver.config["ann"], "BlockSize", "64")
+    monkeypatch.setitem(driver.config["ann"], "ShardSize", "150")
+    monkeypatch.setitem(driver.config["ann"], "Workers", "2")
+    monkeypatch.setitem(driver.config["ann"], "CompressOutput", "on")
+
+    expected = annotate_copy(reference, "multipass")
+    assert len(expected[0].splitlines()) > 600
+    for mode in ["fused", "parallel"]:
+        assert annotate_copy(reference, mode) == expected
+
+
+### EOF
@@ -0,0 +1,97 @@
+# test_ref_backend.py
+#
+# Every reference backend must return the same rows, in the same order,
+# for the same lookup
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import sys
+import random
+import sqlite3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ref_index as ri
+import ref_backend as rb
+
+"""A local reference database with an indexed genomicSuperDups-like
+table: overlapping intervals, shared starts and rows inserted out of
+start order
+"""
+
+
+def make_db(path, seed=1):
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "create table genomicSuperDups (chrom COLLATE NOCASE, chromStart, "
+        "chromEnd, name COLLATE NOCASE, otherChrom COLLATE NOCASE)"
+    )
+    rows = []
+    for i in range(400):
+        start = rnd.randint(0, 20000)
+        if i % 7 == 0 and len(rows) > 0:
+            start = rows[rnd.randrange(len(rows))][1]
+        rows.append(
+            (
+                rnd.choice(["chr1", "chr2"]),
+                start,
+                start + rnd.randint(0, 3000),
+                f"dup{i % 50}",
+                "chr" + str(rnd.randint(1, 22)),
+            )
+        )
+    conn.executemany("insert into genomicSuperDups values (?, ?, ?, ?, ?)", rows)
+    conn.execute(
+        "create index genomicSuperDups_pos on genomicSuperDups (chrom, chromStart)"
+    )
+    conn.commit()
+    return conn
+
+
+def backends(tmp_path):
+    conn = make_db(str(tmp_path / "reference.db"))
+    memory = rb.MemoryBackend(conn.cursor(), "genomicSuperDups")
+    return rb.SqliteBackend(str(tmp_path / "reference.db")), memory
+
+
+def test_overlap_matches_sqlite(tmp_path):
+    sqlite, memory = backends(tmp_path)
+    for chrom in ["chr1", "CHR2", "chr3"]:
+        for pos in range(0, 24000, 41):
+            for args in [
+                dict(pos=pos),
+                dict(pos=pos, pad=500),
+                dict(pos=[pos, pos + 2500], columns=["name", "chromStart"]),
+            ]:
+                expected = sqlite.overlap(
+                    "genomicSuperDups", "chrom", chrom, "chromStart", "chromEnd", **args
+                )
+                assert list(expected) == memory.overlap(
+                    "genomicSuperDups", "chrom", chrom, "chromStart", "chromEnd", **args
+                )
+    sqlite.close()
+
+
+def test_memo_index_matches_sqlite(tmp_path):
+    sqlite, memory = backends(tmp_path)
+    memo = ri.MemoIndex(rb.OverlapView(memory, "genomicSuperDups", ["name"]))
+    for pos in range(0, 24000, 53):
+        expected = sqlite.overlap(
+            "genomicSuperDups",
+            "chrom",
+            "chr1",
+            "chromStart",
+            "chromEnd",
+            pos,
+            columns=["name"],
+        )
+        assert memo.first("chr1", pos) == (expected[0] if expected else None)
+    sqlite.close()
+
+
+### EOF
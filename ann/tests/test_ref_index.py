@@ -0,0 +1,82 @@
+# test_ref_index.py
+#
+# The in-memory interval indexes must answer overlap lookups with the
+# same rows, in the same order, as the per-variant SQL queries
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import sys
+import random
+import sqlite3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ref_index as ri
+
+"""An indexed genomicSuperDups-like table with overlapping intervals,
+shared starts and rows inserted out of start order
+"""
+
+
+def make_table(seed=1):
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(":memory:")
+    conn.execute(
+        "create table genomicSuperDups "
+        "(chrom, chromStart, chromEnd, name, otherChrom, otherStart)"
+    )
+    rows = []
+    for i in range(400):
+        start = rnd.randint(0, 20000)
+        if i % 7 == 0 and len(rows) > 0:
+            start = rows[rnd.randrange(len(rows))][1]
+        rows.append(
+            (
+                rnd.choice(["chr1", "chr2"]),
+                start,
+                start + rnd.randint(0, 3000),
+                f"dup{i}",
+                "chr" + str(rnd.randint(1, 22)),
+                rnd.randint(0, 500000),
+            )
+        )
+    conn.executemany("insert into genomicSuperDups values (?, ?, ?, ?, ?, ?)", rows)
+    conn.execute(
+        "create index genomicSuperDups_pos on genomicSuperDups (chrom, chromStart)"
+    )
+    return conn
+
+
+def query(conn, chrom, pos):
+    return conn.execute(
+        "select * from genomicSuperDups where chrom=? AND "
+        "(chromStart <= ? AND ? <= chromEnd)",
+        (chrom, pos, pos),
+    ).fetchall()
+
+
+def test_overlapping_matches_sql():
+    conn = make_table()
+    index = ri.load_index(conn.cursor(), "genomicSuperDups")
+
+    for chrom in ["chr1", "chr2", "chr3"]:
+        for pos in range(0, 24000, 37):
+            expected = query(conn, chrom, pos)
+            assert index.overlapping(chrom, pos) == expected
+            assert index.first(chrom, pos) == (expected[0] if expected else None)
+
+
+def test_memo_index_matches_index():
+    conn = make_table(seed=2)
+    index = ri.load_index(conn.cursor(), "genomicSuperDups")
+    memo = ri.MemoIndex(index, size=10)
+
+    for pos in list(range(0, 24000, 53)) * 2:
+        assert memo.overlapping("chr1", pos) == index.overlapping("chr1", pos)
+
+
+### EOF
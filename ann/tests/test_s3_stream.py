@@ -0,0 +1,178 @@
+# test_s3_stream.py
+#
+# Streaming job input from S3 in byte ranges, and results back as a
+# multipart upload, against stubbed S3 clients
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import io
+import os
+import sys
+import random
+
+import boto3
+import pytest
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import s3_stream as s3
+
+
+def s3_client():
+    return boto3.client(
+        "s3",
+        region_name="us-east-1",
+        aws_access_key_id="testing",
+        aws_secret_access_key="testing",
+    )
+
+
+def body(data):
+    return StreamingBody(io.BytesIO(data), len(data))
+
+
+def object_data(size, seed=1):
+    rnd = random.Random(seed)
+    return rnd.randbytes(size)
+
+
+"""An object read in parts of 'part_size' bytes, each with a ranged GET
+for exactly its bytes
+"""
+
+
+def test_stream_reads_object_in_ranges():
+    data = object_data(3500)
+    client = s3_client()
+    stubber = Stubber(client)
+    stubber.add_response(
+        "head_object",
+        {"ContentLength": len(data)},
+        {"Bucket": "bucket", "Key": "input.vcf"},
+    )
+    for start in range(0, len(data), 1000):
+        end = min(start + 1000, len(data)) - 1
+        stubber.add_response(
+            "get_object",
+            {"Body": body(data[start : end + 1])},
+            {"Bucket": "bucket", "Key": "input.vcf", "Range": f"bytes={start}-{end}"},
+        )
+
+    with stubber:
+        raw = s3.S3Stream(client, "bucket", "input.vcf", part_size=1000, readahead=1)
+        with io.BufferedReader(raw, buffer_size=300) as fh:
+            assert fh.read() == data
+    stubber.assert_no_pending_responses()
+
+
+"""Ranges fetched concurrently are handed out in order
+"""
+
+
+class RangeClient(object):
+    def __init__(self, data):
+        self.data = data
+        self.ranges = []
+
+    def head_object(self, Bucket, Key):
+        return {"ContentLength": len(self.data)}
+
+    def get_object(self, Bucket, Key, Range):
+        start, end = [int(n) for n in Range[len("bytes=") :].split("-")]
+        self.ranges.append((start, end))
+        return {"Body": io.BytesIO(self.data[start : end + 1])}
+
+
+def test_stream_reassembles_readahead_in_order():
+    data = object_data(100000, seed=2)
+    client = RangeClient(data)
+    raw = s3.S3Stream(client, "bucket", "input.vcf", part_size=4096, readahead=4)
+    with io.BufferedReader(raw, buffer_size=1000) as fh:
+        assert fh.read() == data
+    assert sorted(client.ranges) == [
+        (start, min(start + 4096, len(data)) - 1) for start in range(0, len(data), 4096)
+    ]
+
+
+MiB = 1024 * 1024
+
+UPLOAD = {"Bucket": "bucket", "Key": "out.vcf.gz"}
+
+
+def upload_params(**params):
+    return dict(UPLOAD, UploadId="upload-1", **params)
+
+
+"""Writes of any size go out as part_size parts (the last one shorter)
+and the upload is completed with every part's ETag, in order
+"""
+
+
+def test_multipart_upload_sends_parts_and_completes():
+    data = object_data(11 * MiB + 123, seed=3)
+    client = s3_client()
+    stubber = Stubber(client)
+    stubber.add_response("create_multipart_upload", {"UploadId": "upload-1"}, UPLOAD)
+    parts = []
+    for number, start in enumerate(range(0, len(data), 5 * MiB), 1):
+        stubber.add_response(
+            "upload_part",
+            {"ETag": f'"etag-{number}"'},
+            upload_params(PartNumber=number, Body=data[start : start + 5 * MiB]),
+        )
+        parts.append({"ETag": f'"etag-{number}"', "PartNumber": number})
+    stubber.add_response(
+        "complete_multipart_upload",
+        {},
+        upload_params(MultipartUpload={"Parts": parts}),
+    )
+
+    with stubber:
+        upload = s3.MultipartUpload(
+            client, "bucket", "out.vcf.gz", part_size=5 * MiB, inflight=1
+        )
+        for start in range(0, len(data), 777777):
+            upload.write(data[start : start + 777777])
+        upload.close()
+    stubber.assert_no_pending_responses()
+
+
+"""A failed part aborts the upload, so no partial object is created
+"""
+
+
+def test_multipart_upload_aborts_on_failed_part():
+    client = s3_client()
+    stubber = Stubber(client)
+    stubber.add_response("create_multipart_upload", {"UploadId": "upload-1"}, UPLOAD)
+    stubber.add_client_error("upload_part", service_error_code="InternalError")
+    stubber.add_response("abort_multipart_upload", {}, upload_params())
+
+    with stubber:
+        upload = s3.MultipartUpload(client, "bucket", "out.vcf.gz", inflight=1)
+        upload.write(b"##fileformat=VCFv4.1\n")
+        with pytest.raises(Exception):
+            upload.close()
+    stubber.assert_no_pending_responses()
+
+
+def test_multipart_upload_abort():
+    client = s3_client()
+    stubber = Stubber(client)
+    stubber.add_response("create_multipart_upload", {"UploadId": "upload-1"}, UPLOAD)
+    stubber.add_response("abort_multipart_upload", {}, upload_params())
+
+    with stubber:
+        upload = s3.MultipartUpload(client, "bucket", "out.vcf.gz")
+        upload.write(b"##fileformat=VCFv4.1\n")
+        upload.abort()
+        upload.close()
+    stubber.assert_no_pending_responses()
+
+
+### EOF
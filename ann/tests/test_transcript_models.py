@@ -0,0 +1,54 @@
+# test_transcript_models.py
+#
+# Compiled transcript models are shared only between identical rows
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import transcript_models as tm
+
+"""A refGene row: bin, name, chrom, strand, txStart, txEnd, cdsStart,
+cdsEnd, exonCount, exonStarts, exonEnds, ...
+"""
+ROW = (0, "NM_1", "chr1", "+", 1000, 5000, 1500, 4500, 2, "1000,4000,", "2000,5000,")
+
+
+def variant(row, **changes):
+    columns = {"strand": 3, "cdsStart": 6, "cdsEnd": 7}
+    row = list(row)
+    for name, value in changes.items():
+        row[columns[name]] = value
+    return tuple(row)
+
+
+def test_same_row_shares_model():
+    assert tm.get_model(ROW) is tm.get_model(tuple(ROW))
+
+
+def test_rows_differing_in_strand_or_cds_get_their_own_model():
+    base = tm.get_model(ROW)
+    for row in [
+        variant(ROW, strand="-"),
+        variant(ROW, cdsStart=1200),
+        variant(ROW, cdsEnd=4800),
+        variant(ROW, cdsStart=1000, cdsEnd=1000),
+    ]:
+        model = tm.get_model(row)
+        assert model is not base
+        assert (model.strand, model.cdsStart, model.cdsEnd) == (
+            str(row[3]),
+            row[6],
+            row[7],
+        )
+    assert tm.get_model(variant(ROW, strand="-")).inPromoter(5200)
+    assert not base.inPromoter(5200)
+
+
+### EOF
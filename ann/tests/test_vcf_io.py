@@ -0,0 +1,156 @@
+# test_vcf_io.py
+#
+# BGZF output must read back, through any gzip reader, as exactly the
+# text written, and its tabix index must find the same records as a
+# scan of the file
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import sys
+import gzip
+import random
+import struct
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vcf_io as vio
+
+"""Text spanning several BGZF blocks, in pieces of random length
+(some empty, some longer than a block)
+"""
+
+
+def text_pieces(seed=1, total=300000):
+    rnd = random.Random(seed)
+    pieces = []
+    size = 0
+    while size < total:
+        n = rnd.choice([0, 1, rnd.randint(1, 5000), rnd.randint(60000, 80000)])
+        piece = "".join([rnd.choice("ACGT\t\n0123456789") for i in range(min(n, 2000))])
+        pieces.append((piece * (n // 2000 + 1))[:n])
+        size = size + n
+    return pieces
+
+
+"""Sizes of the blocks of the BGZF file at 'path', from their headers
+"""
+
+
+def block_sizes(path):
+    with open(path, "rb") as fh:
+        data = fh.read()
+    sizes = []
+    offset = 0
+    while offset < len(data):
+        assert data[offset : offset + 4] == b"\x1f\x8b\x08\x04"
+        (bsize,) = struct.unpack("<H", data[offset + 16 : offset + 18])
+        sizes.append(bsize + 1)
+        offset = offset + bsize + 1
+    assert offset == len(data)
+    return sizes
+
+
+def test_bgzf_round_trips_through_gzip(tmp_path):
+    pieces = text_pieces()
+    path = str(tmp_path / "out.vcf.gz")
+    with vio.BgzfWriter(path) as fh:
+        for piece in pieces:
+            fh.write(piece)
+
+    with gzip.open(path, "rt") as fh:
+        assert fh.read() == "".join(pieces)
+    sizes = block_sizes(path)
+    assert len(sizes) > 4
+    assert max(sizes) <= 0x10000
+    with open(path, "rb") as fh:
+        assert fh.read().endswith(vio.BGZF_EOF)
+
+
+def test_compress_file_round_trips_through_gzip(tmp_path):
+    text = "".join(text_pieces(seed=2))
+    path = str(tmp_path / "out.vcf")
+    with open(path, "w") as fh:
+        fh.write(text)
+
+    vio.compress_file(path)
+    assert vio.is_gzipped(path)
+    with gzip.open(path, "rt") as fh:
+        assert fh.read() == text
+
+
+"""Sorted VCF records over several chromosomes, with SNVs, longer REF
+alleles and INFO END= spans, dense enough for many BGZF blocks; returns
+the header and (chrom, beg, end, line) for each record, 'beg' and 'end'
+0-based and half-open as tabix computes them
+"""
+
+
+def sorted_records(seed=1, chroms=["1", "2", "X"], per_chrom=6000):
+    rnd = random.Random(seed)
+    header = "##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+    records = []
+    for chrom in chroms:
+        pos = 0
+        for i in range(per_chrom):
+            pos = pos + rnd.choice([0, 1, rnd.randint(1, 200), rnd.randint(1, 20000)])
+            pos = max(pos, 1)
+            ref = "".join(
+                [rnd.choice("ACGT") for j in range(rnd.choice([1, 1, 3, 40]))]
+            )
+            info = "DP=10"
+            end = pos - 1 + len(ref)
+            if rnd.random() < 0.05:
+                end = pos + rnd.randint(0, 50000)
+                info = info + ";END=" + str(end)
+            line = "\t".join([chrom, str(pos), ".", ref, "T", "50", "PASS", info])
+            records.append((chrom, pos - 1, end, line))
+    return header, records
+
+
+def test_tabix_index_matches_scan(tmp_path):
+    pysam = pytest.importorskip("pysam")
+
+    header, records = sorted_records()
+    path = str(tmp_path / "out.vcf.gz")
+    with vio.BgzfWriter(path, index=True) as fh:
+        fh.write(header)
+        for chrom, beg, end, line in records:
+            fh.write(line + "\n")
+    assert os.path.exists(path + ".tbi")
+
+    rnd = random.Random(2)
+    tbx = pysam.TabixFile(path)
+    assert sorted(tbx.contigs) == ["1", "2", "X"]
+    found = 0
+    for i in range(200):
+        chrom = rnd.choice(["1", "2", "X"])
+        start = rnd.randint(0, records[-1][1])
+        stop = start + rnd.choice([1, 100, 20000, 500000])
+        expected = [
+            line
+            for c, beg, end, line in records
+            if c == chrom and beg < stop and end > start
+        ]
+        assert list(tbx.fetch(chrom, start, stop)) == expected
+        found = found + len(expected)
+    tbx.close()
+    assert found > 1000
+
+
+def test_unsorted_output_is_not_indexed(tmp_path):
+    header, records = sorted_records(per_chrom=100)
+    path = str(tmp_path / "out.vcf.gz")
+    with vio.BgzfWriter(path, index=True) as fh:
+        fh.write(header)
+        for chrom, beg, end, line in reversed(records):
+            fh.write(line + "\n")
+    assert not os.path.exists(path + ".tbi")
+
+
+### EOF
@@ -0,0 +1,102 @@
+# transcript_models.py
+#
+# Precompiled refGene transcript models
+#
+# A refGene row is parsed once into integer exon arrays and its CDS and
+# promoter boundaries; exon membership is then a bisect over the exon
+# starts instead of a decode/split/int() pass over every exon for every
+# variant, which matters in gene-dense regions (HLA, olfactory receptor
+# clusters) where each variant overlaps many transcripts.
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import bisect
+
+import utils as u
+
+"""One refGene transcript
+
+All bounds are inclusive, as in the original isBetween() checks.
+Exons are kept sorted by start with a running maximum of the ends, so
+exons() finds every exon holding a position (adjacent exons can share
+a boundary) with a bisect and a short backwards scan, and returns
+their 0-based numbers in ascending order.
+"""
+
+
+class TranscriptModel(object):
+    def __init__(self, row, promoter_offset=500):
+        self.strand = str(row[3])
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+        self.nonCoding = self.cdsStart == self.cdsEnd
+        self.promoterStart = self.txStart - int(promoter_offset)
+        self.promoterEnd = self.txEnd + int(promoter_offset)
+
+        starts = u.asText(row[9]).split(",")
+        ends = u.asText(row[10]).split(",")
+        exons = sorted(
+            [(int(starts[e]), int(ends[e]), e) for e in range(0, self.exonCount)]
+        )
+        self.starts = [x[0] for x in exons]
+        self.ends = [x[1] for x in exons]
+        self.numbers = [x[2] for x in exons]
+        self.maxEnds = []
+        maxEnd = None
+        for end in self.ends:
+            maxEnd = end if maxEnd is None else max(maxEnd, end)
+            self.maxEnds.append(maxEnd)
+
+    def exons(self, pos):
+        hits = []
+        j = bisect.bisect_right(self.starts, pos) - 1
+        while j >= 0 and self.maxEnds[j] >= pos:
+            if self.ends[j] >= pos:
+                hits.append(self.numbers[j])
+            j = j - 1
+        return sorted(hits)
+
+    def exonLabel(self, e):
+        # Exons are numbered in transcription order
+        exnum = e + 1
+        if self.strand == "-":
+            exnum = self.exonCount - e
+        return "ex" + str(exnum) + "/" + str(self.exonCount)
+
+    def inCds(self, pos):
+        return self.cdsStart <= pos <= self.cdsEnd
+
+    def inPromoter(self, pos):
+        if self.strand == "+":
+            return self.promoterStart <= pos <= self.txStart
+        if self.strand == "-":
+            return self.txEnd <= pos <= self.promoterEnd
+        return False
+
+
+_models = {}
+
+"""Returns the model for a refGene row, compiling it on first use
+
+Models are kept for the life of the process, keyed by the whole row
+(rows differing only in strand or CDS bounds classify differently);
+refGene is small enough to hold every transcript.
+"""
+
+
+def get_model(row, promoter_offset=500):
+    key = (tuple(row), promoter_offset)
+    model = _models.get(key)
+    if model is None:
+        model = TranscriptModel(row, promoter_offset)
+        _models[key] = model
+    return model
+
+
+### EOF
@@ -12,42 +12,16 @@ __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
 
 import os
-import json
-import pymysql
-import boto3
-from botocore.exceptions import ClientError
+import db_pool as dbp
 
 """Get connection to reference database
+   Credentials are cached by db_pool; use db_pool.connection() for a
+   pooled connection that is reused across stages and jobs
 """
 
 
 def db_connect():
-    AWS_REGION_NAME = (
-        os.environ["AWS_REGION_NAME"]
-        if ("AWS_REGION_NAME" in os.environ)
-        else "us-east-1"
-    )
-
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client("secretsmanager", region_name=AWS_REGION_NAME)
-    try:
-        asm_response = asm.get_secret_value(SecretId="rds/anntools_database")
-        rds_secret = json.loads(asm_response["SecretString"])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
-
-    # Extract database connection parameters
-    rds_host = rds_secret["host"]
-    mysql_port = rds_secret["port"]
-    username = rds_secret["username"]
-    password = rds_secret["password"]
-    database_name = "annotator"
-
-    # Return a connection to the database
-    return pymysql.connect(
-        host=rds_host, port=mysql_port, user=username, passwd=password, db=database_name
-    )
+    return dbp.connect()
 
 
 """Column inices for pileup and VCF
@@ -123,6 +97,16 @@ def dedup(mylist):
     return outlist
 
 
+"""Text of a column that may come back as bytes (BLOB) or str
+"""
+
+
+def asText(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return str(value)
+
+
 """Helper method to parse fields
 """
 
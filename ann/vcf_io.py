@@ -0,0 +1,288 @@
+# vcf_io.py
+#
+# Plain, gzip and BGZF VCF files
+#
+# Inputs may be plain text or gzip/bgzip compressed (.vcf.gz), local
+# files or s3:// URIs (see s3_stream.py); they are decompressed as they
+# are streamed, never onto disk. Outputs can be
+# written as BGZF (block gzip, as produced by bgzip), which any gzip
+# reader accepts and which can be indexed by block. Compression runs on
+# a background thread (zlib releases the GIL), so it overlaps with
+# annotating the next block. A tabix index of the output can be built
+# in the same pass (see tabix.py), and the output can be uploaded to S3
+# as it is written (see s3_stream.py).
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import io
+import os
+import gzip
+import zlib
+import queue
+import shutil
+import struct
+import threading
+
+import tabix
+import s3_stream as s3
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# Uncompressed bytes per BGZF block; keeps every block under 64 KiB
+BGZF_BLOCK_SIZE = 0xFF00
+
+# The empty block bgzip writes at the end of every file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+"""True when 'path' is gzip (or bgzip) compressed
+"""
+
+
+def is_gzipped(path):
+    if s3.is_s3_uri(path):
+        return s3.read_head(path, 2) == GZIP_MAGIC
+    fh = open(path, "rb")
+    magic = fh.read(2)
+    fh.close()
+    return magic == GZIP_MAGIC
+
+
+"""'path' without its .gz/.bgz extension, e.g. for naming the count log
+"""
+
+
+def base_name(path):
+    for ext in [".gz", ".bgz"]:
+        if path.endswith(ext):
+            return path[: -len(ext)]
+    return path
+
+
+"""Opens a VCF (a path or an s3:// URI) for reading as text,
+decompressing it on the fly when it is gzipped (whatever its name)
+"""
+
+
+def open_vcf(path):
+    if s3.is_s3_uri(path):
+        fh = s3.open_uri(path)
+        if fh.peek(2)[:2] == GZIP_MAGIC:
+            return gzip.open(fh, "rt")
+        return io.TextIOWrapper(fh)
+    if is_gzipped(path):
+        return gzip.open(path, "rt")
+    return open(path)
+
+
+"""Opens 'path' for writing text; BGZF compressed when 'compress' is set,
+and then also tabix indexed into path + '.tbi' when 'index' is set.
+With 'upload' (an s3:// URI) the file is also streamed to S3 as it is
+written, and the object is complete once the writer is closed.
+"""
+
+
+def open_output(path, compress=False, index=False, upload=None, level=6):
+    if compress:
+        return BgzfWriter(path, level=level, index=index, upload=upload)
+    if upload is not None:
+        return TeeWriter(path, upload, text=True)
+    return open(path, "w")
+
+
+"""Closes a writer from open_output without finishing it, e.g. when
+annotation failed: an upload is aborted, so no partial object is created
+"""
+
+
+def abort_output(fh):
+    if hasattr(fh, "abort"):
+        fh.abort()
+    else:
+        fh.close()
+
+
+"""Writes a local file and the same bytes to an S3 multipart upload
+"""
+
+
+class TeeWriter(object):
+    def __init__(self, path, upload, text=False):
+        self.text = text
+        self.fh = open(path, "wb")
+        self.upload = s3.open_upload(upload)
+
+    def write(self, data):
+        size = len(data)
+        if self.text:
+            data = data.encode()
+        self.fh.write(data)
+        self.upload.write(data)
+        return size
+
+    def close(self):
+        self.fh.close()
+        self.upload.close()
+
+    def abort(self):
+        self.fh.close()
+        self.upload.abort()
+
+
+"""Compresses one chunk of at most BGZF_BLOCK_SIZE bytes into a BGZF block
+
+A BGZF block is a gzip member whose header carries the block size in a
+'BC' extra field.
+"""
+
+
+def bgzf_block(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = struct.pack(
+        "<BBBBIBBHBBHH",
+        31,
+        139,
+        8,
+        4,
+        0,
+        0,
+        255,
+        6,
+        66,
+        67,
+        2,
+        len(deflated) + 25,
+    )
+    trailer = struct.pack("<II", zlib.crc32(data) & 0xFFFFFFFF, len(data))
+    return header + deflated + trailer
+
+
+"""Text writer producing a BGZF file
+
+write() collects text into BGZF_BLOCK_SIZE chunks and queues them; a
+background thread compresses and writes the blocks in order. The queue
+is bounded, so a writer that outpaces compression waits instead of
+buffering the whole file. close() flushes the last block, appends the
+EOF block and re-raises any error from the compressing thread.
+
+'upload' streams the compressed blocks to S3 as well (see open_output).
+With 'index', the text is also fed to a tabix index, written to
+path + '.tbi' by close() when the records turned out to be sorted.
+The compressed offset of every block is recorded as it is written, which
+is all it takes to turn uncompressed offsets into virtual offsets.
+"""
+
+
+class BgzfWriter(object):
+    def __init__(self, path, level=6, queue_size=16, index=False, upload=None):
+        self.path = path
+        self.level = level
+        self.fh = open(path, "wb") if upload is None else TeeWriter(path, upload)
+        self.buffer = bytearray()
+        self.blocks = queue.Queue(maxsize=queue_size)
+        self.offsets = []
+        self.written = 0
+        self.index = tabix.TabixIndex() if index else None
+        self.error = None
+        self.thread = threading.Thread(target=self.compress_blocks, daemon=True)
+        self.thread.start()
+
+    def compress_blocks(self):
+        while True:
+            data = self.blocks.get()
+            if data is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                block = bgzf_block(data, self.level)
+                self.fh.write(block)
+                self.offsets.append(self.written)
+                self.written = self.written + len(block)
+            except Exception as e:
+                self.error = e
+
+    def write(self, text):
+        if self.index is not None:
+            self.index.feed(text)
+        self.write_raw(text.encode())
+        return len(text)
+
+    def write_raw(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self.blocks.put(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+
+    def virtual_offset(self, pos):
+        block, within = divmod(pos, BGZF_BLOCK_SIZE)
+        return (self.offsets[block] << 16) | within
+
+    def close(self):
+        if self.fh is None:
+            return
+        if len(self.buffer) > 0:
+            self.blocks.put(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.blocks.put(None)
+        self.thread.join()
+        self.fh.write(BGZF_EOF)
+        self.offsets.append(self.written)
+        self.fh.close()
+        self.fh = None
+        if self.error is not None:
+            raise self.error
+
+        if self.index is not None and self.index.finish():
+            fh_index = BgzfWriter(self.path + ".tbi", level=self.level)
+            fh_index.write_raw(self.index.to_bytes(self.virtual_offset))
+            fh_index.close()
+
+    # Stops without writing the EOF block or the index (see abort_output)
+    def abort(self):
+        if self.fh is None:
+            return
+        self.blocks.put(None)
+        self.thread.join()
+        abort_output(self.fh)
+        self.fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+"""Writes a decompressed copy of 'path' to 'outpath'
+"""
+
+
+def decompress(path, outpath):
+    fh = gzip.open(path, "rt")
+    fh_out = open(outpath, "w")
+    shutil.copyfileobj(fh, fh_out)
+    fh.close()
+    fh_out.close()
+
+
+"""Replaces the plain text file 'path' with its BGZF compressed version,
+tabix indexed into path + '.tbi' when 'index' is set
+"""
+
+
+def compress_file(path, index=False, level=6):
+    fh = open(path)
+    fh_out = BgzfWriter(path + ".bgzf", level=level, index=index)
+    shutil.copyfileobj(fh, fh_out)
+    fh.close()
+    fh_out.close()
+    os.replace(path + ".bgzf", path)
+    if os.path.exists(path + ".bgzf.tbi"):
+        os.replace(path + ".bgzf.tbi", path + ".tbi")
+
+
+### EOF